@@ -0,0 +1,61 @@
+"""
+Benchmark comparing N pet feeders sending their updates as individual
+/get_updates requests with a gateway forwarding the same updates as a single
+/batch_updates request.
+
+The pet feeders have to exist in the database that the CoAP server uses, with
+the product keys "<key_prefix><n>" for n from 0 to count - 1 and the same
+authentication key.
+
+Run from the coap_server folder with the CoAP virtual environment activated,
+for example
+    python benchmarks/bench_batch_updates.py --url coap://127.0.0.1 --count 50
+"""
+
+import argparse, asyncio, time
+from aiocoap import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks /batch_updates against individual /get_updates requests")
+    parser.add_argument('--url', type=str, default='coap://127.0.0.1', help='The address of the CoAP server')
+    parser.add_argument('--count', type=int, default=50, help='The number of pet feeders per round [default=50]')
+    parser.add_argument('--rounds', type=int, default=10, help='The number of rounds to time [default=10]')
+    parser.add_argument('--key_prefix', type=str, default='benchfeeder', help='The product key prefix of the pet feeders')
+    parser.add_argument('--password', type=str, default='benchpassword', help='The authentication key of the pet feeders')
+    return parser.parse_args()
+
+def feeder_payload(args, n):
+    return "u={key}{n}&p={password}&f=1".format(key=args.key_prefix, n=n, password=args.password)
+
+async def individual_round(context, args):
+    requests = [
+        context.request(Message(code=POST,
+                                payload=feeder_payload(args, n).encode('ascii'),
+                                uri=args.url + '/get_updates')).response
+        for n in range(args.count)
+    ]
+    return await asyncio.gather(*requests)
+
+async def batch_round(context, args):
+    payload = '\n'.join(feeder_payload(args, n) for n in range(args.count))
+    request = Message(code=POST, payload=payload.encode('ascii'), uri=args.url + '/batch_updates')
+    return await context.request(request).response
+
+async def time_rounds(name, round_function, context, args):
+    durations = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        await round_function(context, args)
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    median = durations[len(durations) // 2]
+    print("{:<12} median {:8.1f} ms per {} feeders, {:8.0f} feeder updates/s".format(
+        name, median * 1000, args.count, args.count / median))
+
+async def main(args):
+    context = await Context.create_client_context()
+    await time_rounds("individual", individual_round, context, args)
+    await time_rounds("batch", batch_round, context, args)
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main(parse_args()))
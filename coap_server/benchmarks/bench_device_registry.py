@@ -0,0 +1,86 @@
+"""
+Measures the start up load time and memory of the in memory device registry
+for 100k and 1M feeders, and the time of a registry lookup and of rejecting an
+unknown product key.
+
+The feeders are generated page by page instead of being read from MongoDB, so
+the load time is the cost of the registry itself. Add the time of reading the
+feeders collection (about 10k documents per round trip) for a real start up.
+
+Run from the coap_server folder with "python benchmarks/bench_device_registry.py"
+"""
+
+import asyncio, gc, os, sys, time, timeit, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from endpoints.utils import device_registry
+
+class GeneratedFeeders:
+    """
+    Stands in for the AsyncDatabase, generating the feeder pages.
+    """
+    def __init__(self, count):
+        self.count = count
+
+    async def getFeederAuthRecords(self, afterId=None, limit=10000):
+        start = 0 if afterId is None else int(afterId, 16) + 1
+        return [("%024x" % n, "feeder%08d" % n, "$2b$12$%053d" % n, "OK")
+                    for n in range(start, min(start + limit, self.count))]
+
+    async def getFeederAuthRecord(self, productKey):
+        return None
+
+def resident_memory():
+    # Resident set size in bytes, from /proc on Linux
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+def load(count, loop):
+    registry = device_registry.DeviceRegistry(GeneratedFeeders(count), loop=loop)
+    loop.run_until_complete(registry.refresh(full=True))
+    return registry
+
+def measure(count):
+    loop = asyncio.new_event_loop()
+
+    # Memory of the registry structures, traced in a separate load as
+    # tracemalloc slows the load down several times.
+    tracemalloc.start()
+    registry = load(count, loop)
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del registry
+    gc.collect()
+
+    rss_before = resident_memory()
+    start = time.perf_counter()
+    registry = load(count, loop)
+    load_time = time.perf_counter() - start
+    gc.collect()
+    rss = resident_memory() - rss_before
+
+    number = 200000
+    keys = ["feeder%08d" % (n * 7919 % count) for n in range(number)]
+    it = iter(keys * 5)
+    hit = min(timeit.repeat(lambda: registry.get(next(it)), number=number, repeat=5)) / number
+    unknown = ["unknown%08d" % n for n in range(1000)]
+    for key in unknown:
+        registry.remember_unknown(key)
+    it = iter(unknown * 1000)
+    reject = min(timeit.repeat(lambda: registry.is_known_unknown(next(it)), number=number, repeat=5)) / number
+
+    print("{:>9} {:>10.2f} {:>12.1f} {:>14.1f} {:>10.1f} {:>9.2f} {:>10.2f}".format(
+        count, load_time, traced / 2 ** 20, rss / 2 ** 20, traced / count, hit * 1e6, reject * 1e6))
+    loop.close()
+
+def main():
+    print("{:>9} {:>10} {:>12} {:>14} {:>10} {:>9} {:>10}".format(
+        "feeders", "load (s)", "traced (MiB)", "RSS grew (MiB)", "bytes/feeder", "get (us)", "reject (us)"))
+    for count in (100000, 1000000):
+        measure(count)
+
+if __name__ == "__main__":
+    main()
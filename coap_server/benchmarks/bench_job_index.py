@@ -0,0 +1,66 @@
+"""
+Measures the memory used by the in memory job index per million pending jobs
+and the time to answer a poll from it.
+
+Run from the coap_server folder with "python benchmarks/bench_job_index.py"
+"""
+
+import asyncio, datetime as dt, os, random, sys, timeit, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from endpoints.utils import job_index
+
+JOBS = 1000000
+
+class PendingJobs:
+    """
+    Stands in for the AsyncDatabase, returning the generated pending jobs.
+    """
+    def __init__(self, pending):
+        self.pending = pending
+
+    async def getPendingEventTimes(self):
+        return self.pending
+
+def generate(jobs_per_feeder):
+    now = dt.datetime.now()
+    pending = []
+    for feeder in range(JOBS // jobs_per_feeder):
+        feeder_id = "%024x" % random.getrandbits(96)
+        for _ in range(jobs_per_feeder):
+            pending.append((feeder_id, now + dt.timedelta(seconds=random.randint(-60, 86400))))
+    return pending
+
+def measure(jobs_per_feeder):
+    pending = generate(jobs_per_feeder)
+    loop = asyncio.new_event_loop()
+    index = job_index.JobIndex(PendingJobs(pending), loop=loop)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    loop.run_until_complete(index.reload())
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # The feeder id strings are shared with the loaded jobs here, so the
+    # size of one id is added to the index of each feeder.
+    id_bytes = sys.getsizeof(pending[0][0]) * index.feeders
+    used = after - before + id_bytes
+
+    feeder_ids = [feeder_id for feeder_id, _ in pending[::jobs_per_feeder]]
+    number = 200000
+    lookups = [random.choice(feeder_ids) for _ in range(number)]
+    it = iter(lookups * 5)
+    lookup = min(timeit.repeat(lambda: index.has_due(next(it)), number=number, repeat=5)) / number
+
+    print("{:>10} {:>10} {:>12.1f} {:>12.1f} {:>12.3f}".format(
+        len(index), index.feeders, used / 2 ** 20, used / len(index), lookup * 1e6))
+    loop.close()
+
+def main():
+    print("{:>10} {:>10} {:>12} {:>12} {:>12}".format("jobs", "feeders", "memory (MiB)", "bytes/job", "has_due (us)"))
+    for jobs_per_feeder in (1, 4):
+        measure(jobs_per_feeder)
+
+if __name__ == "__main__":
+    main()
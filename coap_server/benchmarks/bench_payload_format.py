@@ -0,0 +1,35 @@
+"""
+Micro-benchmark comparing the legacy form encoded payload of the pet feeders
+with the compact CBOR payload, both in size and in parsing time.
+
+Run from the coap_server folder with "python benchmarks/bench_payload_format.py"
+"""
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from endpoints.utils import parse_util
+
+REPEAT = 5
+NUMBER = 100000
+
+def main():
+    payloads = {
+        "poll": {'u': "testingkey1234", 'p': "13511NG%%", 'f': 50},
+        "drop status": {'u': "testingkey1234", 'p': "13511NG%%", 'd': 0},
+    }
+    keys = {name: key for key, name in parse_util.CBOR_KEYS.items()}
+
+    print("{:<12} {:>8} {:>14} {:>14}".format("payload", "format", "size (bytes)", "parse (us)"))
+    for name, values in payloads.items():
+        legacy = "&".join("{}={}".format(k, v) for k, v in values.items()).encode('ascii')
+        cbor = parse_util.encode_cbor({keys[k]: v for k, v in values.items()})
+
+        for fmt, payload, parse in [
+                ("text", legacy, parse_util.parse_post_data),
+                ("cbor", cbor, parse_util.parse_cbor_data)]:
+            best = min(timeit.repeat(lambda: parse(payload), repeat=REPEAT, number=NUMBER))
+            print("{:<12} {:>8} {:>14} {:>14.3f}".format(name, fmt, len(payload), best / NUMBER * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Load generator that simulates a fleet of pet feeders polling the CoAP server,
+reporting the throughput, latency percentiles and error rates of /get_updates.
+
+Each simulated pet feeder polls every --poll_interval seconds (with
+--poll_jitter random jitter) reporting the food its pet ate, drawn from
+--food_distribution, and reports its drop status when the server tells it to
+drop food, failing with the probability 1 - --drop_success_rate.
+
+The pet feeders have the product keys "<key_prefix><n>" for n from 0 to
+--feeders - 1 and all use --password. They can be created in the database with
+--provision, which needs the Database API installed and FEEDER_MONGO_URI
+pointing at the same database as the server. --drops_per_minute schedules
+drops now for random pet feeders during the run, like the website's feed now
+button, so the dispatch path is measured too.
+
+Typical local run, from the coap_server folder
+    docker run -d -p 27017:27017 mongo
+    export FEEDER_MONGO_URI=mongodb://localhost:27017
+    python server.py --log_level WARNING &
+    python benchmarks/simulate_fleet.py --url coap://127.0.0.1 --feeders 2000 --provision
+"""
+
+import argparse, asyncio, json, os, random, sys, time
+from aiocoap import *
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from test_client import feeder_payload, send_update
+
+FOOD_DISTRIBUTIONS = {
+    "none": lambda mean: 0,
+    "uniform": lambda mean: random.randint(0, 2 * mean),
+    "exponential": lambda mean: int(random.expovariate(1 / mean)) if mean > 0 else 0,
+    "normal": lambda mean: max(0, int(random.gauss(mean, mean / 3))),
+}
+
+class FleetStats:
+    """
+    Collects the outcome and latency of every request the fleet sends.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.responses = {}
+        self.errors = {}
+        self.drops = 0
+        self.failed_drops = 0
+
+    def record(self, latency, response=None, error=None):
+        if error is not None:
+            self.errors[error] = self.errors.get(error, 0) + 1
+            return
+        self.latencies.append(latency)
+        # An empty response means the server rejected the request
+        response = response or "empty"
+        self.responses[response] = self.responses.get(response, 0) + 1
+
+    @property
+    def requests(self):
+        return len(self.latencies) + sum(self.errors.values())
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        def percentile(q):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+        requests = self.requests
+        failures = sum(self.errors.values()) + self.responses.get("empty", 0)
+        return {
+            "elapsed": elapsed,
+            "requests": requests,
+            "throughput": requests / elapsed if elapsed else 0.0,
+            "latency_ms": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": latencies[-1] * 1000 if latencies else 0.0,
+            },
+            "error_rate": failures / requests if requests else 0.0,
+            "responses": self.responses,
+            "errors": self.errors,
+            "drops": self.drops,
+            "failed_drops": self.failed_drops,
+        }
+
+async def timed_update(context, args, stats, payload):
+    start = time.perf_counter()
+    try:
+        response = await asyncio.wait_for(send_update(context, args.url + '/get_updates', payload), args.timeout)
+    except asyncio.TimeoutError:
+        stats.record(None, error="timeout")
+        return None
+    except Exception as e:
+        stats.record(None, error=type(e).__name__)
+        return None
+    stats.record(time.perf_counter() - start, response=response)
+    return response
+
+async def simulate_feeder(context, args, stats, number, stop_at):
+    key = args.key_prefix + str(number)
+    eaten = FOOD_DISTRIBUTIONS[args.food_distribution]
+
+    # Spreads the first polls of the fleet over one poll interval
+    await asyncio.sleep(random.uniform(0, args.poll_interval))
+    while time.monotonic() < stop_at:
+        payload = feeder_payload(key, args.password, food_eaten=eaten(args.food_mean))
+        response = await timed_update(context, args, stats, payload)
+        if response == 'd':
+            failed = random.random() >= args.drop_success_rate
+            stats.drops += 1
+            stats.failed_drops += failed
+            await timed_update(context, args, stats, feeder_payload(key, args.password, drop_failed=failed))
+
+        jitter = random.uniform(-args.poll_jitter, args.poll_jitter)
+        await asyncio.sleep(max(0.0, args.poll_interval + jitter))
+
+async def schedule_drops(args, stop_at):
+    # Imported here so that the simulator runs without the Database API
+    # unless drops are scheduled or feeders provisioned.
+    import datetime as dt
+    import feeder_api.db_helper as db_helper
+
+    loop = asyncio.get_event_loop()
+    keys = [args.key_prefix + str(number) for number in range(args.feeders)]
+    while time.monotonic() < stop_at:
+        await asyncio.sleep(60 / args.drops_per_minute)
+        key = random.choice(keys)
+        feeder = await loop.run_in_executor(None, db_helper.getFeederByProductKey, key)
+        if feeder is not None:
+            await loop.run_in_executor(None, lambda: db_helper.addScheduleItem(
+                feeder["_id"], scheduleType="S", time=dt.datetime.now(), count=1))
+
+def provision(args):
+    import feeder_api.db_helper as db_helper
+    from endpoints.utils import async_db
+
+    credentials = [(args.key_prefix + str(number), args.password) for number in range(args.feeders)]
+    # The passwords are hashed in the worker threads of an AsyncDatabase, as
+    # the server would, only for the feeders that do not exist yet.
+    db = async_db.AsyncDatabase(db_helper, max_concurrency=os.cpu_count() or 1)
+    new_credentials = db_helper.newFeederCredentials(credentials)
+    hashes = asyncio.get_event_loop().run_until_complete(
+        db.map(db_helper.hashFeederPassword, [password for _, password in new_credentials]))
+    db.shutdown()
+    inserted = db_helper.insertFeeders(new_credentials, address="simulated", hashes=hashes)
+    print("Provisioned {} new pet feeders ({} already existed)".format(inserted, len(credentials) - inserted))
+
+async def report_progress(stats, start, interval):
+    last = 0
+    while True:
+        await asyncio.sleep(interval)
+        requests = stats.requests
+        print("{:7.0f}s {:8d} requests {:8.1f} req/s {:6d} errors".format(
+            time.monotonic() - start, requests, (requests - last) / interval, sum(stats.errors.values())))
+        last = requests
+
+async def run(args):
+    context = await Context.create_client_context()
+    stats = FleetStats()
+    start = time.monotonic()
+    stop_at = start + args.duration
+
+    progress = asyncio.ensure_future(report_progress(stats, start, args.report_interval))
+    tasks = [simulate_feeder(context, args, stats, number, stop_at) for number in range(args.feeders)]
+    if args.drops_per_minute > 0:
+        tasks.append(schedule_drops(args, stop_at))
+    await asyncio.gather(*tasks)
+    progress.cancel()
+    return stats.report(time.monotonic() - start)
+
+def print_report(report):
+    print()
+    print("Requests:    {requests} in {elapsed:.1f}s ({throughput:.1f} req/s)".format(**report))
+    print("Latency:     p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, max {max:.1f} ms".format(**report["latency_ms"]))
+    print("Error rate:  {:.2%}".format(report["error_rate"]))
+    print("Responses:   {}".format(report["responses"]))
+    print("Errors:      {}".format(report["errors"]))
+    print("Drops:       {drops} ({failed_drops} reported as failed)".format(**report))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulates a fleet of pet feeders polling the CoAP server")
+    parser.add_argument('--url', type=str, default='coap://127.0.0.1', help='The address of the CoAP server')
+    parser.add_argument('--feeders', type=int, default=1000, help='The number of simulated pet feeders [default=1000]')
+    parser.add_argument('--duration', type=float, default=60, help='The number of seconds to run for [default=60]')
+    parser.add_argument('--poll_interval', type=float, default=10, help='The seconds between polls of each pet feeder [default=10]')
+    parser.add_argument('--poll_jitter', type=float, default=1, help='The random jitter added to the poll interval in seconds [default=1]')
+    parser.add_argument('--food_distribution', choices=sorted(FOOD_DISTRIBUTIONS), default='exponential', help='The distribution of the food eaten between polls [default=exponential]')
+    parser.add_argument('--food_mean', type=int, default=5, help='The mean grams of food eaten between polls [default=5]')
+    parser.add_argument('--drop_success_rate', type=float, default=0.95, help='The probability that a drop succeeds [default=0.95]')
+    parser.add_argument('--drops_per_minute', type=float, default=0, help='The drops to schedule per minute across the fleet, needs the Database API [default=0]')
+    parser.add_argument('--timeout', type=float, default=30, help='The seconds before a request counts as timed out [default=30]')
+    parser.add_argument('--key_prefix', type=str, default='simfeeder', help='The product key prefix of the pet feeders')
+    parser.add_argument('--password', type=str, default='simpassword', help='The authentication key of the pet feeders')
+    parser.add_argument('--provision', action='store_true', help='Creates the pet feeders in the database before running')
+    parser.add_argument('--report_interval', type=float, default=10, help='The seconds between progress lines [default=10]')
+    parser.add_argument('--json', type=str, default=None, help='Also writes the report to this JSON file')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.provision:
+        provision(args)
+    report = asyncio.get_event_loop().run_until_complete(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
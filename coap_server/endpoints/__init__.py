@@ -1,4 +1,7 @@
 __all__ = [
     'server_time',
-    'get_updates'
+    'get_updates',
+    'feeder_commands',
+    'batch_updates',
+    'server_metrics'
 ]
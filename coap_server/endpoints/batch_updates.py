@@ -0,0 +1,277 @@
+import asyncio, aiocoap, logging, time
+import aiocoap.resource as resource
+import feeder_api.db_helper as db_helper
+import feeder_api.clock as clock
+from .utils import parse_util, async_db, admission as admission_control
+from .utils.metrics import Metrics
+
+class BatchUpdateResource(resource.Resource):
+    """
+    The endpoint resource for gateways that forward the updates of many Pet
+    Feeders at once, for example in catteries and shelters.
+
+    Each record of the batch has the same variables as a /get_updates POST
+    request: product key (u), authentication key (p) and either the amount of
+    food consumed (f) or the drop status (d). In the legacy format the records
+    are separated by new lines (empty lines are ignored), with CBOR
+    (Content-Format 60) the payload is an array of the CBOR maps accepted by
+    /get_updates.
+
+    Example
+        POST request payload: "u=feeder1&p=pass1&f=50\nu=feeder2&p=pass2&d=0"
+
+    The response holds one answer per record in the same order, "d" or "n" for
+    food updates as in /get_updates, "status updated" for drop statuses and an
+    empty answer for invalid records. The answers are separated by new lines,
+    or form a CBOR array of strings.
+
+    Example
+        response payload: "d\nstatus updated"
+
+    All of the records are looked up, logged and dispatched with bulk
+    database operations, so a batch costs the same number of database round
+    trips however many pet feeders it holds. The authentication keys are
+    verified (bcrypt, or a credential cache hit) in the database threads, at
+    most verify_concurrency of one batch at once, so a batch of uncached
+    devices neither holds one thread for all of its bcrypt checks nor takes
+    every thread from the other requests.
+
+    A batch takes one slot of the in flight cap of the AdmissionControl and
+    each record is checked against the rate limit of its product key. Records
+    over their rate get an empty answer.
+
+    While the in memory JobIndex is authoritative, only the pet feeders with a
+    job due are dispatched.
+    """
+
+    def __init__(self, db=None, consumption=None, max_records=256, metrics=None, admission=None,
+            job_index=None, verify_concurrency=8):
+        """
+        Parameters:
+            db: AsyncDatabase [default=None]
+                the asynchronous database access layer, wraps db_helper with
+                the default concurrency limit if None
+            consumption: ConsumptionBuffer [default=None]
+                buffers the food eaten and writes it in batches, the food eaten
+                of a batch is written with one bulk write if None
+            max_records: int [default=256]
+                the maximum number of records accepted in one batch
+            metrics: Metrics [default=None]
+                the server metrics to record the batch latencies and counters
+                in, metrics of its own if None
+            admission: AdmissionControl [default=None]
+                the per product key rate limit and in flight cap, every
+                batch and record is admitted if None
+            job_index: JobIndex [default=None]
+                the in memory index of the pending jobs, every polling pet
+                feeder is dispatched if None
+            verify_concurrency: int [default=8]
+                the number of authentication keys of one batch verified at
+                once in the database threads
+        """
+        super().__init__()
+        self.db = db if db is not None else async_db.AsyncDatabase(db_helper)
+        self.consumption = consumption
+        self.max_records = max_records
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.admission = admission
+        self.job_index = job_index
+        self.verify_concurrency = max(1, verify_concurrency)
+        self.logger = logging.getLogger(__name__)
+
+    async def render_post(self, request):
+        """
+        Processes the batched updates sent by a gateway.
+
+        Parameters:
+            request:
+                the data from the POST request that the gateway sends
+        """
+        self.metrics.inc("batch_updates.requests")
+        admission = self.admission
+        if admission is None:
+            with self.metrics.timer("batch_updates.total"):
+                return await self._process_batch(request)
+
+        max_age = admission.enter()
+        if max_age is not None:
+            self.metrics.inc("batch_updates.overloaded")
+            return admission_control.service_unavailable(max_age)
+        try:
+            with self.metrics.timer("batch_updates.total"):
+                return await self._process_batch(request)
+        finally:
+            admission.leave()
+
+    async def _process_batch(self, request):
+        metrics = self.metrics
+        content_format = request.opt.content_format
+        try:
+            records = parse_batch(request.payload, content_format)
+        except Exception as e:
+            metrics.inc("batch_updates.bad_payloads")
+            return aiocoap.Message(code = aiocoap.BAD_REQUEST)
+
+        if len(records) > self.max_records:
+            return aiocoap.Message(code = aiocoap.REQUEST_ENTITY_TOO_LARGE)
+
+        db = self.db
+        answers = [''] * len(records)
+
+        # Pet feeders need to send their product and authentication keys.
+        valid = [(index, record) for index, record in enumerate(records)
+                    if has_credentials(record)]
+        if self.admission is not None:
+            admitted = [(index, record) for index, record in valid
+                    if self.admission.check_rate(record['u']) is None]
+            metrics.inc("batch_updates.rate_limited", len(valid) - len(admitted))
+            valid = admitted
+        metrics.inc("batch_updates.records", len(records))
+        with metrics.timer("batch_updates.auth"):
+            auths = await self._authenticate([(record['u'], record['p']) for _, record in valid])
+
+        statuses = {}
+        increments = {}
+        polling = []
+        hour = clock.now().replace(minute=0, second=0, microsecond=0)
+        for (index, record), feeder_auth in zip(valid, auths):
+            if not feeder_auth:
+                metrics.inc("batch_updates.auth_failures")
+                continue
+            device_drop_success = record.get('d', None)
+            device_food_eaten = record.get('f', None)
+
+            if device_drop_success not in (None, ''):
+                statuses[feeder_auth.id] = "FAIL" if str(device_drop_success) == '1' else "OK"
+                answers[index] = 'status updated'
+                continue
+            elif device_food_eaten not in (None, ''):
+                try:
+                    food_eaten = int(device_food_eaten)
+                except:
+                    continue
+                key = (feeder_auth.id, hour)
+                increments[key] = increments.get(key, 0) + food_eaten
+            polling.append((index, feeder_auth.id))
+
+        if statuses:
+            await db.updateFeederStatuses(statuses)
+
+        if self.consumption is not None:
+            for (feeder_id, log_hour), food_eaten in increments.items():
+                self.consumption.add(feeder_id, food_eaten, log_hour)
+        elif increments:
+            await db.logOngoingConsumptionBatch(increments)
+
+        # Claims, logs and clears the pending events of every pet feeder in
+        # the batch at once. A pet feeder listed twice only drops once.
+        job_index = self.job_index
+        due = [feeder_id for _, feeder_id in polling]
+        if job_index is not None and job_index.authoritative:
+            due = [feeder_id for feeder_id in due if job_index.has_due(feeder_id)]
+        dispatched = {}
+        if due:
+            dispatch_started = clock.now().timestamp()
+            with metrics.timer("batch_updates.dispatch"):
+                dispatched = await db.dispatchReadyEventsForFeeders(due)
+            if job_index is not None:
+                for feeder_id in due:
+                    job_index.clear_due(feeder_id, dispatch_started)
+        for index, feeder_id in polling:
+            answers[index] = 'd' if dispatched.pop(feeder_id, None) else 'n'
+            if answers[index] == 'd':
+                metrics.inc("batch_updates.drops_issued")
+
+        return encode_batch(answers, content_format)
+
+    async def _authenticate(self, credentials):
+        """
+        Authenticates the records of a batch like db_helper.authenticateFeeders,
+        with one query for the feeders and the password checks spread over the
+        database threads.
+
+        Parameters:
+            credentials: list
+                the (product key, authentication key) of each record
+
+        Returns:
+            a list in the same order holding a db_helper.FeederAuth(id, status)
+            for every valid record and None for the others
+        """
+        results = [None] * len(credentials)
+        if not credentials:
+            return results
+        db = self.db
+        found = {record[1]: record for record in
+                    await db.getFeederAuthRecordsByKeys({product_key for product_key, _ in credentials})}
+        checks = [(index, product_key, password, found[product_key])
+                    for index, (product_key, password) in enumerate(credentials) if product_key in found]
+
+        for start in range(0, len(checks), self.verify_concurrency):
+            chunk = checks[start:start + self.verify_concurrency]
+            valid = await asyncio.gather(*(db.checkFeederPassword(product_key, password, record[2])
+                        for _, product_key, password, record in chunk))
+            for (index, _, _, record), is_valid in zip(chunk, valid):
+                if is_valid:
+                    results[index] = db_helper.FeederAuth(record[0], record[3])
+        return results
+
+def has_credentials(record):
+    """
+    Checks that a record of a batch is a map holding a non empty product key
+    (u) and authentication key (p), both strings. CBOR records can hold any
+    type, which must not reach the rate limit or the authentication.
+    """
+    if not isinstance(record, dict):
+        return False
+    device_key, device_auth = record.get('u'), record.get('p')
+    return isinstance(device_key, str) and isinstance(device_auth, str) and device_key != '' and device_auth != ''
+
+def parse_batch(request_payload, content_format=None):
+    """
+    Parses the records of a batch into a list of dictionaries with the same
+    keys as parse_util.parse_post_data, None for the CBOR items that are not
+    maps and the legacy lines that are not ASCII.
+
+    Parameters:
+        request_payload:
+            the POST request payload
+        content_format: int [default=None]
+            the Content-Format of the request, the legacy format if None
+    """
+    if content_format == parse_util.CBOR_CONTENT_FORMAT:
+        items = parse_util.decode_cbor(request_payload)
+        if not isinstance(items, list):
+            raise ValueError("Payload is not a CBOR array")
+        # Items that are not maps are kept as None, to get an empty answer
+        return [{parse_util.CBOR_KEYS[key]: value for key, value in item.items() if key in parse_util.CBOR_KEYS}
+                    if isinstance(item, dict) else None for item in items]
+
+    lines = request_payload.split(b'\n')
+    return [parse_line(line) for line in lines if line.strip()]
+
+def parse_line(line):
+    """
+    Parses one legacy line of a batch, None if it is not ASCII so that only
+    its record gets an empty answer.
+    """
+    try:
+        return parse_util.parse_post_data(line)
+    except UnicodeDecodeError:
+        return None
+
+def encode_batch(answers, content_format=None):
+    """
+    Creates the response message holding the answers of a batch.
+
+    Parameters:
+        answers: list
+            the answer to each record of the batch, in order
+        content_format: int [default=None]
+            the Content-Format of the request, the legacy format if None
+    """
+    if content_format == parse_util.CBOR_CONTENT_FORMAT:
+        response = aiocoap.Message(payload = parse_util.encode_cbor(answers))
+        response.opt.content_format = content_format
+        return response
+    return aiocoap.Message(payload = '\n'.join(answers).encode('ascii'))
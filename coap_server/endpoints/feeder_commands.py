@@ -0,0 +1,230 @@
+import asyncio, aiocoap, logging
+import aiocoap.resource as resource
+import feeder_api.db_helper as db_helper
+import feeder_api.clock as clock
+import datetime as dt
+from .utils import parse_util, async_db, admission as admission_control
+
+class FeederCommandsResource(resource.ObservableResource):
+    """
+    The observable endpoint resource that pushes drop food commands to a single
+    Pet Feeder, found at /feeder/<product key>/commands.
+
+    Pet feeders send a GET request with the Observe option and their
+    authentication key (p) as a query parameter. The response is "d" if the pet
+    feeder has to drop food now and "n" otherwise. While the observation is
+    active a notification is sent the moment a job becomes due or the owner
+    requests an immediate drop, so the pet feeder does not have to poll.
+
+    Example
+        GET coap://<server address>/feeder/testingkey1234/commands?p=13511NG%%
+
+    The jobs of a notification are dispatched the same way as in
+    FeederUpdateResource, so the pet feeder reports whether the drop was
+    successful with a "d" POST to /get_updates.
+
+    Requests go through the same AdmissionControl as /get_updates: the in
+    flight cap and the rate limit of the product key apply before the pet
+    feeder is authenticated. Notifications the server sends to observers do
+    not count against the rate limit.
+    """
+
+    def __init__(self, product_key, site):
+        """
+        Parameters:
+            product_key: str
+                the product key of the pet feeder this resource belongs to
+            site: FeederCommandsSite
+                the site that routes the requests to this resource
+        """
+        super().__init__()
+        self.product_key = product_key
+        self.site = site
+        self.feeder_id = None
+        self.handle = None
+        self.wake_time = None
+        # The renders left of the notification being sent, one per observer
+        self._notifying = 0
+        self.logger = logging.getLogger(__name__)
+
+    def update_observation_count(self, count):
+        if count == 0:
+            self.cancel_wake()
+            self.site.forget(self)
+
+    async def render_get(self, request):
+        """
+        Authenticates the pet feeder and dispatches its due jobs.
+
+        Parameters:
+            request:
+                the GET request, with the authentication key as the "p" query
+        """
+        admission = self.site.admission
+        if admission is None:
+            return await self._process_get(request)
+
+        # Sheds the request before any database or bcrypt work if too many are
+        # in flight
+        max_age = admission.enter()
+        if max_age is not None:
+            return admission_control.service_unavailable(max_age)
+        try:
+            if self._notifying > 0:
+                self._notifying -= 1
+            else:
+                max_age = admission.check_rate(self.product_key)
+                if max_age is not None:
+                    if not self._observations:
+                        self.site.forget(self)
+                    return admission_control.service_unavailable(max_age)
+            return await self._process_get(request)
+        finally:
+            admission.leave()
+
+    async def _process_get(self, request):
+        db = self.site.db
+        device_auth = parse_util.get_query(request, 'p')
+        if not device_auth:
+            return aiocoap.Message(code = aiocoap.UNAUTHORIZED)
+
+        feeder_auth = await db.authenticateFeeder(self.product_key, device_auth)
+        if not feeder_auth:
+            if not self._observations:
+                self.site.forget(self)
+            return aiocoap.Message(code = aiocoap.UNAUTHORIZED)
+
+        jobs = await db.dispatchReadyEventsForFeeder(feeder_auth.id)
+        payload = 'd' if len(jobs) > 0 else 'n'
+
+        if self._observations:
+            self.site.register(self, feeder_auth.id)
+
+            # Wakes up for the next job that is not due yet, or re-checks the
+            # database after a while in case a job was added without being seen.
+            next_time = await db.getNextEventTimeForFeeder(feeder_auth.id)
+            recheck_time = clock.now() + dt.timedelta(seconds=self.site.recheck_interval)
+            self.cancel_wake()
+            self.wake_at(min(next_time, recheck_time) if next_time else recheck_time)
+        else:
+            # A plain GET without Observe, nothing to notify later.
+            self.site.forget(self)
+
+        return aiocoap.Message(payload = payload.encode('ascii'))
+
+    def wake_at(self, when):
+        """
+        Notifies the observers at the given time, if it is earlier than the
+        currently planned notification.
+
+        Parameters:
+            when: datetime
+                the time the observers should be notified
+        """
+        if not self._observations:
+            return
+        if self.handle is not None and self.wake_time <= when:
+            return
+
+        self.cancel_wake()
+        delay = max(0.0, (when - clock.now()).total_seconds())
+        self.wake_time = when
+        self.handle = asyncio.get_event_loop().call_later(delay, self.notify)
+
+    def cancel_wake(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+            self.wake_time = None
+
+    def notify(self):
+        self.handle = None
+        self.wake_time = None
+        self._notifying = len(self._observations)
+        self.updated_state()
+
+class FeederCommandsSite(resource.Site):
+    """
+    Routes requests for /feeder/<product key>/commands to the
+    FeederCommandsResource of that pet feeder, creating it on first use.
+
+    Resources of unknown pet feeders are dropped again as soon as they fail to
+    authenticate, and every resource is dropped once it has no observers left.
+
+    Instance Variables:
+        db:
+            the asynchronous database access layer
+        admission:
+            the per product key rate limit and in flight cap shared with
+            /get_updates, None if every request is admitted
+        recheck_interval:
+            the number of seconds after which observed pet feeders re-check the
+            database for jobs that were not announced by the job watcher
+    """
+
+    def __init__(self, db=None, recheck_interval=60.0, admission=None):
+        """
+        Parameters:
+            db: AsyncDatabase [default=None]
+                the asynchronous database access layer, wraps db_helper with
+                the default concurrency limit if None
+            recheck_interval: float [default=60.0]
+                the number of seconds between database re-checks of observed
+                pet feeders
+            admission: AdmissionControl [default=None]
+                the per product key rate limit and in flight cap, every
+                request is admitted if None
+        """
+        super().__init__()
+        self.db = db if db is not None else async_db.AsyncDatabase(db_helper)
+        self.recheck_interval = recheck_interval
+        self.admission = admission
+        self._by_key = {}
+        self._by_id = {}
+
+    def _find_child_and_pathstripped_message(self, request):
+        path = request.opt.uri_path
+        if len(path) != 2 or path[1] != 'commands' or not path[0]:
+            raise KeyError()
+
+        child = self._by_key.get(path[0])
+        if child is None:
+            child = FeederCommandsResource(path[0], self)
+            self._by_key[path[0]] = child
+        return child, request.copy(uri_path=())
+
+    def register(self, child, feeder_id):
+        """
+        Remembers which pet feeder an authenticated resource belongs to so job
+        notifications can be routed to it.
+        """
+        child.feeder_id = feeder_id
+        self._by_id[feeder_id] = child
+
+    def forget(self, child):
+        """
+        Drops the resource of a pet feeder that is no longer observed.
+        """
+        if self._by_key.get(child.product_key) is child:
+            del self._by_key[child.product_key]
+        if child.feeder_id is not None and self._by_id.get(child.feeder_id) is child:
+            del self._by_id[child.feeder_id]
+
+    def job_scheduled(self, feeder_id, time):
+        """
+        Called for every job added to the job queue, notifies the observers of
+        the pet feeder when the job becomes due.
+
+        Parameters:
+            feeder_id: str
+                the id of the pet feeder the job is for
+            time: datetime
+                the time the job is due
+        """
+        child = self._by_id.get(feeder_id)
+        if child is not None:
+            child.wake_at(time)
+
+    @property
+    def observed_feeders(self):
+        return len(self._by_id)
@@ -1,9 +1,11 @@
 import random
 import asyncio, aiocoap, logging
 import aiocoap.resource as resource
-import feeder_api.db_helper as db
+import feeder_api.db_helper as db_helper
+import feeder_api.clock as clock
 import datetime as dt
-from .utils import parse_util
+from .utils import parse_util, async_db, admission as admission_control
+from .utils.metrics import Metrics
 
 class FeederUpdateResource(resource.Resource):
     """
@@ -28,11 +30,64 @@ class FeederUpdateResource(resource.Resource):
 
     Example
         POST request payload: "u=testingkey1234&p=13511NG%%&d=0"
+
+    Pet feeders on constrained links can instead send a CBOR map with the
+    Content-Format option set to 60 (application/cbor), using the integer keys
+    0 (u), 1 (p), 2 (f) and 3 (d). The response is then a CBOR text string.
+
+    Example
+        CBOR POST request payload: {0: "testingkey1234", 1: "13511NG%%", 2: 50}
+
+    All of the database calls are run through an AsyncDatabase so that the
+    event loop keeps serving other pet feeders while MongoDB is responding.
+
+    The time spent in each stage of a request is recorded in the latency
+    histograms "get_updates.<stage>" of the server metrics, along with the
+    request, authentication failure, drop and empty response counters.
+
+    Requests are admitted by the AdmissionControl before any database work,
+    rejected requests get a 5.03 Service Unavailable response with a Max-Age
+    option asking the pet feeder to retry later.
+
+    While the in memory JobIndex is authoritative, polls with no job due are
+    answered "n" without querying the job queue.
+
+    With a DeviceRegistry, pet feeders are looked up in memory instead of in
+    the feeders collection and unknown product keys are rejected without a
+    database query after their first poll.
     """
 
-    def __init__(self):
+    def __init__(self, db=None, consumption=None, metrics=None, admission=None, job_index=None,
+            registry=None):
+        """
+        Parameters:
+            db: AsyncDatabase [default=None]
+                the asynchronous database access layer, wraps db_helper with
+                the default concurrency limit if None
+            consumption: ConsumptionBuffer [default=None]
+                buffers the food eaten and writes it in batches, the food eaten
+                is written on every request if None
+            metrics: Metrics [default=None]
+                the server metrics to record the stage latencies and counters
+                in, metrics of its own if None
+            admission: AdmissionControl [default=None]
+                the per product key rate limit and in flight cap, every
+                request is admitted if None
+            job_index: JobIndex [default=None]
+                the in memory index of the pending jobs, the job queue is
+                queried on every poll if None
+            registry: DeviceRegistry [default=None]
+                the in memory registry of the pet feeders, the feeders
+                collection is queried on every poll if None
+        """
         super().__init__()
         self.handle = None
+        self.db = db if db is not None else async_db.AsyncDatabase(db_helper)
+        self.consumption = consumption
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.admission = admission
+        self.job_index = job_index
+        self.registry = registry
         self.logger = logging.getLogger(__name__)
 
     async def render_post(self, request):
@@ -43,12 +98,35 @@ class FeederUpdateResource(resource.Resource):
             request:
                 the data from the POST request that the client sends
         """
+        self.metrics.inc("get_updates.requests")
+        admission = self.admission
+        if admission is None:
+            with self.metrics.timer("get_updates.total"):
+                return await self._process_update(request)
+
+        # Sheds the request before parsing it if too many are in flight
+        max_age = admission.enter()
+        if max_age is not None:
+            self.metrics.inc("get_updates.overloaded")
+            return admission_control.service_unavailable(max_age)
+        try:
+            with self.metrics.timer("get_updates.total"):
+                return await self._process_update(request)
+        finally:
+            admission.leave()
+
+    async def _process_update(self, request):
+        metrics = self.metrics
 
-        # Parses the POSTed data into a dictionary sends an empty payload if failed.
+        # Parses the POSTed data into a dictionary sends an empty payload if
+        # failed. The format of the payload is given by its Content-Format.
+        content_format = request.opt.content_format
         try:
-            data = parse_util.parse_post_data(request.payload)
+            with metrics.timer("get_updates.parse"):
+                data = parse_util.parse_payload(request.payload, content_format)
         except Exception as e:
-            return aiocoap.Message(payload = ''.encode('ascii'))
+            metrics.inc("get_updates.bad_payloads")
+            return self._response('', content_format)
 
         # Gets the values from the POST request
         device_key = data.get('u', None)
@@ -56,46 +134,102 @@ class FeederUpdateResource(resource.Resource):
         device_food_eaten = data.get('f', None)
         device_drop_success = data.get('d', None)
 
-        # Pet feeders need to send their product and authentication keys.
+        # Pet feeders need to send their product and authentication keys, as
+        # strings (CBOR payloads can hold any type).
         if not device_key or not device_auth:
-            return aiocoap.Message(payload = ''.encode('ascii'))
-
-        # Grabs the information about the feeder from the database
-        feeder_info= db.getFeederByProductKey(device_key)
-
-        feeder_id = feeder_info["_id"]
-        if not feeder_info:
-            return aiocoap.Message(payload = ''.encode('ascii'))
+            return self._response('', content_format)
+        if not isinstance(device_key, str) or not isinstance(device_auth, str):
+            return self._response('', content_format)
+
+        # Pet feeders sending more often than allowed are told to back off
+        # before their authentication key is checked.
+        if self.admission is not None:
+            max_age = self.admission.check_rate(device_key)
+            if max_age is not None:
+                metrics.inc("get_updates.rate_limited")
+                return admission_control.service_unavailable(max_age)
+
+        # Looks up the feeder by its product key, in the registry or with one
+        # database query, and verifies the pet feeder client sent the correct
+        # authentication key. The auth stage also includes waiting for a free
+        # database thread.
+        db = self.db
+        timings = {}
+        with metrics.timer("get_updates.auth"):
+            if self.registry is not None:
+                feeder_auth = await self.registry.authenticate(device_key, device_auth, timings=timings)
+            else:
+                feeder_auth = await db.authenticateFeeder(device_key, device_auth, timings=timings)
+        for stage, seconds in timings.items():
+            metrics.observe("get_updates.auth." + stage, seconds)
+        if not feeder_auth:
+            metrics.inc("get_updates.auth_failures")
+            return self._response('', content_format)
 
-        # Verifies if the pet feeder client sent the correct authentication key
-        if not db.verifyFeeder(feeder_id, device_auth):
-            return aiocoap.Message(payload = ''.encode('ascii'))
+        feeder_id = feeder_auth.id
 
         # If the POST parameter "d" is present then it will update the status
         # of the pet feeder.
         # Otherwise it will log the amount of food consumed
-        if device_drop_success:
-            if device_drop_success == '1':
-                db.updateFeeder(feeder_info["_id"], status="FAIL")
-            else:
-                db.updateFeeder(feeder_info["_id"], status="OK")
-            return aiocoap.Message(payload = 'status updated'.encode('ascii'))
-        elif device_food_eaten:
+        if device_drop_success not in (None, ''):
+            with metrics.timer("get_updates.status_update"):
+                if str(device_drop_success) == '1':
+                    await db.updateFeeder(feeder_id, status="FAIL")
+                else:
+                    await db.updateFeeder(feeder_id, status="OK")
+            metrics.inc("get_updates.status_updates")
+            return self._response('status updated', content_format)
+        elif device_food_eaten not in (None, ''):
             try:
                 food_eaten = int(device_food_eaten)
             except:
-                return aiocoap.Message(payload = ''.encode('ascii'))
-
-            db.logOngoingConsumption(feeder_id, food_eaten)
-
-        # Checks with the database if the pet feeder has any drop food events it
-        # needs to execute.
-        jobs = db.getReadyEventsForFeeder(feeder_id)
+                return self._response('', content_format)
+
+            with metrics.timer("get_updates.consumption"):
+                if self.consumption is not None:
+                    self.consumption.add(feeder_id, food_eaten)
+                else:
+                    await db.logOngoingConsumption(feeder_id, food_eaten)
+
+        # Checks if the pet feeder has any drop food events it needs to
+        # execute, most polls have nothing due so only check first. The in
+        # memory index answers for the job queue while it is up to date.
+        job_index = self.job_index
+        with metrics.timer("get_updates.job_lookup"):
+            if job_index is not None and job_index.authoritative:
+                has_events = job_index.has_due(feeder_id)
+                metrics.inc("get_updates.job_index_answers")
+            else:
+                has_events = await db.hasReadyEventsForFeeder(feeder_id)
+        if not has_events:
+            return self._response('n', content_format)
+
+        # Claims, logs and clears all of the pending events in one batch. Only
+        # the jobs due before the dispatch started are cleared from the index.
+        dispatch_started = clock.now().timestamp()
+        with metrics.timer("get_updates.dispatch"):
+            jobs = await db.dispatchReadyEventsForFeeder(feeder_id)
+        if job_index is not None:
+            job_index.clear_due(feeder_id, dispatch_started)
         payload = 'd' if len(jobs) > 0 else 'n'
         if payload == 'd':
-            # Clears the pending events from the database.
-            for job in jobs:
-                db.logFeedingResult(feeder_id, job["type"], dt.datetime.now(), job["count"], "OK")
-                db.deleteScheduledEventById(job["_id"])
+            metrics.inc("get_updates.drops_issued")
+
+        return self._response(payload, content_format)
+
+    def _response(self, payload, content_format):
+        """
+        Creates the response message in the same format as the request.
 
-        return aiocoap.Message(payload = payload.encode('ascii'))
+        Parameters:
+            payload: str
+                the response to send to the pet feeder
+            content_format: int
+                the Content-Format of the request
+        """
+        if not payload:
+            self.metrics.inc("get_updates.empty_responses")
+        response = aiocoap.Message(payload = parse_util.encode_payload(payload, content_format))
+        if content_format == parse_util.CBOR_CONTENT_FORMAT:
+            response.opt.content_format = content_format
+        return response
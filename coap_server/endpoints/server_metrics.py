@@ -0,0 +1,49 @@
+import json, aiocoap
+import aiocoap.resource as resource
+from .utils import parse_util
+
+# CoAP Content-Format of application/json
+JSON_CONTENT_FORMAT = 50
+
+class MetricsResource(resource.Resource):
+    """
+    The endpoint resource exposing the request counters and stage latencies of
+    the CoAP server.
+
+    A GET request returns the metrics as JSON, or in the Prometheus text format
+    with the query "format=prometheus".
+
+    Example
+        GET coap://<server address>/metrics?format=prometheus
+
+    When the server runs several workers, the metrics are the ones of the
+    worker that received the request.
+    """
+
+    def __init__(self, metrics):
+        """
+        Parameters:
+            metrics: Metrics
+                the metrics of the server to expose
+        """
+        super().__init__()
+        self.metrics = metrics
+
+    async def render_get(self, request):
+        """
+        Responds with a snapshot of the metrics.
+
+        Parameters:
+            request:
+                the data from the GET request
+        """
+        if parse_util.get_query(request, 'format') == 'prometheus':
+            payload = self.metrics.prometheus()
+            response = aiocoap.Message(payload = payload.encode('utf-8'))
+            response.opt.content_format = parse_util.TEXT_CONTENT_FORMAT
+            return response
+
+        payload = json.dumps(self.metrics.snapshot())
+        response = aiocoap.Message(payload = payload.encode('utf-8'))
+        response.opt.content_format = JSON_CONTENT_FORMAT
+        return response
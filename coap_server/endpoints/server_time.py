@@ -1,4 +1,4 @@
-import datetime, asyncio, aiocoap
+import datetime, asyncio, aiocoap, logging
 import aiocoap.resource as resource
 
 class TimeResource(resource.ObservableResource):
@@ -14,6 +14,7 @@ class TimeResource(resource.ObservableResource):
         super().__init__()
 
         self.handle = None
+        self.logger = logging.getLogger(__name__)
 
     def notify(self):
         self.updated_state()
@@ -24,10 +25,10 @@ class TimeResource(resource.ObservableResource):
 
     def update_observation_count(self, count):
         if count and self.handle is None:
-            print("Starting the clock")
+            self.logger.debug("Starting the clock")
             self.reschedule()
         if count == 0 and self.handle:
-            print("Stopping the clock")
+            self.logger.debug("Stopping the clock")
             self.handle.cancel()
             self.handle = None
 
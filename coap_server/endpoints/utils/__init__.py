@@ -1,3 +1,10 @@
 __all__ = [
-    'parse_util'
+    'parse_util',
+    'async_db',
+    'consumption_buffer',
+    'job_watcher',
+    'metrics',
+    'admission',
+    'job_index',
+    'device_registry'
 ]
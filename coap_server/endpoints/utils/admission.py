@@ -0,0 +1,158 @@
+import math, random, time, aiocoap
+from aiocoap.numbers import OptionNumber
+from aiocoap.optiontypes import UintOption
+from collections import OrderedDict
+
+class AdmissionControl:
+    """
+    Decides whether a request is served before any database or bcrypt work is
+    done, so that a misbehaving pet feeder or a reboot storm cannot degrade
+    the rest of the fleet.
+
+    Two limits are applied:
+        - a token bucket per product key, refilled at rate requests per second
+          up to burst requests. The buckets of the least recently seen product
+          keys are dropped once max_keys are tracked.
+        - a cap of max_in_flight requests being processed at once by this
+          process.
+
+    Rejected requests get a CoAP 5.03 Service Unavailable response with a
+    Max-Age option telling the pet feeder how many seconds to wait.
+
+    Example
+        control = AdmissionControl(rate=0.5, burst=5)
+        max_age = control.enter()
+        if max_age is not None:
+            return admission.service_unavailable(max_age)
+        try:
+            max_age = control.check_rate(product_key)
+            ...
+        finally:
+            control.leave()
+
+    Instance Variables:
+        rate:
+            the requests per second allowed per product key, 0 for no limit
+        burst:
+            the number of requests a product key can send at once
+        max_keys:
+            the number of product keys with a tracked bucket
+        max_in_flight:
+            the number of requests processed at once, 0 for no limit
+        overload_max_age:
+            the base Max-Age in seconds sent when the server is overloaded
+        in_flight:
+            the number of requests being processed
+        rate_limited:
+            the number of requests rejected by the per product key limit
+        overloaded:
+            the number of requests rejected by the in flight cap
+    """
+
+    def __init__(self, rate=0.5, burst=5, max_keys=100000, max_in_flight=512,
+            overload_max_age=5, clock=time.monotonic):
+        """
+        Parameters:
+            rate: float [default=0.5]
+                the requests per second allowed per product key, 0 disables
+                the per product key limit
+            burst: int [default=5]
+                the number of requests a product key can send at once
+            max_keys: int [default=100000]
+                the number of product keys with a tracked bucket
+            max_in_flight: int [default=512]
+                the number of requests processed at once, 0 disables the cap
+            overload_max_age: int [default=5]
+                the base Max-Age in seconds sent when the server is overloaded,
+                a random extra of up to the same amount spreads the retries
+            clock: function [default=time.monotonic]
+                returns the current time in seconds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.max_in_flight = max_in_flight
+        self.overload_max_age = overload_max_age
+        self.in_flight = 0
+        self.rate_limited = 0
+        self.overloaded = 0
+
+        self._clock = clock
+        self._buckets = OrderedDict()
+
+    def enter(self):
+        """
+        Admits a request under the in flight cap. Admitted requests have to
+        call leave when they are done.
+
+        Returns:
+            None if the request is admitted, otherwise the Max-Age in seconds
+            to send with the 5.03 response
+        """
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            self.overloaded += 1
+            return self.overload_max_age + random.randint(0, self.overload_max_age)
+        self.in_flight += 1
+        return None
+
+    def leave(self):
+        """
+        Marks an admitted request as done.
+        """
+        self.in_flight -= 1
+
+    def check_rate(self, product_key):
+        """
+        Takes a token from the bucket of a product key.
+
+        Parameters:
+            product_key: str
+                the product key the request was sent with
+
+        Returns:
+            None if the product key is within its rate, otherwise the Max-Age
+            in seconds until it has a token again
+        """
+        if not self.rate:
+            return None
+
+        now = self._clock()
+        bucket = self._buckets.get(product_key)
+        if bucket is None:
+            bucket = self._buckets[product_key] = [float(self.burst), now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(product_key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            self.rate_limited += 1
+            return max(1, math.ceil((1 - bucket[0]) / self.rate))
+        bucket[0] -= 1
+        return None
+
+    def stats(self):
+        """
+        Returns the state of the admission control as a dictionary.
+        """
+        return {
+            "in_flight": self.in_flight,
+            "tracked_keys": len(self._buckets),
+            "rate_limited": self.rate_limited,
+            "overloaded": self.overloaded,
+        }
+
+def service_unavailable(max_age):
+    """
+    Creates the 5.03 Service Unavailable response for a rejected request.
+
+    Parameters:
+        max_age: int
+            the number of seconds the pet feeder should wait before retrying
+    """
+    response = aiocoap.Message(code = aiocoap.SERVICE_UNAVAILABLE)
+    # aiocoap has no accessor for the Max-Age option
+    response.opt.add_option(UintOption(OptionNumber.MAX_AGE, max_age))
+    return response
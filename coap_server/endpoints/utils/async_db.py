@@ -0,0 +1,129 @@
+import asyncio, functools
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncDatabase:
+    """
+    Offloads the blocking calls of a synchronous database module (such as
+    feeder_api.db_helper) onto a bounded pool of worker threads so that a slow
+    MongoDB round trip does not stall the event loop of the CoAP server.
+
+    Any function of the wrapped module can be called as a coroutine through
+    this class, for example
+
+        db = AsyncDatabase(db_helper, max_concurrency=128)
+        feeder = await db.getFeederByProductKey("testingkey1234")
+
+    At most max_concurrency calls are run at the same time, requests over the
+    limit wait for a free slot without blocking the event loop.
+
+    Instance Variables:
+        module:
+            the synchronous database module that is wrapped
+        max_concurrency:
+            the maximum number of database calls that can be in flight at once
+        in_flight:
+            the number of database calls currently being executed
+        waiting:
+            the number of database calls waiting for a free slot
+    """
+
+    def __init__(self, module, max_concurrency=128, loop=None):
+        """
+        Creates the executor and the concurrency limit for the database calls.
+
+        Parameters:
+            module:
+                the synchronous database module to wrap
+            max_concurrency: int [default=128]
+                the maximum number of database calls that can run at once
+            loop: [default=None]
+                the event loop to run on, the current event loop if None
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+
+        self.module = module
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.waiting = 0
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._wrappers = {}
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Runs a blocking function in the worker threads and waits for its result.
+
+        Parameters:
+            func:
+                the blocking function to run
+            *args, **kwargs:
+                the arguments to call the function with
+
+        Returns:
+            the value returned by the function
+        """
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            return await self._loop.run_in_executor(
+                self._executor,
+                functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    async def map(self, func, items):
+        """
+        Runs a blocking function on every item in the worker threads, under the
+        same concurrency limit as the other database calls, e.g. to hash many
+        passwords without starving the requests of database threads.
+
+        Parameters:
+            func:
+                the blocking function to run
+            items:
+                the arguments to call the function with, one per call
+
+        Returns:
+            the list of values returned by the function, in the order of items
+        """
+        return list(await asyncio.gather(*(self.call(func, item) for item in items)))
+
+    def __getattr__(self, name):
+        """
+        Exposes the functions of the wrapped module as coroutine functions.
+        """
+        wrappers = self.__dict__.get("_wrappers")
+        if wrappers is None:
+            raise AttributeError(name)
+
+        if name not in wrappers:
+            func = getattr(self.module, name)
+            if not callable(func):
+                return func
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await self.call(func, *args, **kwargs)
+
+            wrappers[name] = wrapper
+        return wrappers[name]
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads once the pending database calls are finished.
+
+        Parameters:
+            wait: bool [default=True]
+                should it block until the pending calls are done?
+        """
+        self._executor.shutdown(wait=wait)
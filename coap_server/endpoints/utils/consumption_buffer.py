@@ -0,0 +1,173 @@
+import asyncio, logging, time
+import feeder_api.clock as clock
+import feeder_api.db_helper as db_helper
+
+class ConsumptionBuffer:
+    """
+    Aggregates the food consumption that pet feeders report in memory and
+    writes it to the database in batches.
+
+    Increments are summed per (feeder id, hour) and flushed as one bulk write
+    every flush_interval seconds, or as soon as max_keys different
+    (feeder id, hour) pairs are buffered. A failed flush puts the increments
+    that were not written back into the buffer so no consumption is lost, and
+    the ones that were written are not written again.
+
+    Instance Variables:
+        flush_interval:
+            the number of seconds between periodic flushes
+        max_keys:
+            the number of buffered (feeder id, hour) pairs that triggers a flush
+        flushes:
+            the number of successful flushes
+        failed_flushes:
+            the number of flushes that raised an error
+        flushed_keys:
+            the total number of (feeder id, hour) pairs written
+        last_flush_latency:
+            the duration in seconds of the last flush
+        max_flush_latency:
+            the longest flush duration in seconds
+    """
+
+    def __init__(self, db, flush_interval=10.0, max_keys=5000, loop=None, metrics=None):
+        """
+        Parameters:
+            db: AsyncDatabase
+                the asynchronous database access layer to flush through
+            flush_interval: float [default=10.0]
+                the number of seconds between periodic flushes
+            max_keys: int [default=5000]
+                the number of buffered (feeder id, hour) pairs that triggers a flush
+            loop: [default=None]
+                the event loop to run on, the current event loop if None
+            metrics: Metrics [default=None]
+                the server metrics to record the flush latencies in
+        """
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flushed_keys = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.metrics = metrics
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._pending = {}
+        self._flushing = None
+        self._handle = None
+        self.logger = logging.getLogger(__name__)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, feeder_id, amount, hour=None):
+        """
+        Buffers food eaten by a pet feeder.
+
+        Parameters:
+            feeder_id: str
+                the id of the pet feeder
+            amount: int
+                the amount of food eaten since the last update
+            hour: datetime [default=None]
+                the hour to log the food against, the current hour if None
+        """
+        if hour is None:
+            hour = clock.now().replace(minute=0, second=0, microsecond=0)
+        key = (feeder_id, hour)
+        self._pending[key] = self._pending.get(key, 0) + amount
+
+        if len(self._pending) >= self.max_keys and self._flushing is None:
+            asyncio.ensure_future(self.flush(), loop=self._loop)
+
+    async def flush(self):
+        """
+        Writes all of the buffered increments to the database in one bulk write.
+        Waits for a flush that is already running instead of starting another.
+        """
+        if self._flushing is not None:
+            await self._flushing
+            return
+        if not self._pending:
+            return
+
+        self._flushing = self._loop.create_future()
+        increments, self._pending = self._pending, {}
+        start = time.perf_counter()
+        try:
+            await self.db.logOngoingConsumptionBatch(increments)
+        except db_helper.PartialWriteError as e:
+            self.failed_flushes += 1
+            self.flushed_keys += len(increments) - len(e.failed)
+            self.logger.error("Failed to flush %d of %d consumption increments (%s)",
+                len(e.failed), len(increments), e.__cause__)
+            self._requeue(e.failed)
+        except Exception:
+            self.failed_flushes += 1
+            self.logger.exception("Failed to flush %d consumption increments", len(increments))
+            self._requeue(increments)
+        else:
+            self.flushes += 1
+            self.flushed_keys += len(increments)
+            self.last_flush_latency = time.perf_counter() - start
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+            if self.metrics is not None:
+                self.metrics.observe("consumption.flush", self.last_flush_latency)
+            self.logger.debug("Flushed %d consumption increments in %.3fs",
+                len(increments), self.last_flush_latency)
+        finally:
+            self._flushing.set_result(None)
+            self._flushing = None
+
+    def _requeue(self, increments):
+        for key, amount in increments.items():
+            self._pending[key] = self._pending.get(key, 0) + amount
+
+    def start(self):
+        """
+        Starts flushing the buffer every flush_interval seconds.
+        """
+        if self._handle is None:
+            self._reschedule()
+
+    async def stop(self):
+        """
+        Stops the periodic flushes and writes whatever is left in the buffer,
+        including the increments added while a flush was running. Gives up
+        once a flush fails, leaving the increments it could not write.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        while self._pending or self._flushing is not None:
+            failed_flushes = self.failed_flushes
+            await self.flush()
+            if self.failed_flushes != failed_flushes:
+                self.logger.error("Stopped with %d consumption increments not written", len(self._pending))
+                return
+
+    def stats(self):
+        """
+        Returns the state of the buffer as a dictionary.
+        """
+        return {
+            "buffered_keys": len(self._pending),
+            "flush_interval": self.flush_interval,
+            "max_keys": self.max_keys,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "flushed_keys": self.flushed_keys,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+    def _reschedule(self):
+        self._handle = self._loop.call_later(self.flush_interval, self._periodic_flush)
+
+    def _periodic_flush(self):
+        asyncio.ensure_future(self.flush(), loop=self._loop)
+        self._reschedule()
@@ -0,0 +1,513 @@
+import asyncio, hashlib, logging, math, time
+import feeder_api.db_helper as db_helper
+
+# Length of a bcrypt hash ("$2b$12$" and 53 characters of salt and digest)
+HASH_SIZE = 60
+# Length of a MongoDB ObjectId in bytes
+ID_SIZE = 12
+
+class BloomFilter:
+    """
+    Probabilistic set of strings. contains never misses an added string and
+    wrongly reports a string that was not added with a probability of about
+    error_rate while at most capacity strings are added.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Parameters:
+            capacity: int
+                the number of strings the filter is sized for
+            error_rate: float [default=0.001]
+                the false positive rate at capacity
+        """
+        self.capacity = capacity
+        self.count = 0
+        bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._bits = bytearray((bits + 7) // 8)
+        self._size = len(self._bits) * 8
+        self._hashes = max(1, round(bits / capacity * math.log(2)))
+
+    def _positions(self, value):
+        # Double hashing of one 128 bit digest gives all of the positions
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        size = self._size
+        return [(first + i * second) % size for i in range(self._hashes)]
+
+    def add(self, value):
+        bits = self._bits
+        for position in self._positions(value):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        bits = self._bits
+        for position in self._positions(value):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def memory(self):
+        return len(self._bits)
+
+class DeviceRegistry:
+    """
+    Compact in memory registry of every pet feeder, so that authenticating a
+    poll does not query the feeders collection and unknown product keys are
+    rejected without any database call.
+
+    The registry is slot based: a dictionary maps each product key to a slot
+    number, and the id, bcrypt hash and status of the feeder are kept at that
+    slot in flat bytearrays (12, 60 and 1 bytes per feeder). A second
+    dictionary maps the 12 byte id to the slot, for changes and deletions that
+    only name the feeder id. Slots of deleted feeders are reused.
+
+    It is loaded page by page at start up and every full_refresh_interval
+    seconds all of the feeders are reloaded in place, picking up status
+    changes, and the feeders that were not seen (deleted) are swept out
+    afterwards.
+
+    Added and deleted feeders and changes of product key, authentication key
+    or status are applied as they happen when the registry is given them by a
+    FeederWatcher (see feeder_changed), and every time its change stream opens
+    the registry is reloaded in full, as changes made while it was closed
+    were missed. While there is no change stream, the registry is refreshed
+    incrementally every refresh_interval seconds by walking the ids of every
+    feeder (from the _id index only): the feeders it is missing are loaded,
+    wherever their id sorts, and the ones no longer in the database are swept
+    out. Changes of the other fields wait for the next full reload.
+
+    Product keys that are neither in the registry nor in the database are
+    remembered in a Bloom filter (two generations of negative_capacity keys
+    each, rotated when the newest is full), so a device polling with an
+    unprovisioned key costs one database query and then none. As the
+    registry is looked up first, a feeder added to the registry (by the
+    change stream or a refresh) is accepted even if its key was remembered.
+    Up to negative_recheck_rate keys per second rejected by the Bloom filter
+    are still looked up in the database, so a false positive or a feeder
+    provisioned since its key was remembered is not locked out until then.
+
+    Instance Variables:
+        refresh_interval:
+            the number of seconds between incremental refreshes
+        full_refresh_interval:
+            the number of seconds between full reloads
+        loaded:
+            has the registry been loaded completely at least once?
+        hits:
+            the number of product keys found in the registry
+        misses:
+            the number of product keys looked up in the database
+        negative_hits:
+            the number of product keys rejected by the Bloom filter
+        negative_rechecks:
+            the number of product keys in the Bloom filter that were looked up
+            in the database anyway
+        last_load_latency:
+            the duration in seconds of the last full load
+    """
+
+    def __init__(self, db, refresh_interval=30.0, full_refresh_interval=900.0,
+            negative_capacity=100000, negative_error_rate=0.001, negative_recheck_rate=1.0,
+            page_size=10000, loop=None):
+        """
+        Parameters:
+            db: AsyncDatabase
+                the asynchronous database access layer wrapping db_helper
+            refresh_interval: float [default=30.0]
+                the number of seconds between incremental refreshes
+            full_refresh_interval: float [default=900.0]
+                the number of seconds between full reloads
+            negative_capacity: int [default=100000]
+                the number of unknown product keys per Bloom filter generation
+            negative_error_rate: float [default=0.001]
+                the false positive rate of each Bloom filter generation
+            negative_recheck_rate: float [default=1.0]
+                the number of product keys per second rejected by the Bloom
+                filter that are looked up in the database anyway, 0 for none
+            page_size: int [default=10000]
+                the number of feeders loaded per database query, ten times as
+                many ids are read per query of the incremental refresh
+            loop: [default=None]
+                the event loop to run on, the current event loop if None
+        """
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.negative_capacity = negative_capacity
+        self.negative_error_rate = negative_error_rate
+        self.negative_recheck_rate = negative_recheck_rate
+        self.page_size = page_size
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.negative_rechecks = 0
+        self.last_load_latency = 0.0
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._clear()
+        self._negative = [self._new_filter(), self._new_filter()]
+        # Token bucket of the database lookups of Bloom filter hits
+        self._recheck_tokens = max(1.0, negative_recheck_rate)
+        self._recheck_time = time.monotonic()
+        self._stream_open = False
+        self._refreshing = None
+        self._changed_while_loading = None
+        self._handles = []
+        self.logger = logging.getLogger(__name__)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _clear(self):
+        self._slots = {}
+        # The slot of each feeder id, as its 12 bytes
+        self._id_slots = {}
+        # The product key of each slot, None for free slots
+        self._keys = []
+        self._ids = bytearray()
+        self._hashes = bytearray()
+        self._statuses = bytearray()
+        self._status_names = [None]
+        self._status_codes = {None: 0}
+        # The mark of each slot flips on every full reload, slots that still
+        # have the old mark afterwards belong to deleted feeders.
+        self._marks = bytearray()
+        self._mark = 0
+        self._free = []
+
+    def _new_filter(self):
+        return BloomFilter(self.negative_capacity, self.negative_error_rate)
+
+    def put(self, feeder_id, product_key, password_hash, status):
+        """
+        Adds or updates a feeder in the registry.
+
+        Parameters:
+            feeder_id: str
+                the id of the feeder as a hex string
+            product_key: str
+                the product key of the feeder
+            password_hash: str
+                the bcrypt hash of the authentication key
+            status: str
+                the status of the feeder
+        """
+        hash_bytes = password_hash.encode('ascii')
+        if len(hash_bytes) != HASH_SIZE:
+            # Not a bcrypt hash, left to the database path
+            self.remove(product_key)
+            return
+        code = self._status_codes.get(status)
+        if code is None:
+            if len(self._status_names) == 256:
+                self.remove(product_key)
+                return
+            code = self._status_codes[status] = len(self._status_names)
+            self._status_names.append(status)
+
+        slot = self._slots.get(product_key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self._keys[slot] = product_key
+            else:
+                slot = len(self._statuses)
+                self._keys.append(product_key)
+                self._ids.extend(bytes(ID_SIZE))
+                self._hashes.extend(bytes(HASH_SIZE))
+                self._statuses.append(0)
+                self._marks.append(0)
+            self._slots[product_key] = slot
+        id_bytes = bytes.fromhex(feeder_id)
+        old_id = bytes(self._ids[slot * ID_SIZE:(slot + 1) * ID_SIZE])
+        if old_id != id_bytes and self._id_slots.get(old_id) == slot:
+            del self._id_slots[old_id]
+        self._id_slots[id_bytes] = slot
+        self._ids[slot * ID_SIZE:(slot + 1) * ID_SIZE] = id_bytes
+        self._hashes[slot * HASH_SIZE:(slot + 1) * HASH_SIZE] = hash_bytes
+        self._statuses[slot] = code
+        self._marks[slot] = self._mark
+
+    def remove(self, product_key):
+        """
+        Removes a feeder from the registry.
+        """
+        slot = self._slots.pop(product_key, None)
+        if slot is not None:
+            self._keys[slot] = None
+            self._free.append(slot)
+            # Free slots keep the id of their last feeder, which may have moved
+            # to another slot since (e.g. a new product key)
+            id_bytes = bytes(self._ids[slot * ID_SIZE:(slot + 1) * ID_SIZE])
+            if self._id_slots.get(id_bytes) == slot:
+                del self._id_slots[id_bytes]
+
+    def remove_id(self, feeder_id):
+        """
+        Removes a feeder from the registry by its id, e.g. once it was deleted.
+        """
+        slot = self._id_slots.get(bytes.fromhex(feeder_id))
+        if slot is not None:
+            self.remove(self._keys[slot])
+
+    def feeder_changed(self, feeder_id, record):
+        """
+        Applies a change of a feeder. Used as the FeederWatcher callback.
+
+        Parameters:
+            feeder_id: str
+                the id of the feeder
+            record: tuple
+                (id, product key, password hash, status) of the feeder, or
+                None if it was deleted
+        """
+        # A load that read the feeder before the change must not undo it
+        if self._changed_while_loading is not None:
+            self._changed_while_loading[feeder_id] = record
+        self.remove_id(feeder_id)
+        if record is not None:
+            self.put(*record)
+
+    def stream_state(self, running):
+        """
+        Follows the state of the FeederWatcher change stream, reloading the
+        registry in full whenever it opens. The incremental refreshes are
+        skipped while it is open.
+
+        Parameters:
+            running: bool
+                is the change stream open?
+        """
+        self._stream_open = running
+        if running:
+            asyncio.ensure_future(self.refresh(full=True), loop=self._loop)
+
+    def get(self, product_key):
+        """
+        Gets (id, password hash, status) of a feeder, or None if the product
+        key is not in the registry.
+        """
+        slot = self._slots.get(product_key)
+        if slot is None:
+            return None
+        return (self._ids[slot * ID_SIZE:(slot + 1) * ID_SIZE].hex(),
+                self._hashes[slot * HASH_SIZE:(slot + 1) * HASH_SIZE].decode('ascii'),
+                self._status_names[self._statuses[slot]])
+
+    def is_known_unknown(self, product_key):
+        """
+        Checks if a product key was recently found to not exist.
+        """
+        return product_key in self._negative[0] or product_key in self._negative[1]
+
+    def remember_unknown(self, product_key):
+        """
+        Remembers a product key that does not exist in the database.
+        """
+        current = self._negative[0]
+        if current.count >= current.capacity:
+            current = self._new_filter()
+            self._negative = [current, self._negative[0]]
+        current.add(product_key)
+
+    def _take_recheck(self):
+        # Refills the bucket at negative_recheck_rate tokens per second
+        rate = self.negative_recheck_rate
+        if not rate:
+            return False
+        now = time.monotonic()
+        self._recheck_tokens = min(max(1.0, rate), self._recheck_tokens + (now - self._recheck_time) * rate)
+        self._recheck_time = now
+        if self._recheck_tokens < 1:
+            return False
+        self._recheck_tokens -= 1
+        return True
+
+    async def lookup(self, product_key):
+        """
+        Finds a feeder by its product key, from the registry if possible.
+
+        Returns:
+            (id, password hash, status) of the feeder, or None if the product
+            key does not exist
+        """
+        record = self.get(product_key)
+        if record is not None:
+            self.hits += 1
+            return record
+        known_unknown = self.is_known_unknown(product_key)
+        if known_unknown:
+            if not self._take_recheck():
+                self.negative_hits += 1
+                return None
+            self.negative_rechecks += 1
+
+        self.misses += 1
+        record = await self.db.getFeederAuthRecord(product_key)
+        if record is None:
+            if not known_unknown:
+                self.remember_unknown(product_key)
+            return None
+        self.put(*record)
+        return record[0], record[2], record[3]
+
+    async def authenticate(self, product_key, password, timings=None):
+        """
+        Authenticates a pet feeder like db_helper.authenticateFeeder, looking
+        the product key up in the registry instead of the database. The bcrypt
+        check (or credential cache hit) runs in the database threads.
+
+        Parameters:
+            product_key: str
+                the product key the pet feeder sent
+            password: str
+                the authentication key the pet feeder sent
+            timings: dict [default=None]
+                stores the seconds spent on the "lookup" and "verify" if given
+
+        Returns:
+            a db_helper.FeederAuth(id, status), or None if the product key is
+            unknown or the authentication key is wrong
+        """
+        start = time.perf_counter()
+        record = await self.lookup(product_key)
+        if timings is not None:
+            found = time.perf_counter()
+            timings["lookup"] = found - start
+        if record is None:
+            return None
+        feeder_id, password_hash, status = record
+        valid = await self.db.checkFeederPassword(product_key, password, password_hash)
+        if timings is not None:
+            timings["verify"] = time.perf_counter() - found
+        if not valid:
+            return None
+        return db_helper.FeederAuth(feeder_id, status)
+
+    async def refresh(self, full=False):
+        """
+        Loads the feeders the registry is missing and drops the deleted ones,
+        or reloads every feeder if full. Waits for a refresh that is already
+        running instead of starting another. The incremental refresh does
+        nothing while the change stream is open.
+        """
+        if self._refreshing is not None:
+            await self._refreshing
+            if not full:
+                return
+        if not full and self.loaded and self._stream_open:
+            return
+
+        self._refreshing = self._loop.create_future()
+        self._changed_while_loading = {}
+        start = time.perf_counter()
+        try:
+            if full or not self.loaded:
+                await self._load_all()
+                self.last_load_latency = time.perf_counter() - start
+                self.logger.info("Loaded %d feeders in %.3fs", len(self._slots), self.last_load_latency)
+            else:
+                await self._load_missing()
+        except Exception:
+            self.logger.exception("Failed to refresh the device registry")
+        finally:
+            self._changed_while_loading = None
+            self._refreshing.set_result(None)
+            self._refreshing = None
+
+    async def _load_all(self):
+        # Lookups keep being served while the feeders are reloaded in place,
+        # a failed reload leaves the feeders that were not reloaded yet.
+        self._mark ^= 1
+        await self._load_after(None)
+        self._sweep()
+        self._negative = [self._new_filter(), self._new_filter()]
+        self.loaded = True
+
+    async def _load_missing(self):
+        # Marks the slots of the ids that are still in the database and loads
+        # the feeders without a slot. Feeders put while the ids are walked are
+        # marked by put and are not swept.
+        self._mark ^= 1
+        marks, mark, id_slots = self._marks, self._mark, self._id_slots
+        changed = self._changed_while_loading
+        limit = self.page_size * 10
+        after_id = None
+        while True:
+            page = await self.db.getFeederIds(afterId=after_id, limit=limit)
+            missing = []
+            for feeder_id in page:
+                slot = id_slots.get(bytes.fromhex(feeder_id))
+                if slot is not None:
+                    marks[slot] = mark
+                elif feeder_id not in changed:
+                    missing.append(feeder_id)
+            for start in range(0, len(missing), self.page_size):
+                for record in await self.db.getFeederAuthRecordsByIds(missing[start:start + self.page_size]):
+                    if record[0] not in changed:
+                        self.put(*record)
+            if len(page) < limit:
+                break
+            after_id = page[-1]
+        self._sweep()
+
+    def _sweep(self):
+        # Removes the feeders whose slot was not marked by the last walk
+        marks, mark = self._marks, self._mark
+        for product_key, slot in list(self._slots.items()):
+            if marks[slot] != mark:
+                self.remove(product_key)
+
+    async def _load_after(self, after_id):
+        while True:
+            page = await self.db.getFeederAuthRecords(afterId=after_id, limit=self.page_size)
+            changed = self._changed_while_loading
+            for record in page:
+                if record[0] not in changed:
+                    self.put(*record)
+            if len(page) < self.page_size:
+                return
+            after_id = page[-1][0]
+
+    def start(self):
+        """
+        Loads the registry and starts refreshing it.
+        """
+        if not self._handles:
+            asyncio.ensure_future(self.refresh(full=True), loop=self._loop)
+            self._handles = [
+                self._loop.call_later(self.refresh_interval, self._periodic_refresh, False),
+                self._loop.call_later(self.full_refresh_interval, self._periodic_refresh, True),
+            ]
+
+    def stop(self):
+        """
+        Stops the periodic refreshes.
+        """
+        for handle in self._handles:
+            handle.cancel()
+        self._handles = []
+
+    def stats(self):
+        """
+        Returns the state of the registry as a dictionary.
+        """
+        return {
+            "feeders": len(self._slots),
+            "loaded": self.loaded,
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "negative_rechecks": self.negative_rechecks,
+            "negative_keys": self._negative[0].count + self._negative[1].count,
+            "last_load_latency": self.last_load_latency,
+        }
+
+    def _periodic_refresh(self, full):
+        asyncio.ensure_future(self.refresh(full=full), loop=self._loop)
+        interval = self.full_refresh_interval if full else self.refresh_interval
+        self._handles[1 if full else 0] = self._loop.call_later(interval, self._periodic_refresh, full)
@@ -0,0 +1,222 @@
+import asyncio, heapq, logging, time
+import feeder_api.clock as clock
+
+class JobIndex:
+    """
+    In memory index of the pending jobs of the job queue, so that a poll from
+    a pet feeder with nothing due is answered without querying the database.
+
+    The index maps each feeder id to a min-heap of the times of its pending
+    jobs, stored as POSIX timestamps. It is loaded from the database, kept
+    current with the jobs delivered by the JobWatcher and reloaded every
+    reconcile_interval seconds to drop jobs that were dispatched or deleted
+    elsewhere.
+
+    Jobs held by a consumer are indexed at the time their lease expires, both
+    when loading and when the JobWatcher (with leases) delivers a claim, so a
+    job whose consumer died before acknowledging it is due again in the index
+    as soon as it can be claimed, not from the next reload.
+
+    The index only answers for the database while it is authoritative: after
+    it was loaded with the change stream of the JobWatcher open. While the
+    change stream is down, jobs could be added without the index hearing of
+    them, so callers have to fall back to the database. A stale job in the
+    index only costs a database query that finds nothing, never a missed drop.
+
+    Instance Variables:
+        reconcile_interval:
+            the number of seconds between reloads from the database
+        authoritative:
+            can a poll be answered from the index alone?
+        reloads:
+            the number of completed loads from the database
+        last_reload_latency:
+            the duration in seconds of the last load
+    """
+
+    def __init__(self, db, reconcile_interval=300.0, loop=None):
+        """
+        Parameters:
+            db: AsyncDatabase
+                the asynchronous database access layer to load the jobs through
+            reconcile_interval: float [default=300.0]
+                the number of seconds between reloads from the database
+            loop: [default=None]
+                the event loop to run on, the current event loop if None
+        """
+        self.db = db
+        self.reconcile_interval = reconcile_interval
+        self.authoritative = False
+        self.reloads = 0
+        self.last_reload_latency = 0.0
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._heaps = {}
+        self._jobs = 0
+        self._stream_open = False
+        self._added_while_loading = None
+        self._reloading = None
+        self._handle = None
+        self.logger = logging.getLogger(__name__)
+
+    def __len__(self):
+        return self._jobs
+
+    @property
+    def feeders(self):
+        return len(self._heaps)
+
+    def add(self, feeder_id, job_time):
+        """
+        Adds a job to the index. Used as the JobWatcher callback.
+
+        Parameters:
+            feeder_id: str
+                the id of the pet feeder of the job
+            job_time: datetime
+                the time the job is due
+        """
+        timestamp = job_time.timestamp()
+        heap = self._heaps.get(feeder_id)
+        if heap is None:
+            self._heaps[feeder_id] = [timestamp]
+        else:
+            heapq.heappush(heap, timestamp)
+        self._jobs += 1
+        if self._added_while_loading is not None:
+            self._added_while_loading.append((feeder_id, timestamp))
+
+    def has_due(self, feeder_id, now=None):
+        """
+        Checks if a pet feeder has a job due, without touching the database.
+        Only meaningful while the index is authoritative.
+
+        Parameters:
+            feeder_id: str
+                the id of the pet feeder
+            now: float [default=None]
+                the current POSIX timestamp, the time of the feeder_api clock if None
+        """
+        heap = self._heaps.get(feeder_id)
+        if not heap:
+            return False
+        return heap[0] <= (clock.now().timestamp() if now is None else now)
+
+    def clear_due(self, feeder_id, now=None):
+        """
+        Removes the jobs of a pet feeder that are due, after they were
+        dispatched or found to be gone from the database.
+
+        Parameters:
+            feeder_id: str
+                the id of the pet feeder
+            now: float [default=None]
+                the current POSIX timestamp, the time of the feeder_api clock if None
+        """
+        heap = self._heaps.get(feeder_id)
+        if not heap:
+            return
+        now = clock.now().timestamp() if now is None else now
+        while heap and heap[0] <= now:
+            heapq.heappop(heap)
+            self._jobs -= 1
+        if not heap:
+            del self._heaps[feeder_id]
+
+    def stream_state(self, running):
+        """
+        Follows the state of the JobWatcher change stream. The index stops
+        being authoritative when the stream fails and is reloaded once it is
+        open again, so no job inserted in between is missed.
+
+        Parameters:
+            running: bool
+                is the change stream open?
+        """
+        self._stream_open = running
+        if not running:
+            self.authoritative = False
+        elif not self.authoritative:
+            asyncio.ensure_future(self.reload(), loop=self._loop)
+
+    async def reload(self):
+        """
+        Replaces the index with the pending jobs in the database. Jobs that
+        the JobWatcher delivers while the database is being read are kept.
+        Waits for a reload that is already running instead of starting another,
+        unless that reload started before the change stream opened (e.g. the
+        first load at start up), in which case it loads again right after it
+        so the index does not wait for the next periodic reload to become
+        authoritative.
+        """
+        while self._reloading is not None:
+            await self._reloading
+            if self.authoritative or not self._stream_open:
+                return
+
+        self._reloading = self._loop.create_future()
+        self._added_while_loading = []
+        stream_was_open = self._stream_open
+        start = time.perf_counter()
+        try:
+            pending = await self.db.getPendingEventTimes(leased=True)
+        except Exception:
+            self.logger.exception("Failed to load the pending jobs")
+            return
+        else:
+            heaps = {}
+            for feeder_id, job_time in pending:
+                heaps.setdefault(feeder_id, []).append(job_time.timestamp())
+            for feeder_id, timestamp in self._added_while_loading:
+                heaps.setdefault(feeder_id, []).append(timestamp)
+            for heap in heaps.values():
+                heapq.heapify(heap)
+
+            self._heaps = heaps
+            self._jobs = sum(len(heap) for heap in heaps.values())
+            # The load is only complete if the change stream was open for
+            # all of it.
+            self.authoritative = stream_was_open and self._stream_open
+            self.reloads += 1
+            self.last_reload_latency = time.perf_counter() - start
+            self.logger.info("Loaded %d pending jobs of %d feeders in %.3fs",
+                self._jobs, len(heaps), self.last_reload_latency)
+        finally:
+            self._added_while_loading = None
+            self._reloading.set_result(None)
+            self._reloading = None
+
+    def start(self):
+        """
+        Loads the index and starts reloading it every reconcile_interval seconds.
+        """
+        if self._handle is None:
+            asyncio.ensure_future(self.reload(), loop=self._loop)
+            self._reschedule()
+
+    def stop(self):
+        """
+        Stops the periodic reloads.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def stats(self):
+        """
+        Returns the state of the index as a dictionary.
+        """
+        return {
+            "jobs": self._jobs,
+            "feeders": len(self._heaps),
+            "authoritative": self.authoritative,
+            "reloads": self.reloads,
+            "last_reload_latency": self.last_reload_latency,
+        }
+
+    def _reschedule(self):
+        self._handle = self._loop.call_later(self.reconcile_interval, self._periodic_reload)
+
+    def _periodic_reload(self):
+        asyncio.ensure_future(self.reload(), loop=self._loop)
+        self._reschedule()
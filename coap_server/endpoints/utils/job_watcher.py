@@ -0,0 +1,117 @@
+import asyncio, logging, threading
+
+class JobWatcher:
+    """
+    Follows the jobs that are added to the job queue (by the scheduler or by a
+    user requesting an immediate drop on the website) in a background thread
+    and hands them to a callback on the event loop.
+
+    The jobs are read from db_helper.watchScheduledEvents, which needs MongoDB
+    change streams. If they are unavailable the watcher keeps retrying every
+    retry_interval seconds and the resources fall back to periodically
+    re-checking the database.
+
+    With leases, the callback is also called when a job is claimed, its lease
+    extended or it is given back, with the time it can be claimed again, so a
+    job whose consumer died is delivered again for the end of its lease.
+
+    Instance Variables:
+        callback:
+            called on the event loop as callback(feeder_id, time) for every new job
+        state_callback:
+            called on the event loop as state_callback(running) when the change
+            stream opens or fails
+        running:
+            is the change stream currently open?
+    """
+
+    def __init__(self, db_module, callback, retry_interval=30.0, loop=None, state_callback=None,
+            leases=False):
+        """
+        Parameters:
+            db_module:
+                the synchronous database module providing watchScheduledEvents
+            callback:
+                the function called on the event loop for every new job
+            retry_interval: float [default=30.0]
+                the number of seconds to wait before reopening a failed change stream
+            loop: [default=None]
+                the event loop to deliver the jobs on, the current event loop if None
+            state_callback: [default=None]
+                the function called on the event loop with True when the change
+                stream opens and False when it fails
+            leases: bool [default=False]
+                should the lease changes of the jobs be delivered too?
+        """
+        self.db_module = db_module
+        self.callback = callback
+        self.retry_interval = retry_interval
+        self.state_callback = state_callback
+        self.leases = leases
+        self.running = False
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.logger = logging.getLogger(__name__)
+
+    thread_name = "job-watcher"
+
+    def start(self):
+        """
+        Starts following the job queue in a daemon thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops delivering jobs. The thread exits the next time the stream returns.
+        """
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                for change in self._watch():
+                    if self._stopped.is_set():
+                        return
+                    self._loop.call_soon_threadsafe(self.callback, *change)
+            except Exception as e:
+                self.logger.warning("%s change stream failed (%s), retrying in %ss", self.stream_name, e,
+                    self.retry_interval)
+            if self.running:
+                self.running = False
+                self._notify_state(False)
+            self._stopped.wait(self.retry_interval)
+
+    stream_name = "Job queue"
+
+    def _watch(self):
+        return self.db_module.watchScheduledEvents(onOpen=self._opened, leases=self.leases)
+
+    def _opened(self):
+        self.running = True
+        self._notify_state(True)
+
+    def _notify_state(self, running):
+        if self.state_callback is not None:
+            self._loop.call_soon_threadsafe(self.state_callback, running)
+
+class FeederWatcher(JobWatcher):
+    """
+    Follows the feeders that are added, deleted or whose product key,
+    authentication key or status changes (e.g. from the website) in a
+    background thread and hands them to a callback on the event loop, as
+    callback(feeder_id, record) where record is None for a deleted feeder.
+
+    The changes are read from db_helper.watchFeederAuthRecords, which needs
+    MongoDB change streams, with the same retries as the JobWatcher.
+    """
+
+    thread_name = "feeder-watcher"
+    stream_name = "Feeders"
+
+    def _watch(self):
+        return self.db_module.watchFeederAuthRecords(onOpen=self._opened)
@@ -0,0 +1,226 @@
+import math, time
+
+# Histogram buckets grow by 2^(1/4) (about 19%) from 10 microseconds, so 96
+# buckets cover up to about 16 minutes and percentiles are within 19%.
+_MIN_VALUE = 1e-5
+_BUCKETS_PER_DOUBLING = 4
+_BUCKET_COUNT = 96
+
+_QUANTILES = (0.5, 0.95, 0.99)
+
+class Histogram:
+    """
+    A fixed size histogram of durations in seconds with logarithmic buckets.
+
+    Recording a value is a bucket index calculation and two additions, so the
+    histograms can stay on for every request. Percentiles are estimated from
+    the upper bound of the bucket they fall in.
+
+    Instance Variables:
+        count:
+            the number of recorded values
+        sum:
+            the sum of the recorded values
+        max:
+            the largest recorded value
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._buckets = [0] * _BUCKET_COUNT
+
+    def observe(self, value):
+        """
+        Records a value.
+
+        Parameters:
+            value: float
+                the duration in seconds
+        """
+        if value > _MIN_VALUE:
+            index = int(math.log2(value / _MIN_VALUE) * _BUCKETS_PER_DOUBLING)
+            if index >= _BUCKET_COUNT:
+                index = _BUCKET_COUNT - 1
+        else:
+            index = 0
+        self._buckets[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Estimates a percentile of the recorded values.
+
+        Parameters:
+            q: float
+                the quantile between 0 and 1, e.g. 0.99 for the 99th percentile
+
+        Returns:
+            the upper bound of the bucket holding the quantile, capped at the
+            largest recorded value, or 0 if nothing was recorded
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket in enumerate(self._buckets):
+            seen += bucket
+            if seen >= rank and bucket:
+                upper = _MIN_VALUE * 2 ** ((index + 1) / _BUCKETS_PER_DOUBLING)
+                return min(upper, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Returns the count, sum, max and percentiles as a dictionary.
+        """
+        data = {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+        }
+        for q in _QUANTILES:
+            data["p{:g}".format(q * 100)] = self.quantile(q)
+        return data
+
+class _Timer:
+    """
+    Context manager recording the time spent in its with block into a histogram.
+    """
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+class Metrics:
+    """
+    In memory counters, gauges and latency histograms of the CoAP server.
+
+    The metrics are only updated from the event loop thread, so no locking is
+    done. Each server process keeps its own metrics.
+
+    Example
+        metrics = Metrics()
+        metrics.inc("requests")
+        with metrics.timer("get_updates.parse"):
+            data = parse_util.parse_payload(payload)
+
+    Instance Variables:
+        counters:
+            the counter values by name
+        histograms:
+            the Histogram of each timed stage by name
+        gauges:
+            the functions returning the current value of each gauge by name
+        started:
+            the time the metrics were created, to report the uptime
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def inc(self, name, amount=1):
+        """
+        Increases a counter, creating it at 0 if it does not exist.
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def histogram(self, name):
+        """
+        Gets the histogram with the name, creating it if it does not exist.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def observe(self, name, seconds):
+        """
+        Records a duration in the histogram with the name.
+        """
+        self.histogram(name).observe(seconds)
+
+    def timer(self, name):
+        """
+        Returns a context manager that records the time spent in its with
+        block in the histogram with the name.
+        """
+        return _Timer(self.histogram(name))
+
+    def gauge(self, name, func):
+        """
+        Registers a gauge whose value is read when the metrics are exported.
+
+        Parameters:
+            name: str
+                the name of the gauge
+            func: function
+                returns the current value of the gauge
+        """
+        self.gauges[name] = func
+
+    def snapshot(self):
+        """
+        Returns all of the metrics as a dictionary that can be encoded as JSON.
+        """
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                gauges[name] = None
+        return {
+            "uptime": time.time() - self.started,
+            "counters": dict(self.counters),
+            "gauges": gauges,
+            "latency": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+        }
+
+    def prometheus(self, prefix="petfeeder_coap"):
+        """
+        Returns all of the metrics in the Prometheus text exposition format.
+        Counters and gauges are exported as is and histograms as summaries
+        with the 0.5, 0.95 and 0.99 quantiles in seconds.
+
+        Parameters:
+            prefix: str [default="petfeeder_coap"]
+                the prefix of the metric names
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = _metric_name(prefix, name) + "_total"
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            if value is None:
+                continue
+            metric = _metric_name(prefix, name)
+            lines.append("# TYPE {} gauge".format(metric))
+            lines.append("{} {}".format(metric, value))
+        for name, histogram in sorted(self.histograms.items()):
+            metric = _metric_name(prefix, name) + "_seconds"
+            lines.append("# TYPE {} summary".format(metric))
+            for q in _QUANTILES:
+                lines.append('{}{{quantile="{:g}"}} {}'.format(metric, q, histogram.quantile(q)))
+            lines.append("{}_sum {}".format(metric, histogram.sum))
+            lines.append("{}_count {}".format(metric, histogram.count))
+        return "\n".join(lines) + "\n"
+
+def _metric_name(prefix, name):
+    return "{}_{}".format(prefix, name.replace(".", "_").replace("-", "_"))
@@ -1,3 +1,17 @@
+import struct
+
+# CoAP Content-Format numbers of the payload formats pet feeders can send
+TEXT_CONTENT_FORMAT = 0
+CBOR_CONTENT_FORMAT = 60
+
+# Fixed integer keys of the CBOR payload and the POST variables they stand for
+CBOR_KEYS = {
+    0: 'u', # product key
+    1: 'p', # authentication key
+    2: 'f', # food eaten
+    3: 'd', # drop status
+}
+
 def parse_post_data(request_payload):
     """
     Decodes the payload into an ASCII string then parses the POST data and
@@ -13,3 +27,265 @@ def parse_post_data(request_payload):
     """
     data = request_payload.decode('ascii').split('&')
     return {param[:param.find('=')] : param[param.find('=') + 1:] for param in data}
+
+def parse_cbor_data(request_payload):
+    """
+    Parses a CBOR encoded payload from a pet feeder into the same dictionary
+    as parse_post_data. The payload is a CBOR map from the integer keys in
+    CBOR_KEYS to the values, for example {0: "testingkey1234", 1: "13511NG%%",
+    2: 50}. Unknown keys are ignored.
+
+    The payload is read in place through a memoryview, only the final values
+    are copied out of it.
+
+    Parameters:
+        request_payload:
+            the CBOR encoded POST request payload
+
+    Returns:
+        a dictionary representing the variables from the POST request
+
+    Raises:
+        ValueError:
+            the payload is not a CBOR map or uses unsupported CBOR features
+    """
+    view = memoryview(request_payload)
+    if not view or view[0] >> 5 != 5:
+        raise ValueError("Payload is not a CBOR map")
+
+    # Fast path for the flat maps pet feeders send: small integer keys with
+    # short text or integer values, decoded without recursing.
+    count = view[0] & 0x1f
+    if count < 24:
+        data = {}
+        pos = 1
+        end = len(view)
+        for _ in range(count):
+            key = view[pos]
+            if key >= 24:
+                break
+            initial = view[pos + 1]
+            major, info = initial >> 5, initial & 0x1f
+            if info > 25 or major > 3 or major == 2:
+                break
+            pos += 2
+            if info == 24:
+                info = view[pos]
+                pos += 1
+            elif info == 25:
+                info = view[pos] << 8 | view[pos + 1]
+                pos += 2
+            if major == 3:
+                if pos + info > end:
+                    raise ValueError("Truncated CBOR string")
+                value = str(view[pos:pos + info], 'utf-8')
+                pos += info
+            else:
+                value = info if major == 0 else -1 - info
+            if key in CBOR_KEYS:
+                data[CBOR_KEYS[key]] = value
+        else:
+            if pos != end:
+                raise ValueError("Payload is not a single CBOR map")
+            return data
+
+    value = decode_cbor(view)
+    return {CBOR_KEYS[key]: val for key, val in value.items() if key in CBOR_KEYS}
+
+def parse_payload(request_payload, content_format=None):
+    """
+    Parses the payload of a pet feeder in the format given by its CoAP
+    Content-Format option.
+
+    Parameters:
+        request_payload:
+            the POST request payload
+        content_format: int [default=None]
+            the Content-Format of the request, the legacy POST format if None
+
+    Returns:
+        a dictionary representing the variables from the POST request
+    """
+    if content_format == CBOR_CONTENT_FORMAT:
+        return parse_cbor_data(request_payload)
+    return parse_post_data(request_payload)
+
+def get_query(request, name):
+    """
+    Gets the value of a query parameter of a CoAP request.
+
+    Parameters:
+        request:
+            the CoAP request
+        name: str
+            the name of the query parameter
+
+    Returns:
+        the value of the query parameter, or None if it is missing
+    """
+    prefix = name + '='
+    for query in request.opt.uri_query:
+        if query.startswith(prefix):
+            return query[len(prefix):]
+    return None
+
+def encode_payload(value, content_format=None):
+    """
+    Encodes a response in the format given by the CoAP Content-Format of the
+    request.
+
+    Parameters:
+        value:
+            the value to respond with, a string for the legacy format
+        content_format: int [default=None]
+            the Content-Format of the request, the legacy ASCII format if None
+
+    Returns:
+        the encoded payload as bytes
+    """
+    if content_format == CBOR_CONTENT_FORMAT:
+        return encode_cbor(value)
+    return value.encode('ascii')
+
+def encode_cbor(value):
+    """
+    Encodes a value as CBOR. Supports the types pet feeder payloads are made
+    of: integers, strings, bytes, booleans, None, lists and dictionaries.
+
+    Parameters:
+        value:
+            the value to encode
+
+    Returns:
+        the CBOR encoding as bytes
+    """
+    out = bytearray()
+    _encode_cbor(value, out)
+    return bytes(out)
+
+def decode_cbor(payload):
+    """
+    Decodes a payload holding a single CBOR data item, supporting the same
+    types as encode_cbor.
+
+    Parameters:
+        payload:
+            the CBOR encoded bytes
+
+    Returns:
+        the decoded value
+    """
+    view = memoryview(payload)
+    value, end = _decode_cbor(view, 0)
+    if end != len(view):
+        raise ValueError("Payload is not a single CBOR data item")
+    return value
+
+def _encode_head(major, length, out):
+    if length < 24:
+        out.append(major << 5 | length)
+    elif length < 0x100:
+        out.append(major << 5 | 24)
+        out.append(length)
+    elif length < 0x10000:
+        out.append(major << 5 | 25)
+        out += struct.pack('>H', length)
+    elif length < 0x100000000:
+        out.append(major << 5 | 26)
+        out += struct.pack('>I', length)
+    else:
+        out.append(major << 5 | 27)
+        out += struct.pack('>Q', length)
+
+def _encode_cbor(value, out):
+    if value is False:
+        out.append(0xf4)
+    elif value is True:
+        out.append(0xf5)
+    elif value is None:
+        out.append(0xf6)
+    elif isinstance(value, int):
+        if value >= 0:
+            _encode_head(0, value, out)
+        else:
+            _encode_head(1, -1 - value, out)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        _encode_head(2, len(value), out)
+        out += value
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        _encode_head(3, len(data), out)
+        out += data
+    elif isinstance(value, (list, tuple)):
+        _encode_head(4, len(value), out)
+        for item in value:
+            _encode_cbor(item, out)
+    elif isinstance(value, dict):
+        _encode_head(5, len(value), out)
+        for key, item in value.items():
+            _encode_cbor(key, out)
+            _encode_cbor(item, out)
+    else:
+        raise TypeError("Cannot encode %s as CBOR" % type(value).__name__)
+
+def _decode_cbor(view, pos):
+    """
+    Decodes the CBOR data item starting at pos.
+
+    Returns:
+        the decoded value and the position after it
+    """
+    initial = view[pos]
+    major, info = initial >> 5, initial & 0x1f
+    pos += 1
+
+    if major == 7:
+        if info == 20:
+            return False, pos
+        if info == 21:
+            return True, pos
+        if info == 22:
+            return None, pos
+        raise ValueError("Unsupported CBOR simple value %d" % info)
+
+    if info < 24:
+        arg = info
+    elif info == 24:
+        arg = view[pos]
+        pos += 1
+    elif info == 25:
+        arg = int.from_bytes(view[pos:pos + 2], 'big')
+        pos += 2
+    elif info == 26:
+        arg = int.from_bytes(view[pos:pos + 4], 'big')
+        pos += 4
+    elif info == 27:
+        arg = int.from_bytes(view[pos:pos + 8], 'big')
+        pos += 8
+    else:
+        raise ValueError("Indefinite length CBOR items are not supported")
+
+    if major == 0:
+        return arg, pos
+    if major == 1:
+        return -1 - arg, pos
+    if major == 2 or major == 3:
+        end = pos + arg
+        if end > len(view):
+            raise ValueError("Truncated CBOR string")
+        if major == 2:
+            return bytes(view[pos:end]), end
+        return str(view[pos:end], 'utf-8'), end
+    if major == 4:
+        items = []
+        for _ in range(arg):
+            item, pos = _decode_cbor(view, pos)
+            items.append(item)
+        return items, pos
+    if major == 5:
+        items = {}
+        for _ in range(arg):
+            key, pos = _decode_cbor(view, pos)
+            items[key], pos = _decode_cbor(view, pos)
+        return items, pos
+    raise ValueError("Unsupported CBOR major type %d" % major)
@@ -1,7 +1,13 @@
-import datetime, logging, asyncio, aiocoap, argparse
+import datetime, logging, asyncio, aiocoap, argparse, signal, os
 import aiocoap.resource as resource
 
+import feeder_api.db_helper as db_helper
+import feeder_api.log_setup as log_setup
+
 from endpoints import *
+from endpoints.utils import async_db, consumption_buffer, job_watcher, admission, job_index, device_registry
+from endpoints.utils.metrics import Metrics
+import workers as coap_workers
 
 class Server:
     """
@@ -10,31 +16,144 @@ class Server:
     Intance Variables:
         logger:
             The logger of the server to log issues
+        db_concurrency:
+            The maximum number of database calls that can be in flight at once
+        consumption_flush_interval:
+            The number of seconds between writes of the buffered food eaten
+        consumption_max_keys:
+            The number of buffered (feeder, hour) totals that triggers a write
+        observe_recheck_interval:
+            The number of seconds between database re-checks of observed feeders
+        admission_options:
+            The keyword arguments of the AdmissionControl of each server process
+        job_reconcile_interval:
+            The number of seconds between reloads of the in memory job index
+        registry_refresh_interval:
+            The number of seconds between incremental refreshes of the device registry
+        log_options:
+            The keyword arguments of log_setup.configureLogging
     """
 
-    def __init__(self, logging_level="WARNING"):
+    def __init__(self, logging_level="WARNING", db_concurrency=128,
+            consumption_flush_interval=10.0, consumption_max_keys=5000,
+            observe_recheck_interval=60.0, admission_options=None,
+            job_reconcile_interval=300.0, registry_refresh_interval=30.0,
+            log_options=None):
         """
         Initializes the CoAP server.
 
         Parameters:
             logging_level: str [default="WARNING"]
                 At what level of logs should be logged?
+            db_concurrency: int [default=128]
+                The maximum number of database calls that can be in flight at
+                once, calls over the limit wait without blocking the server
+            consumption_flush_interval: float [default=10.0]
+                The number of seconds between writes of the buffered food eaten
+            consumption_max_keys: int [default=5000]
+                The number of buffered (feeder, hour) totals that triggers an
+                early write
+            observe_recheck_interval: float [default=60.0]
+                The number of seconds after which feeders observing their
+                commands re-check the database for jobs
+            admission_options: dict [default=None]
+                The rate, burst, max_keys, max_in_flight and overload_max_age
+                of the admission control, its defaults if None
+            job_reconcile_interval: float [default=300.0]
+                The number of seconds between reloads of the in memory index of
+                the job queue from the database, 0 disables the index
+            registry_refresh_interval: float [default=30.0]
+                The number of seconds between loads of the feeders added to the
+                database into the in memory device registry, 0 disables the
+                registry
+            log_options: dict [default=None]
+                The logFile, jsonFormat, maxBytes, backupCount and rotateWhen
+                of the logging, logs to logs/coap.log if None. Log records are
+                written by a background thread so the event loop never waits
+                on log I/O.
         """
-        logging.basicConfig(
-            filename = 'logs/coap.log',
-            level = logging_level,
-        )
-        logging.getLogger().addHandler(logging.StreamHandler())
+        self.logging_level = logging_level
+        self.log_options = dict(log_options or {})
+        self.log_options.setdefault('logFile', 'logs/coap.log')
+        log_setup.configureLogging(level=logging_level, **self.log_options)
 
         self.logger = logging.getLogger(__name__)
+        self.db_concurrency = db_concurrency
+        self.consumption_flush_interval = consumption_flush_interval
+        self.consumption_max_keys = consumption_max_keys
+        self.observe_recheck_interval = observe_recheck_interval
+        self.admission_options = admission_options or {}
+        self.job_reconcile_interval = job_reconcile_interval
+        self.registry_refresh_interval = registry_refresh_interval
+
+    def run(self, workers=1):
+        """
+        Prepares the database and starts the CoAP server, in this process or in
+        worker processes that share the CoAP port.
 
-    def start_server(self):
+        Parameters:
+            workers: int [default=1]
+                The number of worker processes, each with its own event loop
+                and MongoDB client. The server runs in this process if 1.
+        """
+        for collection_name, name, action in db_helper.ensureIndexes():
+            if action.startswith("conflict"):
+                self.logger.warning("Index {}.{} not rebuilt on startup ({}), run python -m feeder_api.indexes".format(
+                    collection_name, name, action))
+        if workers <= 1:
+            self.start_server()
+            return
+
+        self.logger.info("Starting {} CoAP server workers".format(workers))
+        supervisor = coap_workers.WorkerSupervisor(self._start_worker, workers,
+            teardown=log_setup.stopLogging)
+        supervisor.run()
+
+    def _start_worker(self, number):
+        # Runs in a forked worker, which must not reuse the parent's MongoDB
+        # client, event loop or logging thread. Each worker writes its own log
+        # file as the processes would otherwise rotate the same file.
+        options = dict(self.log_options)
+        if options['logFile']:
+            base, extension = os.path.splitext(options['logFile'])
+            options['logFile'] = "{}.{}{}".format(base, number, extension)
+        log_setup.configureLogging(level=self.logging_level, **options)
+        db_helper.reconnect()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        # The supervisor logs a crash and then stops the logging thread
+        self.start_server(reuse_port=True)
+
+    def start_server(self, reuse_port=False):
         """
         Starts the CoAP server and creates the resource tree that is the
         endpoint resources that clients access.
+
+        Parameters:
+            reuse_port: bool [default=False]
+                Binds the CoAP port with SO_REUSEPORT so that other worker
+                processes can bind it too
         """
         self.logger.info("Starting the CoAP server")
         site = resource.Site()
+        metrics = Metrics()
+        db = async_db.AsyncDatabase(db_helper, max_concurrency=self.db_concurrency)
+        consumption = consumption_buffer.ConsumptionBuffer(
+            db,
+            flush_interval=self.consumption_flush_interval,
+            max_keys=self.consumption_max_keys,
+            metrics=metrics
+        )
+        # Sheds requests before any database or bcrypt work when a product
+        # key polls too often or too many requests are in flight.
+        admission_control = admission.AdmissionControl(**self.admission_options)
+        # Answers polls with nothing due without querying the job queue
+        jobs = None
+        if self.job_reconcile_interval > 0:
+            jobs = job_index.JobIndex(db, reconcile_interval=self.job_reconcile_interval)
+        # Authenticates pet feeders without querying the feeders collection
+        registry = None
+        if self.registry_refresh_interval > 0:
+            registry = device_registry.DeviceRegistry(db, refresh_interval=self.registry_refresh_interval)
 
         # Default resources for the CoAP server
         self.logger.info("Creating default resources")
@@ -51,12 +170,93 @@ class Server:
 
         site.add_resource(
             ['get_updates'],
-            get_updates.FeederUpdateResource()
+            get_updates.FeederUpdateResource(db=db, consumption=consumption,
+                metrics=metrics, admission=admission_control, job_index=jobs,
+                registry=registry)
+        )
+
+        # Updates of many feeders forwarded by a gateway in one request
+        site.add_resource(
+            ['batch_updates'],
+            batch_updates.BatchUpdateResource(db=db, consumption=consumption,
+                metrics=metrics, admission=admission_control, job_index=jobs)
+        )
+
+        # Observable drop food commands at /feeder/<product key>/commands,
+        # notified as soon as a job is added to the job queue.
+        commands = feeder_commands.FeederCommandsSite(
+            db=db,
+            recheck_interval=self.observe_recheck_interval,
+            admission=admission_control
         )
+        site.add_resource(['feeder'], commands)
+        def job_scheduled(feeder_id, time):
+            if jobs is not None:
+                jobs.add(feeder_id, time)
+            commands.job_scheduled(feeder_id, time)
+        # Jobs claimed by a consumer that dies come back when their lease
+        # lapses, the lease changes are followed to index them again then.
+        watcher = job_watcher.JobWatcher(db_helper, job_scheduled,
+            state_callback=jobs.stream_state if jobs is not None else None, leases=True)
+        # Drops deleted feeders and applies status changes to the registry
+        feeder_watcher = None
+        if registry is not None:
+            feeder_watcher = job_watcher.FeederWatcher(db_helper, registry.feeder_changed,
+                state_callback=registry.stream_state)
 
-        asyncio.Task(aiocoap.Context.create_server_context(site))
+        # Request counters and stage latencies, as JSON or Prometheus text
+        site.add_resource(
+            ['metrics'],
+            server_metrics.MetricsResource(metrics)
+        )
+        metrics.gauge("worker_pid", os.getpid)
+        metrics.gauge("db.in_flight", lambda: db.in_flight)
+        metrics.gauge("db.waiting", lambda: db.waiting)
+        metrics.gauge("consumption.buffered_keys", lambda: len(consumption))
+        metrics.gauge("consumption.failed_flushes", lambda: consumption.failed_flushes)
+        metrics.gauge("observed_feeders", lambda: commands.observed_feeders)
+        metrics.gauge("admission.in_flight", lambda: admission_control.in_flight)
+        if jobs is not None:
+            metrics.gauge("job_index.jobs", lambda: len(jobs))
+            metrics.gauge("job_index.feeders", lambda: jobs.feeders)
+            metrics.gauge("job_index.authoritative", lambda: int(jobs.authoritative))
+        if registry is not None:
+            metrics.gauge("registry.feeders", lambda: len(registry))
+            metrics.gauge("registry.misses", lambda: registry.misses)
+            metrics.gauge("registry.negative_hits", lambda: registry.negative_hits)
+        metrics.gauge("auth_cache.hit_ratio", lambda: db_helper.getCredentialCacheStats()["hitRatio"])
+
+        loop = asyncio.get_event_loop()
+        if reuse_port:
+            sock = coap_workers.reuse_port_socket()
+            loop.run_until_complete(coap_workers.create_server_context(site, sock, loop=loop))
+        else:
+            loop.run_until_complete(aiocoap.Context.create_server_context(site))
+        consumption.start()
+        if jobs is not None:
+            jobs.start()
+        if registry is not None:
+            registry.start()
+            feeder_watcher.start()
+        watcher.start()
         self.logger.info("CoAP server has started!")
-        asyncio.get_event_loop().run_forever()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Writes the food eaten that is still buffered before exiting
+            self.logger.info("Stopping the CoAP server")
+            watcher.stop()
+            if feeder_watcher is not None:
+                feeder_watcher.stop()
+            if jobs is not None:
+                jobs.stop()
+            if registry is not None:
+                registry.stop()
+            loop.run_until_complete(consumption.stop())
+            db.shutdown()
 
 def parse_args():
     """
@@ -73,13 +273,168 @@ def parse_args():
         type = str,
         default = 'WARNING'
     )
+
+    parser.add_argument(
+        '--log_file',
+        help = 'The file to log to, worker N logs to the file with .N before its extension, empty to only log to the console [default=logs/coap.log]',
+        type = str,
+        default = 'logs/coap.log'
+    )
+
+    parser.add_argument(
+        '--log_json',
+        help = 'Writes the logs as one JSON object per line',
+        action = 'store_true'
+    )
+
+    parser.add_argument(
+        '--log_max_bytes',
+        help = 'The size in bytes that rotates the log file, 0 never rotates by size [default=10485760]',
+        type = int,
+        default = 10 * 1024 * 1024
+    )
+
+    parser.add_argument(
+        '--log_backups',
+        help = 'The number of rotated log files kept [default=5]',
+        type = int,
+        default = 5
+    )
+
+    parser.add_argument(
+        '--log_rotate_when',
+        help = 'Rotates the log file at this interval instead of by size, e.g. midnight or H [default=None]',
+        type = str,
+        default = ''
+    )
+
+    parser.add_argument(
+        '--db_concurrency',
+        help = 'The maximum number of database calls in flight at once [default=128]',
+        type = int,
+        default = 128
+    )
+
+    parser.add_argument(
+        '--auth_cache_size',
+        help = 'The number of verified feeder credentials to cache, 0 disables the cache [default=10000]',
+        type = int,
+        default = 10000
+    )
+
+    parser.add_argument(
+        '--auth_cache_ttl',
+        help = 'The number of seconds a verified feeder credential is cached for [default=300]',
+        type = float,
+        default = 300
+    )
+
+    parser.add_argument(
+        '--consumption_flush_interval',
+        help = 'The number of seconds between writes of the buffered food eaten [default=10]',
+        type = float,
+        default = 10.0
+    )
+
+    parser.add_argument(
+        '--consumption_max_keys',
+        help = 'The number of buffered (feeder, hour) totals that triggers an early write [default=5000]',
+        type = int,
+        default = 5000
+    )
+
+    parser.add_argument(
+        '--observe_recheck_interval',
+        help = 'The number of seconds between database re-checks of feeders observing their commands [default=60]',
+        type = float,
+        default = 60.0
+    )
+
+    parser.add_argument(
+        '--job_reconcile_interval',
+        help = 'The number of seconds between reloads of the in memory job index, 0 disables the index [default=300]',
+        type = float,
+        default = 300.0
+    )
+
+    parser.add_argument(
+        '--registry_refresh_interval',
+        help = 'The number of seconds between loads of new feeders into the in memory device registry, 0 disables the registry [default=30]',
+        type = float,
+        default = 30.0
+    )
+
+    parser.add_argument(
+        '--rate_limit',
+        help = 'The requests per second allowed per product key, 0 disables the limit [default=0.5]',
+        type = float,
+        default = 0.5
+    )
+
+    parser.add_argument(
+        '--rate_burst',
+        help = 'The number of requests a product key can send at once [default=5]',
+        type = int,
+        default = 5
+    )
+
+    parser.add_argument(
+        '--rate_limit_keys',
+        help = 'The number of product keys whose request rate is tracked [default=100000]',
+        type = int,
+        default = 100000
+    )
+
+    parser.add_argument(
+        '--max_in_flight',
+        help = 'The number of requests a server process handles at once before answering 5.03, 0 disables the cap [default=512]',
+        type = int,
+        default = 512
+    )
+
+    parser.add_argument(
+        '--overload_max_age',
+        help = 'The seconds overloaded requests are asked to wait before retrying, with up to as much random jitter [default=5]',
+        type = int,
+        default = 5
+    )
+
+    parser.add_argument(
+        '--workers',
+        help = 'The number of server processes sharing the CoAP port with SO_REUSEPORT [default=1]',
+        type = int,
+        default = 1
+    )
     return parser.parse_args()
 
 def main(args):
     log_level = args.log_level
+    db_helper.configureCredentialCache(maxSize=args.auth_cache_size, ttl=args.auth_cache_ttl)
 
-    server = Server(logging_level=log_level)
-    server.start_server()
+    server = Server(
+        logging_level=log_level,
+        db_concurrency=args.db_concurrency,
+        consumption_flush_interval=args.consumption_flush_interval,
+        consumption_max_keys=args.consumption_max_keys,
+        observe_recheck_interval=args.observe_recheck_interval,
+        job_reconcile_interval=args.job_reconcile_interval,
+        registry_refresh_interval=args.registry_refresh_interval,
+        admission_options=dict(
+            rate=args.rate_limit,
+            burst=args.rate_burst,
+            max_keys=args.rate_limit_keys,
+            max_in_flight=args.max_in_flight,
+            overload_max_age=args.overload_max_age
+        ),
+        log_options=dict(
+            logFile=args.log_file,
+            jsonFormat=args.log_json,
+            maxBytes=args.log_max_bytes,
+            backupCount=args.log_backups,
+            rotateWhen=args.log_rotate_when
+        )
+    )
+    server.run(workers=args.workers)
 
 if __name__ == '__main__':
     args = parse_args()
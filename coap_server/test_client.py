@@ -1,4 +1,4 @@
-import asyncio
+import asyncio, argparse
 from aiocoap import *
 import random
 
@@ -6,45 +6,62 @@ import random
 Client code for testing the CoAP server
 
 To run have the CoAP virtual environment activated that was discussed in the README.md
-and run with "python test_client.py" 
+and run with "python test_client.py --url coap://<address of the CoAP server>"
+
+The request functions are also used by the fleet simulator in benchmarks/simulate_fleet.py
 """
 
-async def main():
+def feeder_payload(key, passphrase, food_eaten=None, drop_failed=None):
+    """
+    Creates the POST payload of a pet feeder sending the food eaten or whether
+    its last drop failed.
+    """
+    payload = "u={key}&p={password}".format(key = key, password = passphrase)
+    if drop_failed is not None:
+        return payload + "&d=" + ('1' if drop_failed else '0')
+    return payload + "&f=" + str(food_eaten or 0)
+
+async def send_update(context, url, payload):
+    """
+    Sends a POST request to the /get_updates endpoint and returns the response
+    payload as a string.
+    """
+    request = Message(code=POST,
+                        payload = payload.encode('ascii'),
+                        uri = url)
+    response = await context.request(request).response
+    return response.payload.decode('ascii')
+
+async def main(url, key, passphrase):
     context = await Context.create_client_context()
-    
-    # CHANGE TO THE ADDRESS OF THE CoAP SERVER!
-    url = "coap://35.213.204.238/get_updates"
+
     # Simulates pet eating food
     print("Sending Message as a Pet Feeder")
     food_eaten = 0
     if random.choice([True, False]):
         food_eaten = random.randint(0, 50)
 
-    # Development Pet Feeder
-    key = "testingkey1234"
-    passphrase = "13511NG%%"
-
-    base_payload = "u={key}&p={password}".format(key = key, password = passphrase)
-
-    payload = base_payload + "&f=" + str(food_eaten)
+    payload = feeder_payload(key, passphrase, food_eaten=food_eaten)
     print("payload: " + payload)
-    request = Message(code=POST,
-                        payload = payload.encode('ascii'),
-                        uri = url)
-
-    response = await context.request(request).response
-    print("response: " + response.payload.decode('ascii'))
-    if response.payload.decode('ascii') == 'd':
+    response = await send_update(context, url, payload)
+    print("response: " + response)
+    if response == 'd':
         print("Dropping Food!")
-        success_var = '0' if random.choice([True, False]) else '1'
-        payload = base_payload + "&d=" + success_var
-        request = Message(code=POST,
-                            payload = payload.encode('ascii'),
-                            uri = url)
+        payload = feeder_payload(key, passphrase, drop_failed=random.choice([True, False]))
         print("payload: " + payload)
-        response = await context.request(request).response
+        response = await send_update(context, url, payload)
     await asyncio.sleep(10)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulates one pet feeder polling the CoAP server")
+    # CHANGE TO THE ADDRESS OF THE CoAP SERVER!
+    parser.add_argument('--url', type=str, default="coap://35.213.204.238/get_updates", help='The /get_updates URL of the CoAP server')
+    # Development Pet Feeder
+    parser.add_argument('--key', type=str, default="testingkey1234", help='The product key of the pet feeder')
+    parser.add_argument('--password', type=str, default="13511NG%%", help='The authentication key of the pet feeder')
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
     while True:
-        asyncio.get_event_loop().run_until_complete(main())
+        asyncio.get_event_loop().run_until_complete(main(args.url, args.key, args.password))
@@ -0,0 +1,75 @@
+"""
+Fixtures of the CoAP server tests. The database calls run against mongomock
+instead of a MongoDB deployment.
+
+Run from the coap_server folder with "python -m pytest tests" (needs pytest,
+mongomock and the Database API). Tests of the modules that import aiocoap are
+skipped where aiocoap cannot be imported.
+"""
+
+import asyncio, datetime, importlib, os, sys
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import pymongo
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', '..', 'database_api'))
+
+class MockClient(mongomock.MongoClient):
+    """
+    A mongomock client that ignores the MongoDB URI db_helper connects with.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+# db_helper connects when it is imported
+pymongo.MongoClient = MockClient
+import feeder_api.clock as clock
+import feeder_api.db_helper as db_helper
+
+def import_or_skip(name):
+    """
+    Imports a module of the server that needs aiocoap, skipping the test if
+    aiocoap cannot be imported (aiocoap 0.3 needs Python 3.9 or older).
+
+    Parameters:
+        name: str
+            the name of the module, e.g. "endpoints.batch_updates"
+    """
+    try:
+        return importlib.import_module(name)
+    except (ImportError, AttributeError) as e:
+        pytest.skip("aiocoap cannot be imported ({})".format(e))
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+@pytest.fixture
+def db():
+    """
+    db_helper on an empty mongomock database with its indexes.
+    """
+    db_helper._client.drop_database("smartfeeder")
+    db_helper.reconnect()
+    db_helper.ensureIndexes()
+    yield db_helper
+    db_helper._client.drop_database("smartfeeder")
+
+@pytest.fixture
+def virtual_clock():
+    """
+    A VirtualClock at 08:00 today used by the whole process, the system clock
+    is restored afterwards.
+    """
+    virtual = clock.VirtualClock(datetime.datetime.combine(datetime.date.today(), datetime.time(8)))
+    previous = clock.setClock(virtual)
+    yield virtual
+    clock.setClock(previous)
@@ -0,0 +1,53 @@
+import pytest
+from conftest import import_or_skip
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+@pytest.fixture
+def admission():
+    return import_or_skip("endpoints.utils.admission")
+
+def test_rate_limit_allows_a_burst_then_refills(admission):
+    fake = FakeClock()
+    control = admission.AdmissionControl(rate=0.5, burst=3, clock=fake)
+
+    assert [control.check_rate("k") for _ in range(3)] == [None, None, None]
+    # The next token is 2 seconds away at 0.5 requests per second
+    assert control.check_rate("k") == 2
+    assert control.check_rate("other") is None
+    fake.time = 2.0
+    assert control.check_rate("k") is None
+    assert control.check_rate("k") is not None
+    assert control.rate_limited == 2
+
+def test_rate_limit_disabled(admission):
+    control = admission.AdmissionControl(rate=0, burst=1)
+    assert all(control.check_rate("k") is None for _ in range(100))
+
+def test_least_recently_seen_keys_are_dropped(admission):
+    control = admission.AdmissionControl(rate=0.1, burst=1, max_keys=2, clock=FakeClock())
+    assert control.check_rate("a") is None
+    assert control.check_rate("b") is None
+    assert control.check_rate("c") is None
+    assert control.stats()["tracked_keys"] == 2
+    # "a" was forgotten with its empty bucket, "c" was not
+    assert control.check_rate("a") is None
+    assert control.check_rate("c") is not None
+
+def test_in_flight_cap(admission):
+    control = admission.AdmissionControl(max_in_flight=2, overload_max_age=5)
+    assert control.enter() is None
+    assert control.enter() is None
+    max_age = control.enter()
+    assert 5 <= max_age <= 10
+    assert control.in_flight == 2
+    assert control.overloaded == 1
+
+    control.leave()
+    assert control.enter() is None
+    assert control.stats()["in_flight"] == 2
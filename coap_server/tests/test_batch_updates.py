@@ -0,0 +1,50 @@
+import datetime, types
+import pytest
+from conftest import import_or_skip
+from endpoints.utils import parse_util
+from endpoints.utils.async_db import AsyncDatabase
+
+@pytest.fixture
+def resource(loop, db):
+    batch_updates = import_or_skip("endpoints.batch_updates")
+    return batch_updates.BatchUpdateResource(db=AsyncDatabase(db, max_concurrency=1, loop=loop))
+
+def post(loop, resource, payload, content_format=None):
+    request = types.SimpleNamespace(payload=payload, opt=types.SimpleNamespace(content_format=content_format))
+    return loop.run_until_complete(resource.render_post(request))
+
+@pytest.fixture
+def feeders(db, virtual_clock):
+    fed = db.insertFeeder("address", "feeder1", "pass1")
+    db.insertFeeder("address", "feeder2", "pass2")
+    db.addScheduleItem(fed["_id"], scheduleType="S", time=virtual_clock.now())
+    return fed
+
+def test_legacy_answers_stay_aligned_with_malformed_records(loop, resource, feeders):
+    payload = b"\n".join([
+        b"u=feeder1&p=pass1&f=5",
+        b"u=feeder1&p=wrong&f=5",
+        "u=café&p=pass1&f=5".encode("utf-8"),
+        b"",
+        b"p=pass2&f=1",
+        b"u=feeder2&p=pass2&d=1",
+        b"u=feeder2&p=pass2&f=abc",
+        b"u=feeder2&p=pass2&f=3",
+    ])
+    response = post(loop, resource, payload)
+    assert response.payload.decode("ascii").split("\n") == ["d", "", "", "", "status updated", "", "n"]
+
+def test_cbor_answers_stay_aligned_with_malformed_records(loop, resource, feeders):
+    payload = parse_util.encode_cbor([
+        {0: "feeder2", 1: "pass2", 2: 3},
+        5,
+        {0: "feeder2", 1: 7},
+        {0: "unknown", 1: "pass2"},
+        {0: "feeder1", 1: "pass1", 2: 5},
+    ])
+    response = post(loop, resource, payload, parse_util.CBOR_CONTENT_FORMAT)
+    assert parse_util.decode_cbor(response.payload) == ["n", "", "", "", "d"]
+
+def test_invalid_batch_is_rejected(loop, resource, feeders):
+    response = post(loop, resource, parse_util.encode_cbor({0: "feeder1"}), parse_util.CBOR_CONTENT_FORMAT)
+    assert response.payload == b""
@@ -0,0 +1,52 @@
+import datetime
+from endpoints.utils.job_index import JobIndex
+
+FEEDER = "5f68b87e65ff4dd70d6add43"
+
+def test_due_jobs_follow_the_virtual_clock(loop, virtual_clock):
+    index = JobIndex(None, loop=loop)
+    start = virtual_clock.now()
+    index.add(FEEDER, start + datetime.timedelta(minutes=1))
+    index.add(FEEDER, start + datetime.timedelta(minutes=10))
+
+    assert not index.has_due(FEEDER)
+    virtual_clock.advance(60)
+    assert index.has_due(FEEDER)
+    assert not index.has_due("5f68b87e65ff4dd70d6add44")
+
+    index.clear_due(FEEDER)
+    assert len(index) == 1
+    assert not index.has_due(FEEDER)
+
+    virtual_clock.advance(datetime.timedelta(minutes=9))
+    assert index.has_due(FEEDER)
+    index.clear_due(FEEDER)
+    assert len(index) == 0
+    assert index.feeders == 0
+
+def test_clear_due_keeps_jobs_added_after_the_dispatch_started(loop, virtual_clock):
+    index = JobIndex(None, loop=loop)
+    index.add(FEEDER, virtual_clock.now())
+    dispatch_started = virtual_clock.now().timestamp()
+
+    # A job that became due while the dispatch was running was not claimed
+    virtual_clock.advance(5)
+    index.add(FEEDER, virtual_clock.now())
+    index.clear_due(FEEDER, dispatch_started)
+    assert len(index) == 1
+    assert index.has_due(FEEDER)
+
+def test_reload_indexes_leased_jobs_at_their_lease_expiry(loop, db, virtual_clock):
+    from endpoints.utils.async_db import AsyncDatabase
+
+    feeder = db.insertFeeder("address", "testingkey1234", "13511NG%%")
+    db.addScheduleItem(feeder["_id"], scheduleType="S", time=virtual_clock.now())
+    claimed = db.jobQueue.claimAll()
+    assert len(claimed) == 1
+
+    index = JobIndex(AsyncDatabase(db, max_concurrency=1, loop=loop), loop=loop)
+    loop.run_until_complete(index.reload())
+    assert len(index) == 1
+    assert not index.has_due(feeder["_id"])
+    virtual_clock.advance(db.JOB_VISIBILITY_TIMEOUT)
+    assert index.has_due(feeder["_id"])
@@ -0,0 +1,50 @@
+import pytest
+from endpoints.utils import parse_util
+
+@pytest.mark.parametrize("value", [
+    0, 23, 24, 255, 256, 65535, 65536, 2 ** 32, 2 ** 64 - 1, -1, -24, -25, -2 ** 40,
+    "", "testingkey1234", "13511NG%%", "café", "x" * 300,
+    b"", b"\x00\xff" * 200,
+    True, False, None,
+    [], [1, "two", [3, None]], list(range(30)),
+    {}, {0: "testingkey1234", 1: "13511NG%%", 2: 50}, {"nested": {"list": [b"bytes", -7]}},
+])
+def test_cbor_round_trip(value):
+    assert parse_util.decode_cbor(parse_util.encode_cbor(value)) == value
+
+def test_cbor_map_fast_path_matches_generic_decoder():
+    payloads = [
+        {0: "testingkey1234", 1: "13511NG%%", 2: 50},
+        {0: "testingkey1234", 1: "13511NG%%", 3: 1},
+        {0: "k" * 200, 1: "p", 2: 60000},
+        {0: "testingkey1234", 1: "13511NG%%", 2: -5, 9: "ignored"},
+        {0: "testingkey1234", 1: b"bytes take the generic path", 2: [1]},
+    ]
+    for payload in payloads:
+        encoded = parse_util.encode_cbor(payload)
+        expected = {parse_util.CBOR_KEYS[key]: value for key, value in payload.items() if key in parse_util.CBOR_KEYS}
+        assert parse_util.parse_cbor_data(encoded) == expected
+        assert parse_util.parse_payload(encoded, parse_util.CBOR_CONTENT_FORMAT) == expected
+
+@pytest.mark.parametrize("payload", [
+    b"",
+    parse_util.encode_cbor([1, 2]),
+    parse_util.encode_cbor({0: "testingkey1234"})[:-3],
+    parse_util.encode_cbor({0: "a"}) + b"\x00",
+])
+def test_invalid_cbor_payloads_raise(payload):
+    with pytest.raises((ValueError, IndexError)):
+        parse_util.parse_cbor_data(payload)
+
+def test_legacy_payload():
+    assert parse_util.parse_payload(b"u=testingkey1234&p=13511NG%%&f=50") == {
+        "u": "testingkey1234", "p": "13511NG%%", "f": "50"}
+    # A param without "=" loses its last character to the key
+    assert parse_util.parse_post_data(b"u=a&d") == {"u": "a", "": "d"}
+    assert parse_util.parse_post_data(b"u=a&p=b=c") == {"u": "a", "p": "b=c"}
+    with pytest.raises(UnicodeDecodeError):
+        parse_util.parse_post_data("u=café".encode("utf-8"))
+
+def test_encode_payload():
+    assert parse_util.encode_payload("d") == b"d"
+    assert parse_util.decode_cbor(parse_util.encode_payload("d", parse_util.CBOR_CONTENT_FORMAT)) == "d"
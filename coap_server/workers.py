@@ -0,0 +1,179 @@
+import asyncio, os, signal, socket, time, logging
+import aiocoap
+from aiocoap.numbers import COAP_PORT
+from aiocoap.transports.udp6 import TransportEndpointUDP6
+from aiocoap.util import socknumbers
+
+def reuse_port_socket(bind=("::", COAP_PORT)):
+    """
+    Creates the UDP socket of a worker's CoAP server, bound with SO_REUSEPORT
+    so that several worker processes can bind the CoAP port and the kernel
+    spreads the datagrams between them. The socket gets the same options as
+    the one aiocoap creates for its server contexts.
+
+    Parameters:
+        bind: tuple [default=("::", COAP_PORT)]
+            the address and port to bind, on every address by default
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVPKTINFO, 1)
+        sock.setsockopt(socket.IPPROTO_IPV6, socknumbers.IPV6_RECVERR, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socknumbers.IP_RECVERR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(bind)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+async def create_server_context(site, sock, loop=None):
+    """
+    Creates an aiocoap server context serving site on a socket that is already
+    bound, like aiocoap.Context.create_server_context does on a socket of its
+    own. aiocoap has no option to pass a socket, so its UDP transport is
+    attached to the context here.
+
+    Parameters:
+        site:
+            the resource tree of the server
+        sock: socket
+            the bound UDP socket, see reuse_port_socket
+        loop: [default=None]
+            the event loop to run on, the current event loop if None
+    """
+    loop = loop or asyncio.get_event_loop()
+    context = aiocoap.Context(loop=loop, serversite=site, loggername="coap-server")
+    protocol_factory = lambda: TransportEndpointUDP6(new_message_callback=context._dispatch_message,
+        new_error_callback=context._dispatch_error, log=context.log, loop=loop)
+    transport, protocol = await loop.create_datagram_endpoint(protocol_factory, sock=sock)
+    await protocol.ready
+    context.transport_endpoints.append(protocol)
+    return context
+
+class WorkerSupervisor:
+    """
+    Forks worker processes that each run the CoAP server and restarts them if
+    they crash.
+
+    Workers that exit soon after starting are restarted with a growing delay,
+    so a worker failing on start up does not fork in a tight loop. SIGTERM and
+    SIGINT stop the workers and then the supervisor.
+
+    Intance Variables:
+        target:
+            The function that each worker process runs
+        workers:
+            The number of worker processes to keep running
+        children:
+            The process ids of the running workers mapped to their worker number
+            and start time
+    """
+
+    def __init__(self, target, workers, min_uptime=5.0, max_restart_delay=30.0, teardown=None):
+        """
+        Parameters:
+            target: function
+                the function each worker runs after it is forked, called with
+                the number of the worker (0 to workers - 1), the worker exits with status 0 when it returns and 1 when it raises
+            workers: int
+                the number of worker processes
+            min_uptime: float [default=5.0]
+                the number of seconds a worker has to run for its exit to not
+                count as a crash on start up
+            max_restart_delay: float [default=30.0]
+                the longest delay before restarting a worker that keeps crashing
+            teardown: function [default=None]
+                called in each worker before it exits, after its crash was
+                logged, e.g. to stop the worker's logging thread
+        """
+        self.target = target
+        self.workers = workers
+        self.min_uptime = min_uptime
+        self.max_restart_delay = max_restart_delay
+        self.teardown = teardown
+        self.children = {}
+        self.restart_delays = {}
+        self.stopping = False
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        """
+        Starts the workers and supervises them until the supervisor is stopped.
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for number in range(self.workers):
+            self._spawn(number)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            number, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+
+            self.logger.warning("Worker {} (pid {}) exited with status {}, restarting it".format(
+                number, pid, _describe_status(status)))
+            delay = self._restart_delay(number, time.monotonic() - started)
+            if delay:
+                time.sleep(delay)
+            if not self.stopping:
+                self._spawn(number)
+
+        self.logger.info("All workers have stopped")
+
+    def _spawn(self, number):
+        pid = os.fork()
+        if pid == 0:
+            # The worker handles SIGINT and SIGTERM itself
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 0
+            try:
+                self.target(number)
+            except BaseException:
+                self.logger.exception("Worker {} crashed".format(number))
+                code = 1
+            finally:
+                try:
+                    if self.teardown is not None:
+                        self.teardown()
+                finally:
+                    logging.shutdown()
+                    os._exit(code)
+
+        self.logger.info("Started worker {} (pid {})".format(number, pid))
+        self.children[pid] = (number, time.monotonic())
+
+    def _restart_delay(self, number, uptime):
+        if uptime >= self.min_uptime:
+            self.restart_delays.pop(number, None)
+            return 0
+        delay = min(self.restart_delays.get(number, 0.5) * 2, self.max_restart_delay)
+        self.restart_delays[number] = delay
+        return delay
+
+    def _stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        self.logger.info("Stopping {} workers".format(len(self.children)))
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+def _describe_status(status):
+    if os.WIFSIGNALED(status):
+        return "signal {}".format(os.WTERMSIG(status))
+    return os.WEXITSTATUS(status)
@@ -0,0 +1,97 @@
+"""
+Benchmarks the job queue with 1, 4 and 16 concurrent consumers draining the
+same due jobs: each consumer claims a job with find_one_and_update (or
+--batch jobs at a time), then acknowledges it. Checks that every job was
+acknowledged exactly once, then that jobs claimed by a consumer that never
+acknowledges them are claimed again once their lease expires.
+
+The jobs are inserted into the database at FEEDER_MONGO_URI with a feeder id
+of their own and removed afterwards, for example
+    docker run -d -p 27017:27017 mongo
+    export FEEDER_MONGO_URI=mongodb://localhost:27017
+
+Run from the database_api folder with
+    python benchmarks/bench_job_queue.py --jobs 20000
+"""
+
+import argparse, datetime as dt, os, sys, threading, time
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from feeder_api import db_helper
+from feeder_api.job_queue import JobQueue
+
+FEEDER_ID = ObjectId()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the job queue with concurrent consumers")
+    parser.add_argument('--jobs', type=int, default=20000, help='The number of jobs drained per run [default=20000]')
+    parser.add_argument('--consumers', type=int, nargs='+', default=[1, 4, 16],
+                        help='The numbers of concurrent consumers [default=1 4 16]')
+    parser.add_argument('--batch', type=int, default=1, help='The number of jobs claimed at a time [default=1]')
+    return parser.parse_args()
+
+def seed(count):
+    due = dt.datetime.now() - dt.timedelta(minutes=1)
+    for start in range(0, count, 10000):
+        db_helper.jobs.insert_many([{"feederId": FEEDER_ID, "address": "bench-job-queue", "type": "SCHEDULED",
+                                     "time": due, "count": 1} for _ in range(start, min(start + 10000, count))],
+                                   ordered=False)
+
+def consume(queue, batch, acked):
+    query = {"feederId": FEEDER_ID}
+    while True:
+        claimed = queue.claimMany(query, limit=batch)
+        if len(claimed) == 0:
+            return
+        queue.ack(claimed)
+        acked.extend(job["_id"] for job in claimed)
+
+def drain(consumers, count, batch):
+    seed(count)
+    acked = []
+    threads = [threading.Thread(target=consume, args=(JobQueue(db_helper.jobs, owner="bench-%d" % n), batch, acked))
+               for n in range(consumers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    left = db_helper.jobs.count_documents({"feederId": FEEDER_ID})
+    duplicates = len(acked) - len(set(acked))
+    print("{:>9} {:>8} {:>10.2f} {:>11.0f} {:>10} {:>5}".format(
+        consumers, len(acked), elapsed, len(acked) / elapsed, duplicates, left))
+    return duplicates == 0 and len(acked) == count and left == 0
+
+def check_visibility_timeout():
+    seed(100)
+    crashed = JobQueue(db_helper.jobs, owner="bench-crashed", visibilityTimeout=1.0)
+    claimed = crashed.claimMany({"feederId": FEEDER_ID})
+    survivor = JobQueue(db_helper.jobs, owner="bench-survivor")
+    hidden = survivor.claimAll({"feederId": FEEDER_ID})
+    time.sleep(1.5)
+    reclaimed = survivor.claimAll({"feederId": FEEDER_ID})
+    # The crashed consumer's late acknowledgement must not remove the jobs it lost
+    stale = crashed.ack(claimed)
+    acked = survivor.ack(reclaimed)
+    print("visibility timeout: {} claimed, {} visible while leased, {} reclaimed after expiry, {} removed by the stale "
+          "consumer".format(len(claimed), len(hidden), len(reclaimed), stale))
+    return len(claimed) == 100 and len(hidden) == 0 and len(reclaimed) == 100 and stale == 0 and acked == 100
+
+def main():
+    args = parse_args()
+    db_helper.ensureIndexes()
+    ok = True
+    try:
+        print("{:>9} {:>8} {:>10} {:>11} {:>10} {:>5}".format("consumers", "acked", "time (s)", "jobs/s", "duplicates", "left"))
+        for consumers in args.consumers:
+            ok = drain(consumers, args.jobs, args.batch) and ok
+        ok = check_visibility_timeout() and ok
+    finally:
+        db_helper.jobs.delete_many({"feederId": FEEDER_ID})
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
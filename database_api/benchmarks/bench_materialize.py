@@ -0,0 +1,89 @@
+"""
+Benchmarks the daily job materialization of the scheduler with generated
+feeders: the previous approach (every feeder document loaded into a list, the
+feeder fetched again for each schedule item and one insert per feeder) against
+db_helper.materializeDailyJobs with 1 and --workers threads.
+
+The feeders are inserted into the database at FEEDER_MONGO_URI and removed with
+their jobs afterwards. materializeDailyJobs reads every feeder of the database,
+so use an empty local database, for example
+    docker run -d -p 27017:27017 mongo
+    export FEEDER_MONGO_URI=mongodb://localhost:27017
+
+Run from the database_api folder with
+    python benchmarks/bench_materialize.py --feeders 100000
+"""
+
+import argparse, datetime as dt, os, random, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from feeder_api import db_helper
+
+ADDRESS = "bench-materialize"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the daily job materialization")
+    parser.add_argument('--feeders', type=int, default=100000, help='The number of feeders [default=100000]')
+    parser.add_argument('--items', type=int, default=3, help='The number of schedule items per feeder [default=3]')
+    parser.add_argument('--workers', type=int, default=4, help='The number of threads of the parallel run [default=4]')
+    parser.add_argument('--skip_legacy', action='store_true', help='Does not time the previous approach')
+    return parser.parse_args()
+
+def seed(count, items):
+    for start in range(0, count, 10000):
+        batch = []
+        for n in range(start, min(start + 10000, count)):
+            schedule = []
+            for _ in range(items):
+                time_of_day = dt.datetime(2000, 1, 1, random.randrange(24), random.randrange(60))
+                if random.random() < 0.5:
+                    schedule.append({"type": "R", "time": time_of_day, "count": 1, "every": 1, "unit": "days"})
+                else:
+                    schedule.append({"type": "W", "time": time_of_day, "count": 1, "days": random.sample(range(7), 3)})
+            batch.append({"address": ADDRESS, "productKey": "benchmaterialize%d" % n, "password": "",
+                          "status": "OK", "lastFeed": None, "nextFeed": None, "feedSchedule": schedule})
+        db_helper.feeders.insert_many(batch, ordered=False)
+
+def legacy_schedule_jobs():
+    # The scheduler's daily run before materializeDailyJobs
+    allFeeders = list(db_helper.feeders.find())
+    today = dt.datetime.now().date()
+    inserted = 0
+    for feeder in allFeeders:
+        jobsToRun = []
+        for sched in feeder["feedSchedule"]:
+            if db_helper.nextScheduleOccurrence(sched).date() <= today:
+                jobsToRun.append(db_helper.createEventFromScheduleItem(str(feeder["_id"]), sched))
+        if len(jobsToRun) > 0:
+            inserted += db_helper._insertScheduleEvents(jobsToRun)
+    return inserted
+
+def measure(name, run):
+    start = time.perf_counter()
+    inserted = run()
+    elapsed = time.perf_counter() - start
+    db_helper.jobs.delete_many({"address": ADDRESS})
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db_helper.jobs.delete_many({"address": ADDRESS})
+    print("{:<24} {:>8} jobs {:>8.2f}s {:>10.1f} MiB peak".format(name, inserted, elapsed, peak / 2 ** 20))
+
+def main():
+    args = parse_args()
+    random.seed(5506)
+    seed(args.feeders, args.items)
+    try:
+        if not args.skip_legacy:
+            measure("previous scheduleJobs", legacy_schedule_jobs)
+        measure("materializeDailyJobs", lambda: db_helper.materializeDailyJobs())
+        measure("materializeDailyJobs x{}".format(args.workers),
+                lambda: db_helper.materializeDailyJobs(workers=args.workers))
+    finally:
+        db_helper.jobs.delete_many({"address": ADDRESS})
+        db_helper.feeders.delete_many({"address": ADDRESS})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Benchmarks the timer heap of the scheduler with 100k schedule items: the time
+and memory to load them, the time to run a whole day of them, and how soon an
+item added while the engine sleeps is run (the early wake up).
+
+No database is used, but importing db_helper creates a (lazy) MongoDB client,
+so set FEEDER_MONGO_URI, e.g. to mongodb://localhost:27017.
+
+Run from the database_api folder with
+    python benchmarks/bench_schedule_engine.py --items 100000
+"""
+
+import asyncio, datetime as dt, functools, os, random, statistics, sys, threading, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+from feeder_api import db_helper
+from feeder_api.schedule_engine import ScheduleEngine, AsyncScheduleEngine
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the timer heap of the scheduler")
+    parser.add_argument('--items', type=int, default=100000, help='The number of schedule items [default=100000]')
+    parser.add_argument('--wakeups', type=int, default=200, help='The number of early wake ups to time [default=200]')
+    return parser.parse_args()
+
+def generate_items(count):
+    items = []
+    for _ in range(count):
+        time_of_day = dt.datetime(2000, 1, 1, random.randrange(24), random.randrange(60))
+        if random.random() < 0.5:
+            items.append({"type": "R", "time": time_of_day, "count": 1, "every": 1, "unit": "days"})
+        else:
+            items.append({"type": "W", "time": time_of_day, "count": 1, "days": random.sample(range(7), random.randint(1, 7))})
+    return items
+
+def load(engine, items, callback):
+    keys = [("feeder%d" % (index // 4), index % 4) for index in range(len(items))]
+    for key, item in zip(keys, items):
+        engine.schedule(key, functools.partial(db_helper.nextScheduleOccurrence, item), callback)
+    return keys
+
+def bench_load(items, start):
+    clock = lambda: start
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    engine = ScheduleEngine(now=clock)
+    load(engine, items, None)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    engine = ScheduleEngine(now=clock)
+    began = time.perf_counter()
+    load(engine, items, None)
+    elapsed = time.perf_counter() - began
+    print("load {} items: {:.2f}s, {:.1f} MiB ({:.0f} bytes/item)".format(
+        len(items), elapsed, used / 2 ** 20, used / len(items)))
+
+def bench_day(items, start):
+    # The clock is set to the end of the day so the engine runs every item
+    # due in the day back to back, then sleeps until tomorrow.
+    now = [start]
+    engine = ScheduleEngine(now=lambda: now[0])
+    done = threading.Event()
+    expected = [0]
+    ran = [0]
+    def callback(key, when):
+        ran[0] += 1
+        if ran[0] == expected[0]:
+            done.set()
+    keys = load(engine, items, callback)
+    end = start.replace(hour=23, minute=59, second=59)
+    expected[0] = sum(1 for key in keys if engine.nextRun(key) <= end)
+
+    now[0] = end
+    thread = threading.Thread(target=engine.run, daemon=True)
+    began = time.perf_counter()
+    thread.start()
+    done.wait()
+    elapsed = time.perf_counter() - began
+    engine.stop()
+    thread.join()
+    print("run a day of {} items: {:.2f}s ({:.1f} us/item, rescheduled included)".format(
+        ran[0], elapsed, elapsed / ran[0] * 1e6))
+
+def report_wakeups(name, delays):
+    delays = sorted(delays)
+    print("{} early wake up with the next item hours away: median {:.0f} us, p99 {:.0f} us".format(
+        name, statistics.median(delays) * 1e6, delays[int(len(delays) * 0.99) - 1] * 1e6))
+
+def bench_wakeup(items, wakeups):
+    # Real clock, the loaded items are all in the future. Each added item is
+    # due immediately and has to interrupt the engine's sleep.
+    engine = ScheduleEngine()
+    tomorrow = dt.datetime.now() + dt.timedelta(days=1)
+    for index in range(len(items)):
+        engine.schedule(("feeder%d" % index, 0), lambda after: tomorrow, None)
+    ran = threading.Event()
+    thread = threading.Thread(target=engine.run, daemon=True)
+    thread.start()
+    delays = []
+    for n in range(wakeups):
+        time.sleep(0.002)
+        ran.clear()
+        due = dt.datetime.now()
+        added = time.perf_counter()
+        engine.schedule(("added", n), lambda after, due=due: due, lambda key, when: ran.set())
+        ran.wait()
+        delays.append(time.perf_counter() - added)
+    engine.stop()
+    thread.join()
+    report_wakeups("thread", delays)
+
+def bench_async_wakeup(items, wakeups):
+    loop = asyncio.new_event_loop()
+    engine = AsyncScheduleEngine(loop=loop)
+    tomorrow = dt.datetime.now() + dt.timedelta(days=1)
+    for index in range(len(items)):
+        engine.schedule(("feeder%d" % index, 0), lambda after: tomorrow, None)
+
+    async def measure():
+        engine.start()
+        delays = []
+        for n in range(wakeups):
+            await asyncio.sleep(0.002)
+            ran = loop.create_future()
+            due = dt.datetime.now()
+            added = time.perf_counter()
+            engine.schedule(("added", n), lambda after, due=due: due, lambda key, when: ran.set_result(None))
+            await ran
+            delays.append(time.perf_counter() - added)
+        engine.stop()
+        return delays
+
+    report_wakeups("asyncio", loop.run_until_complete(measure()))
+    loop.close()
+
+def main():
+    args = parse_args()
+    random.seed(5506)
+    items = generate_items(args.items)
+    start = dt.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    bench_load(items, start)
+    bench_day(items, start)
+    bench_wakeup(items, args.wakeups)
+    bench_async_wakeup(items, args.wakeups)
+    print("database queries per day while nothing is due: 0 (the polling loop made 1440)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Validates the vectorized next occurrences of schedule_vector against
+db_helper.nextScheduleOccurrence and times both at fleet scale.
+
+The validation compares every generated schedule item at --references random
+reference times, including times exactly at the items' feeding times, at
+midnight and at the end of the day. The timing compares a loop over
+nextScheduleOccurrence with encoding the items and computing them at once, and
+with computing already encoded items (e.g. columns kept between runs).
+
+No database is used, but importing db_helper creates a (lazy) MongoDB client,
+so set FEEDER_MONGO_URI, e.g. to mongodb://localhost:27017.
+
+Run from the database_api folder with "python benchmarks/bench_schedule_vector.py"
+"""
+
+import argparse, datetime as dt, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from feeder_api import db_helper, schedule_vector
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Validates and benchmarks the vectorized schedule occurrences")
+    parser.add_argument('--validate_items', type=int, default=20000, help='The number of items validated [default=20000]')
+    parser.add_argument('--references', type=int, default=50, help='The number of reference times validated [default=50]')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='The numbers of items timed [default=1000 100000 1000000]')
+    return parser.parse_args()
+
+def generate_items(count):
+    items = []
+    for _ in range(count):
+        time_of_day = dt.datetime(2000, 1, 1, random.randrange(24), random.randrange(60))
+        kind = random.random()
+        if kind < 0.4:
+            items.append({"type": "R", "time": time_of_day, "count": 1, "every": random.randint(1, 7), "unit": "days"})
+        elif kind < 0.8:
+            items.append({"type": "W", "time": time_of_day, "count": 1,
+                          "days": random.sample(range(7), random.randint(1, 7))})
+        elif kind < 0.98:
+            items.append({"type": "S", "time": dt.datetime(2026, random.randint(1, 12), random.randint(1, 28),
+                          random.randrange(24), random.randrange(60), random.randrange(60), random.randrange(10 ** 6)),
+                          "count": 1})
+        else:
+            items.append({"type": "R", "time": time_of_day, "count": 1, "every": 2, "unit": "weeks"})
+    return items
+
+def reference_times(items, count):
+    times = []
+    for _ in range(count):
+        day = dt.datetime(2026, 1, 1) + dt.timedelta(days=random.randrange(730))
+        choice = random.random()
+        if choice < 0.3:
+            # Exactly at the feeding time of an item
+            item = random.choice(items)
+            times.append(day.replace(hour=item["time"].hour, minute=item["time"].minute))
+        elif choice < 0.4:
+            times.append(day)
+        elif choice < 0.5:
+            times.append(day.replace(hour=23, minute=59, second=59, microsecond=999999))
+        else:
+            times.append(day + dt.timedelta(seconds=random.randrange(86400), microseconds=random.randrange(10 ** 6)))
+    return times
+
+def validate(count, references):
+    items = generate_items(count)
+    columns = schedule_vector.encodeScheduleItems(items)
+    mismatches = 0
+    for now in reference_times(items, references):
+        vectorized = schedule_vector.nextOccurrences(columns, now).tolist()
+        for item, expected, actual in zip(items, (db_helper.nextScheduleOccurrence(item, now) for item in items), vectorized):
+            if expected != actual:
+                mismatches += 1
+                if mismatches <= 5:
+                    print("mismatch at {}: {} scalar {} vectorized {}".format(now, item, expected, actual))
+    print("validated {} items at {} reference times: {} mismatches".format(count, references, mismatches))
+    return mismatches == 0
+
+def best_of(repeat, function):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench(count):
+    items = generate_items(count)
+    now = dt.datetime.now()
+    repeat = 5 if count <= 100000 else 1
+    scalar = best_of(repeat, lambda: [db_helper.nextScheduleOccurrence(item, now) for item in items])
+    encoded = best_of(repeat, lambda: schedule_vector.nextScheduleOccurrences(items, now))
+    columns = schedule_vector.encodeScheduleItems(items)
+    vectorized = best_of(repeat, lambda: schedule_vector.nextOccurrences(columns, now))
+    print("{:>9} {:>12.1f} {:>16.1f} {:>15.1f} {:>9.1f}x".format(
+        count, scalar * 1e3, encoded * 1e3, vectorized * 1e3, scalar / vectorized))
+
+def main():
+    args = parse_args()
+    random.seed(5506)
+    if not validate(args.validate_items, args.references):
+        sys.exit(1)
+    print("{:>9} {:>12} {:>16} {:>15} {:>10}".format("items", "scalar (ms)", "encode+vec (ms)", "vectorized (ms)", "speedup"))
+    for count in args.sizes:
+        bench(count)
+
+if __name__ == "__main__":
+    main()
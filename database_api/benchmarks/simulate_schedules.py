@@ -0,0 +1,194 @@
+"""
+Replays weeks of schedules for synthetic feeders in virtual time: the real
+scheduler (feeder_api.scheduler.Scheduler) runs against the database with a
+VirtualClock set as the clock of feeder_api, and the clock jumps straight to
+the next due entry of the schedule engine instead of sleeping. Every job of
+every day is created at the virtual midnight and dispatched at its virtual
+time, going through the same database calls as in production.
+
+Reports the jobs generated per second of real time, how much faster than real
+time the weeks were replayed, and the number of database round trips (every
+command sent to MongoDB, counted with a pymongo command listener) in total, per
+job and per command. The dispatched jobs are checked against the occurrences
+expected from nextScheduleOccurrence.
+
+A single (one off) feed is also booked on the first feeder at 09:00 of the
+first day for 15:00, the way the website books one (addScheduleItem), after
+the scheduler started. It is handed to the scheduler as its single job
+watcher would (the change stream cannot follow virtual time) and must be
+dispatched at 15:00 exactly.
+
+The feeders are inserted into the database at FEEDER_MONGO_URI and removed with
+their jobs and logs afterwards. The scheduler reads every feeder and takes the
+scheduler leases of the database, so use an empty local database, for example
+    docker run -d -p 27017:27017 mongo
+    export FEEDER_MONGO_URI=mongodb://localhost:27017
+
+Run from the database_api folder with
+    python benchmarks/simulate_schedules.py --feeders 1000 --weeks 2
+"""
+
+import argparse, collections, datetime as dt, os, random, sys, time
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from feeder_api import clock, db_helper
+from feeder_api.partition_leases import PartitionLeases
+from feeder_api.schedule_engine import ScheduleEngine
+from feeder_api.scheduler import Scheduler
+
+ADDRESS = "simulate-schedules"
+OWNER = "simulate-schedules"
+
+class RoundTripCounter(monitoring.CommandListener):
+    """
+    Counts the commands sent to MongoDB by name.
+    """
+
+    def __init__(self):
+        self.commands = collections.Counter()
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replays weeks of feeder schedules in virtual time")
+    parser.add_argument('--feeders', type=int, default=1000, help='The number of synthetic feeders [default=1000]')
+    parser.add_argument('--items', type=int, default=3, help='The number of schedule items per feeder [default=3]')
+    parser.add_argument('--weeks', type=float, default=2, help='The number of weeks replayed [default=2]')
+    parser.add_argument('--resync_interval', type=float, default=86400,
+                        help='The virtual seconds between reloads of every schedule [default=86400]')
+    parser.add_argument('--lease_ttl', type=float, default=10800,
+                        help='The virtual seconds of the partition leases, heartbeats every third [default=10800]')
+    parser.add_argument('--seed', type=int, default=5506, help='The seed of the synthetic schedules [default=5506]')
+    return parser.parse_args()
+
+def generate_schedule(count, start, end):
+    schedule = []
+    for _ in range(count):
+        time_of_day = dt.datetime(2000, 1, 1, random.randrange(24), random.randrange(60))
+        kind = random.random()
+        if kind < 0.45:
+            schedule.append({"type": "R", "time": time_of_day, "count": 1, "every": random.randint(1, 3), "unit": "days"})
+        elif kind < 0.9:
+            schedule.append({"type": "W", "time": time_of_day, "count": 1,
+                             "days": random.sample(range(7), random.randint(1, 7))})
+        else:
+            offset = random.randrange(int((end - start).total_seconds()))
+            schedule.append({"type": "S", "time": start + dt.timedelta(seconds=offset), "count": 1})
+    return schedule
+
+def seed(count, items, start, end):
+    schedules = []
+    for first in range(0, count, 10000):
+        batch = []
+        for n in range(first, min(first + 10000, count)):
+            schedule = generate_schedule(items, start, end)
+            schedules.append(schedule)
+            batch.append({"address": ADDRESS, "productKey": "simulate%d" % n, "password": "", "status": "OK",
+                          "lastFeed": None, "nextFeed": None, "feedSchedule": schedule})
+        db_helper.feeders.insert_many(batch, ordered=False)
+    feederIds = [feeder["_id"] for feeder in db_helper.feeders.find({"address": ADDRESS}, projection={"_id": 1})]
+    return feederIds, schedules
+
+def expected_jobs(schedules, start, end):
+    expected = 0
+    for schedule in schedules:
+        for item in schedule:
+            after = start
+            while True:
+                when = db_helper.nextScheduleOccurrence(item, after)
+                if when is None or when < after or when >= end:
+                    break
+                expected += 1
+                if item["type"] == "S":
+                    break
+                after = when + dt.timedelta(microseconds=1)
+    return expected
+
+def replay(virtual, engine, end):
+    steps = 0
+    while True:
+        when = engine.nextDue()
+        if when is None or when >= end:
+            return steps
+        if when > virtual.now():
+            virtual.set(when)
+        engine.runPending()
+        steps += 1
+
+def book_single_job(scheduler, feederId, when):
+    db_helper.addScheduleItem(feederId, scheduleType="S", time=when, count=1)
+    # What Scheduler._watchSingleJobs does with the job inserted by addScheduleItem
+    scheduler.scheduleSingleJob(str(feederId), when)
+
+def cleanup(feederIds):
+    db_helper.jobs.delete_many({"feederId": {"$in": feederIds} })
+    db_helper.feedLogs.delete_many({"feederId": {"$in": feederIds} })
+    db_helper.feeders.delete_many({"address": ADDRESS})
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    start = dt.datetime.combine(dt.date.today(), dt.time())
+    end = start + dt.timedelta(weeks=args.weeks)
+
+    virtual = clock.VirtualClock(start)
+    previous = clock.setClock(virtual)
+    counter = RoundTripCounter()
+    monitoring.register(counter)
+    # The listener only sees the clients created after it was registered
+    db_helper.reconnect()
+
+    feederIds = []
+    leases = PartitionLeases(OWNER, ttl=args.lease_ttl)
+    try:
+        db_helper.ensureIndexes()
+        feederIds, schedules = seed(args.feeders, args.items, start, end)
+        expected = expected_jobs(schedules, start, end)
+        booked_at, booked_for = start + dt.timedelta(hours=9), start + dt.timedelta(hours=15)
+        expected += booked_for < end
+
+        engine = ScheduleEngine()
+        scheduler = Scheduler(resyncInterval=args.resync_interval, engine=engine, leases=leases)
+        counter.commands.clear()
+        began = time.perf_counter()
+        scheduler.start()
+        # Scheduler.run renews the leases from a thread of its own, which cannot follow virtual time
+        engine.schedule("heartbeat", lambda after: after + dt.timedelta(seconds=args.lease_ttl / 3),
+                        lambda key, when: scheduler.heartbeat())
+        engine.schedule("bookSingleJob", lambda after: booked_at if after <= booked_at else None,
+                        lambda key, when: book_single_job(scheduler, feederIds[0], booked_for))
+        steps = replay(virtual, engine, end)
+        elapsed = time.perf_counter() - began
+        roundTrips = sum(counter.commands.values())
+
+        dispatched = db_helper.feedLogs.count_documents({"feederId": {"$in": feederIds} })
+        queued = db_helper.jobs.count_documents({"feederId": {"$in": feederIds} })
+        generated = dispatched + queued
+        print("replayed {} of {} feeders ({} schedule items) in {:.2f}s, {:.0f}x real time, {} engine steps".format(
+            end - start, len(feederIds), sum(len(schedule) for schedule in schedules), elapsed,
+            (end - start).total_seconds() / elapsed, steps))
+        print("jobs: {} generated ({:.0f}/s), {} dispatched, {} left queued, {} expected".format(
+            generated, generated / elapsed, dispatched, queued, expected))
+        booked = db_helper.feedLogs.find_one({"feederId": feederIds[0], "type": "S", "time": booked_for})
+        print("single job booked at {} for {}: {}".format(booked_at, booked_for,
+                                                           "dispatched on time" if booked else "NOT dispatched on time"))
+        print("round trips: {} ({:.2f} per job)".format(roundTrips, roundTrips / max(1, generated)))
+        for name, count in counter.commands.most_common():
+            print("    {:<16} {:>10}".format(name, count))
+        if dispatched != expected or (booked_for < end and booked is None):
+            sys.exit(1)
+    finally:
+        leases.releaseAll()
+        cleanup(feederIds)
+        clock.setClock(previous)
+
+if __name__ == "__main__":
+    main()
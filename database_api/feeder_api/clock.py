@@ -0,0 +1,76 @@
+"""
+The clock the scheduling and logging paths read the current time from.
+
+Every "now" of db_helper, the scheduler and the schedule engine, and of the CoAP server's consumption logging, job
+index and feeder wake-ups, comes from now() in this module, which asks the clock set with setClock, the system clock
+by default. A VirtualClock set instead makes the whole scheduler run in virtual
+time, e.g. to replay weeks of schedules in seconds (see benchmarks/simulate_schedules.py) or to test a schedule at a
+given time of the day.
+
+The times are naive datetimes in local time, like the schedules.
+"""
+
+import datetime as dt
+
+class SystemClock:
+    """
+        The time of the system clock.
+    """
+
+    def now(self):
+        return dt.datetime.now()
+
+class VirtualClock:
+    """
+        A clock that only moves when it is told to. Time cannot go backwards, as the scheduler never expects it to.
+
+        Intance Variables:
+            current:
+                The current virtual time
+    """
+
+    def __init__(self, start=None):
+        """
+            start (datetime): the initial time, the time of the system clock if None
+        """
+        self.current = start or dt.datetime.now()
+
+    def now(self):
+        return self.current
+
+    def set(self, when):
+        """
+            Moves the clock forward to when.
+        """
+        if when < self.current:
+            raise ValueError("Cannot move a virtual clock back from {} to {}".format(self.current, when))
+        self.current = when
+
+    def advance(self, seconds):
+        """
+            Moves the clock forward by a number of seconds (or a timedelta) and returns the new time.
+        """
+        if not isinstance(seconds, dt.timedelta):
+            seconds = dt.timedelta(seconds=seconds)
+        self.set(self.current + seconds)
+        return self.current
+
+_clock = SystemClock()
+
+def now():
+    """
+        Gets the current time of the clock in use.
+    """
+    return _clock.now()
+
+def getClock():
+    return _clock
+
+def setClock(clock):
+    """
+        Replaces the clock in use, for the whole process. Returns the previous clock so it can be restored.
+    """
+    global _clock
+    previous = _clock
+    _clock = clock if clock is not None else SystemClock()
+    return previous
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class CredentialCache:
+    """
+        Bounded, TTL-evicting cache of feeder credentials that were successfully verified with bcrypt.
+
+        Entries are keyed by a keyed BLAKE2b digest of the product key, the secret the device sent and the
+        stored password hash, so the plaintext secret is never kept in memory and a feeder that is re-provisioned
+        with a new password (new stored hash) can never hit an old entry. The digest key is random per process.
+
+        The cache is thread safe as it is used from the worker threads of the CoAP server.
+    """
+
+    def __init__(self, maxSize=10000, ttl=300):
+        """
+            maxSize (int): the maximum number of verified credentials kept, least recently used are evicted first
+            ttl (float): the number of seconds a verified credential is trusted for
+        """
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._key = os.urandom(32)
+        self._entries = OrderedDict() # digest -> (productKey, expiresAt)
+        self._byProductKey = {}       # productKey -> set of digests
+        self._lock = threading.Lock()
+
+    def _digest(self, productKey, secret, passwordHash):
+        h = hashlib.blake2b(key=self._key, digest_size=16)
+        for part in (productKey, secret, passwordHash):
+            data = str(part).encode('utf-8')
+            h.update(len(data).to_bytes(4, 'big'))
+            h.update(data)
+        return h.digest()
+
+    def contains(self, productKey, secret, passwordHash):
+        """
+            Checks if the credentials were verified within the last ttl seconds. Counts a hit or a miss.
+        """
+        digest = self._digest(productKey, secret, passwordHash)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return True
+            if entry is not None:
+                self._remove(digest)
+            self.misses += 1
+            return False
+
+    def add(self, productKey, secret, passwordHash):
+        """
+            Remembers credentials that were successfully verified.
+        """
+        if self.maxSize <= 0:
+            return
+        digest = self._digest(productKey, secret, passwordHash)
+        with self._lock:
+            if digest in self._entries:
+                self._remove(digest)
+            self._entries[digest] = (productKey, time.monotonic() + self.ttl)
+            self._byProductKey.setdefault(productKey, set()).add(digest)
+            while len(self._entries) > self.maxSize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, productKey):
+        """
+            Forgets every verified credential of a product key. Returns the number of entries removed.
+        """
+        with self._lock:
+            digests = list(self._byProductKey.get(productKey, ()))
+            for digest in digests:
+                self._remove(digest)
+            return len(digests)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._byProductKey.clear()
+
+    def stats(self):
+        """
+            Returns the counters used for sizing the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries),
+                    "maxSize": self.maxSize,
+                    "ttl": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hitRatio": self.hits / lookups if lookups else 0.0
+                    }
+
+    def _remove(self, digest):
+        """
+            Removes an entry. Caller must hold the lock.
+        """
+        productKey, _ = self._entries.pop(digest)
+        digests = self._byProductKey.get(productKey)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._byProductKey[productKey]
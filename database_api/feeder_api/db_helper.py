@@ -1,4 +1,5 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pymongo.collection import ReturnDocument
 from bson import ObjectId
 import bcrypt
@@ -6,15 +7,57 @@ import bcrypt
 from pprint import pprint
 from random import randint, randrange
 import datetime as dt
+import hashlib
+import os
+import zlib
+from time import perf_counter
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .credential_cache import CredentialCache
+from . import clock, indexes, schedule_vector
+from .job_queue import JobQueue, expiresAt, readyQuery, unclaimedQuery
 
 _FEEDER_PATCHABLE = ["address", "status", "lastFeed", "nextFeed"]
 _USER_PATCHABLE = ["email", "name"]
 _USER_FEEDER_PATCHABLE = ["name", "description", "notifySuccess", "notifyFailure"]
 _SCHEDULE_ITEM_DELETE_CRITERIA = ["type", "every", "unit", "time", "count", "days"]
 _EVENT_PROPERTIES = ["feederId", "address", "type", "time", "count"]
+_FEEDER_AUTH_PROJECTION = {"_id": 1, "password": 1, "status": 1}
+_FEEDER_REGISTRY_PROJECTION = {"_id": 1, "productKey": 1, "password": 1, "status": 1}
+_FEEDER_SCHEDULE_PROJECTION = {"_id": 1, "address": 1, "feedSchedule": 1}
+# The number of feeders whose next occurrences are computed together when materializing the daily jobs
+_MATERIALIZE_CHUNK = 1000
+# The number of schedule items from which the vectorized next occurrences are faster than a loop
+_VECTOR_MIN_ITEMS = 64
+
+# The number of hash partitions the feeders are split into between scheduler workers. Stored in each feeder, so it
+# cannot change without reassigning every feeder.
+SCHEDULER_PARTITIONS = 64
+
+# The minimal feeder record returned when a device authenticates
+FeederAuth = namedtuple("FeederAuth", ["id", "status"])
+
+class PartialWriteError(Exception):
+    """
+        Raised when only some of the writes of a batch were applied.
+
+        Intance Variables:
+            failed:
+                The values whose writes were not applied, in the same form as the values given (e.g. (feederId, hour)
+                to amount), so that only they are written again
+    """
+
+    def __init__(self, message, failed):
+        super().__init__(message)
+        self.failed = failed
+
 
+# FEEDER_MONGO_URI points the API at another deployment, e.g. a local mongod for benchmarks
+_MONGO_URI = os.environ.get("FEEDER_MONGO_URI",
+    "mongodb+srv://<MongoDB username>:<MongoDB password>@<MongoDB address>/<dbname>?retryWrites=true&w=majority")
 
-_client = MongoClient("mongodb+srv://<MongoDB username>:<MongoDB password>@<MongoDB address>/<dbname>?retryWrites=true&w=majority")
+_client = MongoClient(_MONGO_URI)
 
 _db = _client["smartfeeder"]
 feeders = _db["feeders"]
@@ -22,6 +65,45 @@ users = _db["users"]
 jobs = _db["jobs_scheduled"]
 feedLogs = _db["feeding_logs"]
 hourlyLogs = _db["hourly_consumption"]
+dailyLogs = _db["daily_consumption"]
+schedulerLeases = _db["scheduler_leases"]
+schedulerWorkers = _db["scheduler_workers"]
+
+# The number of seconds a dispatched job stays claimed before another consumer can dispatch it again, in case the
+# consumer that claimed it died before removing it
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get("FEEDER_JOB_VISIBILITY_TIMEOUT", 60))
+# The number of seconds after their time that undelivered jobs are removed from the job queue (by a TTL index on their
+# expireAt, see indexes.py), e.g. the jobs of a feeder that was offline
+JOB_EXPIRY_HORIZON = int(os.environ.get("FEEDER_JOB_EXPIRY_HORIZON", 86400))
+jobQueue = JobQueue(jobs, visibilityTimeout=JOB_VISIBILITY_TIMEOUT, expiryHorizon=JOB_EXPIRY_HORIZON)
+
+def reconnect():
+    """
+        Replaces the MongoDB client with a new one. MongoClient is not fork safe, so processes forked after the client was
+        created (e.g. the CoAP server workers) have to call this before using the database. The inherited client is left
+        alone as its sockets are shared with the parent process.
+    """
+    global _client, _db, feeders, users, jobs, feedLogs, hourlyLogs, dailyLogs, schedulerLeases, schedulerWorkers, jobQueue
+    _client = MongoClient(_MONGO_URI, connect=False)
+    _db = _client["smartfeeder"]
+    feeders = _db["feeders"]
+    users = _db["users"]
+    jobs = _db["jobs_scheduled"]
+    feedLogs = _db["feeding_logs"]
+    hourlyLogs = _db["hourly_consumption"]
+    dailyLogs = _db["daily_consumption"]
+    schedulerLeases = _db["scheduler_leases"]
+    schedulerWorkers = _db["scheduler_workers"]
+    # A new consumer, the forked process has its own pid
+    jobQueue = JobQueue(jobs, visibilityTimeout=JOB_VISIBILITY_TIMEOUT, expiryHorizon=JOB_EXPIRY_HORIZON)
+
+# Storage layout of the ongoing consumption logs, "hourly" (one document per feeder per hour) or
+# "daily" (one document per feeder per day holding 24 hourly slots). See readme.md.
+CONSUMPTION_LAYOUT = os.environ.get("FEEDER_CONSUMPTION_LAYOUT", "hourly")
+
+# Feeder credentials that passed bcrypt recently, so polling devices are not re-hashed on every request
+_credentialCache = CredentialCache(maxSize=int(os.environ.get("FEEDER_AUTH_CACHE_SIZE", 10000)),
+                                    ttl=float(os.environ.get("FEEDER_AUTH_CACHE_TTL", 300)))
 
 def _createHash(password):
     """
@@ -29,6 +111,17 @@ def _createHash(password):
     """
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
+def _checkFeederPassword(productKey, password, passwordHash):
+    """
+        Checks a feeder's password against its stored hash, skipping bcrypt if the same credentials were verified recently.
+    """
+    if _credentialCache.contains(productKey, password, passwordHash):
+        return True
+    if not bcrypt.checkpw(password.encode('utf-8'), passwordHash.encode('utf-8')):
+        return False
+    _credentialCache.add(productKey, password, passwordHash)
+    return True
+
 
 #-FUNCTION-DEFINITIONS---------------------------------------------------------------------------------------------------------------------------------------------------------
 # Feeders
@@ -41,24 +134,219 @@ def insertFeeder(address, productKey, password):
         return False
 
     hash =  _createHash(password)
+    _credentialCache.invalidate(productKey)
 
-    feeder = {  "address": address,
+    feederId = ObjectId()
+    feeder = {  "_id": feederId,
+                "address": address,
                 "productKey": productKey,
                 "password": hash,
                 "status": "OK",
                 "lastFeed": None,
                 "nextFeed": None,
                 "feedSchedule": [],
+                "partition": feederPartition(feederId),
             }
-    insertResult = feeders.insert_one(feeder)
+    try:
+        insertResult = feeders.insert_one(feeder)
+    except DuplicateKeyError:
+        # The product key is already taken (unique index)
+        return False
     feeder["_id"] = str(insertResult.inserted_id)
     return feeder
 
+def hashFeederPassword(password):
+    """
+        Hashes the password of a new feeder with a salt of its own, for insertFeeders.
+    """
+    return _createHash(password)
+
+def newFeederCredentials(credentials):
+    """
+        Gets the (productKey, password) pairs of credentials that insertFeeders would insert: valid ones whose product
+        key does not exist yet, the first of each product key.
+    """
+    credentials = [(key, password) for key, password in credentials if isValidProductKey(key, password)]
+    existing = {feeder["productKey"] for feeder in
+        feeders.find({"productKey": {"$in": [key for key, _ in credentials]}}, projection={"productKey": 1})}
+
+    newCredentials = []
+    for productKey, password in credentials:
+        if productKey in existing:
+            continue
+        existing.add(productKey)
+        newCredentials.append((productKey, password))
+    return newCredentials
+
+def insertFeeders(credentials, address=None, hashes=None):
+    """
+        Enters many new feeders into the database at once, e.g. to provision a batch of devices.
+
+        Takes a list of (productKey, password) pairs. Product keys that already exist are skipped. Every password is
+        hashed with a salt of its own, even when devices share it. hashes holds the hashFeederPassword of each pair if
+        they were computed elsewhere, e.g. spread over the worker threads of an AsyncDatabase with newFeederCredentials,
+        otherwise the passwords are hashed one after the other in the calling thread.
+        Returns the number of feeders inserted.
+    """
+    # The hash of the first pair of each product key, the one that is inserted
+    hashOf = {}
+    for (productKey, _), passwordHash in zip(credentials, hashes or []):
+        hashOf.setdefault(productKey, passwordHash)
+    newFeeders = []
+    for productKey, password in newFeederCredentials(credentials):
+        passwordHash = hashOf.get(productKey) or _createHash(password)
+        _credentialCache.invalidate(productKey)
+        feederId = ObjectId()
+        newFeeders.append({ "_id": feederId,
+                            "address": address,
+                            "productKey": productKey,
+                            "password": passwordHash,
+                            "status": "OK",
+                            "lastFeed": None,
+                            "nextFeed": None,
+                            "feedSchedule": [],
+                            "partition": feederPartition(feederId),
+                        })
+    if not newFeeders:
+        return 0
+    try:
+        return len(feeders.insert_many(newFeeders, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        # Product keys inserted by someone else in the meantime are skipped too
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+        return e.details["nInserted"]
+
 def verifyFeeder(feederId, feederPass):
     feeder = getFeeder(feederId)
     if not feeder:
         return False
-    return bcrypt.checkpw(feederPass.encode('utf-8'), feeder['password'].encode('utf-8'))
+    return _checkFeederPassword(feeder["productKey"], feederPass, feeder["password"])
+
+def authenticateFeeder(productKey, feederPass, timings=None):
+    """
+        Authenticates a device by its product key and password with a single query.
+
+        Only the id, password hash and status of the feeder are fetched. Returns a FeederAuth(id, status)
+        with the feeder's id as a string, or None if the product key is unknown or the password is wrong.
+        If a timings dictionary is given, the seconds spent on the lookup and on the password check are
+        stored in it under "lookup" and "verify".
+    """
+    start = perf_counter()
+    feeder = feeders.find_one({"productKey": productKey}, projection=_FEEDER_AUTH_PROJECTION)
+    if timings is not None:
+        found = perf_counter()
+        timings["lookup"] = found - start
+    if feeder == None:
+        return None
+    valid = _checkFeederPassword(productKey, feederPass, feeder["password"])
+    if timings is not None:
+        timings["verify"] = perf_counter() - found
+    if not valid:
+        return None
+    return FeederAuth(str(feeder["_id"]), feeder.get("status"))
+
+def checkFeederPassword(productKey, feederPass, passwordHash):
+    """
+        Checks a feeder's password against a password hash that was already fetched, e.g. from an in-memory
+        registry of the feeders. Uses the verified credential cache before bcrypt.
+    """
+    return _checkFeederPassword(productKey, feederPass, passwordHash)
+
+def getFeederAuthRecords(afterId=None, limit=10000):
+    """
+        Gets (id, productKey, passwordHash, status) of up to limit feeders in _id order, starting after the
+        feeder with the id afterId (from the first feeder if None). Used to load and incrementally refresh
+        an in-memory registry of the feeders, page by page.
+    """
+    query = {} if afterId == None else {"_id": {"$gt": ObjectId(afterId)}}
+    cursor = feeders.find(query, projection=_FEEDER_REGISTRY_PROJECTION, sort=[("_id", ASCENDING)], limit=limit)
+    return [(str(feeder["_id"]), feeder["productKey"], feeder["password"], feeder.get("status")) for feeder in cursor]
+
+def getFeederAuthRecordsByIds(ids):
+    """
+        Gets (id, productKey, passwordHash, status) of the feeders with the given ids that exist.
+    """
+    cursor = feeders.find({"_id": {"$in": [ObjectId(id) for id in ids]} }, projection=_FEEDER_REGISTRY_PROJECTION)
+    return [(str(feeder["_id"]), feeder["productKey"], feeder["password"], feeder.get("status")) for feeder in cursor]
+
+def getFeederAuthRecordsByKeys(productKeys):
+    """
+        Gets (id, productKey, passwordHash, status) of the feeders with the given product keys that exist, in one query.
+    """
+    cursor = feeders.find({"productKey": {"$in": list(productKeys)} }, projection=_FEEDER_REGISTRY_PROJECTION)
+    return [(str(feeder["_id"]), feeder["productKey"], feeder["password"], feeder.get("status")) for feeder in cursor]
+
+def getFeederIds(afterId=None, limit=100000):
+    """
+        Gets the ids of up to limit feeders in _id order, starting after the feeder with the id afterId (from the first
+        feeder if None). Only reads the _id index. Used to find the feeders an in-memory registry is missing and the
+        ones that were deleted, page by page.
+    """
+    query = {} if afterId == None else {"_id": {"$gt": ObjectId(afterId)}}
+    cursor = feeders.find(query, projection={"_id": 1}, sort=[("_id", ASCENDING)], limit=limit)
+    return [str(feeder["_id"]) for feeder in cursor]
+
+def getFeederAuthRecord(productKey):
+    """
+        Gets (id, productKey, passwordHash, status) of the feeder with the product key, or None if it does not exist.
+    """
+    feeder = feeders.find_one({"productKey": productKey}, projection=_FEEDER_REGISTRY_PROJECTION)
+    if feeder == None:
+        return None
+    return (str(feeder["_id"]), feeder["productKey"], feeder["password"], feeder.get("status"))
+
+def watchFeederAuthRecords(onOpen=None):
+    """
+        Yields (feederId, record) whenever a feeder is added or its product key, password or status changes, record
+        being (id, productKey, passwordHash, status) as in getFeederAuthRecords, and (feederId, None) when a feeder is
+        deleted. Used to keep an in-memory registry of the feeders current.
+
+        Blocks while waiting for changes. Uses a MongoDB change stream so the database must be a replica set (eg. Atlas).
+        onOpen is called once the change stream is open, every change made after that call is yielded.
+    """
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]} } },
+                {"$project": {"operationType": 1, "documentKey": 1, "updateDescription": 1, "fullDocument.productKey": 1,
+                              "fullDocument.password": 1, "fullDocument.status": 1} }]
+    with feeders.watch(pipeline, full_document="updateLookup") as stream:
+        if onOpen != None:
+            onOpen()
+        for change in stream:
+            feederId = str(change["documentKey"]["_id"])
+            if change["operationType"] == "delete":
+                yield feederId, None
+                continue
+            if change["operationType"] == "update":
+                description = change.get("updateDescription", {})
+                changed = list(description.get("updatedFields", {})) + description.get("removedFields", [])
+                if not any(field.split(".")[0] in _FEEDER_REGISTRY_PROJECTION for field in changed):
+                    continue
+            feeder = change.get("fullDocument")
+            # The feeder was deleted before its update was looked up, the delete follows
+            if feeder != None:
+                yield feederId, (feederId, feeder["productKey"], feeder["password"], feeder.get("status"))
+
+def authenticateFeeders(credentials):
+    """
+        Authenticates many devices with a single query, see authenticateFeeder.
+
+        "credentials" is a list of (productKey, password) pairs. Returns a list in the same order holding a
+        FeederAuth(id, status) for every pair that is valid and None for the others.
+    """
+    productKeys = list({productKey for productKey, _ in credentials})
+    if len(productKeys) == 0:
+        return []
+    projection = dict(_FEEDER_AUTH_PROJECTION, productKey=1)
+    found = {feeder["productKey"]: feeder for feeder in feeders.find({"productKey": {"$in": productKeys} }, projection=projection)}
+
+    results = []
+    for productKey, feederPass in credentials:
+        feeder = found.get(productKey)
+        if feeder == None or not _checkFeederPassword(productKey, feederPass, feeder["password"]):
+            results.append(None)
+        else:
+            results.append(FeederAuth(str(feeder["_id"]), feeder.get("status")))
+    return results
 
 def getFeeder(feederId):
     """
@@ -97,6 +385,16 @@ def updateFeeder(feederId, **kwargs):
     updatedUser = feeders.find_one_and_update({"_id": ObjectId(feederId)}, {"$set": patch }, return_document=ReturnDocument.AFTER)
     return updatedUser
 
+def updateFeederStatuses(statuses):
+    """
+        Sets the status of many feeders in a single round trip. "statuses" maps feeder id to its new status.
+    """
+    if len(statuses) == 0:
+        return 0
+    result = feeders.bulk_write([UpdateOne({"_id": ObjectId(feederId)}, {"$set": {"status": status} })
+                                    for feederId, status in statuses.items()], ordered=False)
+    return result.modified_count
+
 def checkFeederIsValid(productKey, password, feederId=None):
     """
         Checks if a feeder and its productKey-password pair exist in the database. Returns feeder if one found.
@@ -117,9 +415,12 @@ def deleteFeeder(feederId):
 
         WARNING/TODO - Does not delete associated events and logged information.
     """
-    deleteResult = feeders.delete_one({"_id": ObjectId(feederId)})
+    deleted = feeders.find_one_and_delete({"_id": ObjectId(feederId)}, projection={"productKey": 1})
     #TODO delete relevant logs & events etc.
-    return deleteResult.deleted_count == 1
+    if deleted is None:
+        return False
+    _credentialCache.invalidate(deleted.get("productKey"))
+    return True
 
 def addScheduleItem(feederId, item=None, scheduleType="R", time=dt.datetime(2000, 1, 1, 12), count=1, **kwargs):
     """
@@ -154,7 +455,7 @@ def addScheduleItem(feederId, item=None, scheduleType="R", time=dt.datetime(2000
     updateFeederNextFeed(feederId)
 
     # add to job queue if it is due later today
-    if nextScheduleOccurrence(scheduleItem).date() <= dt.datetime.now().date():
+    if nextScheduleOccurrence(scheduleItem).date() <= clock.now().date():
         event = createEventFromScheduleItem(feederId, scheduleItem)
         _insertScheduleEvents([event])
 
@@ -202,15 +503,129 @@ def getNextFeederFeed(feederId=None, feeder=None):
 
 def getReadyEvents():
     """MOVE TO DB_HELPER"""
-    events = list( jobs.find({"time": {"$lte": dt.datetime.now()} }) )
+    events = list( jobs.find(readyQuery(clock.now())) )
     for event in events:
         event["_id"] = str(event["_id"])
         event["feederId"] = str(event["feederId"])
     return events
 
 def getReadyEventsForFeeder(feeder_id):
-    events = getReadyEvents()
-    return [ev for ev in events if ev["feederId"] == feeder_id]
+    """
+        Gets the jobs of a single feeder that are due now.
+
+        Uses the (feederId, time) index so the cost depends only on the feeder's own jobs.
+    """
+    events = list( jobs.find(readyQuery(clock.now(), {"feederId": ObjectId(feeder_id)})) )
+    for event in events:
+        event["_id"] = str(event["_id"])
+        event["feederId"] = str(event["feederId"])
+    return events
+
+def hasReadyEventsForFeeder(feeder_id):
+    """
+        Checks if a feeder has any jobs due now without fetching them (the common "nothing due" answer).
+    """
+    event = jobs.find_one(readyQuery(clock.now(), {"feederId": ObjectId(feeder_id)}), projection={"_id": 1})
+    return event != None
+
+def getNextEventTimeForFeeder(feeder_id):
+    """
+        Gets the time of the earliest job of a feeder that has not been dispatched, or None if there is none.
+    """
+    event = jobs.find_one(unclaimedQuery(clock.now(), {"feederId": ObjectId(feeder_id)}),
+                            projection={"_id": 0, "time": 1}, sort=[("time", ASCENDING)])
+    return event["time"] if event != None else None
+
+def getPendingEventTimes(eventType=None, leased=False):
+    """
+        Gets (feederId, time) of every job in the job queue that has not been dispatched yet, only of the jobs of
+        eventType (e.g. "S") if given.
+
+        The jobs held by a consumer are left out, unless leased is set, in which case they are given with the time
+        their lease expires if it is later than theirs: they are only dispatched again if the consumer dies.
+
+        Only the two fields (and the lease) are fetched, e.g. to build an in-memory index of the job queue.
+    """
+    query = {"type": eventType} if eventType is not None else None
+    if not leased:
+        cursor = jobs.find(unclaimedQuery(clock.now(), query), projection={"_id": 0, "feederId": 1, "time": 1})
+        return [(str(event["feederId"]), event["time"]) for event in cursor]
+    cursor = jobs.find(query or {}, projection={"_id": 0, "feederId": 1, "time": 1, "owner": 1, "leaseExpires": 1})
+    return [(str(event["feederId"]), _claimableTime(event)) for event in cursor]
+
+def _claimableTime(event):
+    # The time a job can be claimed, the end of its lease if it is held past its time
+    if event.get("owner") is not None and event.get("leaseExpires") is not None:
+        return max(event["time"], event["leaseExpires"])
+    return event["time"]
+
+def watchScheduledEvents(onOpen=None, eventType=None, leases=False):
+    """
+        Yields (feederId, time) for every job added to the job queue from now on, as soon as it is inserted, only of
+        the jobs of eventType (e.g. "S") if given.
+
+        If leases is set, (feederId, time) is also yielded whenever a job is claimed, its lease extended or it is given
+        back, time being when it can be claimed again (see getPendingEventTimes), so that a job whose consumer died is
+        seen again once its lease lapses. Jobs acknowledged before their change is read are skipped.
+
+        Blocks while waiting for jobs. Uses a MongoDB change stream so the database must be a replica set (eg. Atlas).
+        onOpen is called once the change stream is open, every job inserted after that call is yielded.
+    """
+    match = {"operationType": "insert"}
+    options = {}
+    if leases:
+        match = {"$or": [match, {"operationType": "update", "$or": [
+                    {"updateDescription.updatedFields.leaseExpires": {"$exists": True} },
+                    {"updateDescription.removedFields": "leaseExpires"}] }] }
+        options["full_document"] = "updateLookup"
+    if eventType is not None:
+        match = {"$and": [match, {"fullDocument.type": eventType}]}
+    with jobs.watch([{"$match": match}], **options) as stream:
+        if onOpen != None:
+            onOpen()
+        for change in stream:
+            event = change.get("fullDocument")
+            # Deleted before the update was looked up
+            if event == None:
+                continue
+            yield str(event["feederId"]), _claimableTime(event)
+
+def getFeederSchedules(partitions=None):
+    """
+        Yields (feederId, feedSchedule) of every feeder, or of the feeders in the given scheduler partitions, streamed
+        from a cursor that only fetches the schedules.
+    """
+    query = {} if partitions is None else {"partition": {"$in": list(partitions)} }
+    for feeder in feeders.find(query, projection={"feedSchedule": 1}):
+        yield str(feeder["_id"]), feeder.get("feedSchedule", [])
+
+def watchFeederSchedules(onOpen=None):
+    """
+        Yields (feederId, feedSchedule) whenever the schedule of a feeder changes or a feeder is added, and
+        (feederId, None) when a feeder is deleted.
+
+        Blocks while waiting for changes. Uses a MongoDB change stream so the database must be a replica set (eg. Atlas).
+        onOpen is called once the change stream is open, every change made after that call is yielded.
+    """
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]} } },
+                {"$project": {"operationType": 1, "documentKey": 1, "updateDescription": 1, "fullDocument.feedSchedule": 1} }]
+    with feeders.watch(pipeline, full_document="updateLookup") as stream:
+        if onOpen != None:
+            onOpen()
+        for change in stream:
+            feederId = str(change["documentKey"]["_id"])
+            if change["operationType"] == "delete":
+                yield feederId, None
+                continue
+            if change["operationType"] == "update":
+                description = change.get("updateDescription", {})
+                changed = list(description.get("updatedFields", {})) + description.get("removedFields", [])
+                if not any(field.split(".")[0] == "feedSchedule" for field in changed):
+                    continue
+            feeder = change.get("fullDocument")
+            # The feeder was deleted before its update was looked up, the delete follows
+            if feeder != None:
+                yield feederId, feeder.get("feedSchedule", [])
 
 def updateFeederNextFeed(feederId):
     """
@@ -238,7 +653,11 @@ def insertNewUser(username, email, password):
             "name": "User",
             "feeders": []
             }
-    insertResult = users.insert_one(user)
+    try:
+        insertResult = users.insert_one(user)
+    except DuplicateKeyError:
+        # The username was taken since it was checked (unique index)
+        return None
     user["_id"] = str(insertResult.inserted_id)
     return user
 
@@ -346,13 +765,133 @@ def createEventFromScheduleItem(feederId, sched):
         if not deleteScheduleItem(feederId, sched):
             return False #delete failed
     #send it
-    event = {   "feederId": ObjectId(feederId),
+    return _eventFromScheduleItem(feeder, sched, nextScheduleOccurrence(sched))
+
+def _eventFromScheduleItem(feeder, sched, time):
+    return {    "feederId": ObjectId(feeder["_id"]),
                 "address": feeder["address"],
                 "type": sched["type"],
-                "time": nextScheduleOccurrence(sched),
-                "count": sched["count"]
+                "time": time,
+                "count": sched["count"],
+                "occurrenceKey": occurrenceKey(feeder["_id"], sched, time),
+                "expireAt": expiresAt(time, JOB_EXPIRY_HORIZON)
             }
-    return event
+
+def occurrenceKey(feederId, sched, time):
+    """
+        Gets the key identifying one occurrence of a schedule item of a feeder, the same however many times the job of
+        the occurrence is created. The jobs_scheduled index on it is unique so the job of an occurrence is only queued
+        once (see ensureIndexes).
+    """
+    item = []
+    for field in _SCHEDULE_ITEM_DELETE_CRITERIA:
+        value = sched.get(field)
+        if field == "time" and sched["type"] != "S":
+            value = (value.hour, value.minute)
+        elif field == "days" and value is not None:
+            value = sorted(set(value))
+        item.append(value)
+    digest = hashlib.blake2b(repr(item).encode("utf-8"), digest_size=8).hexdigest()
+    return "{}:{}:{}".format(feederId, digest, time.isoformat())
+
+def materializeDailyJobs(day=None, batchSize=5000, workers=1, partitions=None):
+    """
+        Creates the jobs of every schedule item that is due on or before day (today if None), the daily run of the
+        scheduler. Single ('S') schedule items are removed from their feeders as their job is created.
+
+        The feeders are streamed from a cursor that only fetches their address and schedule, and the jobs are inserted in
+        unordered batches of batchSize, so the memory used does not grow with the number of feeders. With workers > 1
+        the feeders are split into that many _id ranges of about the same size, materialized by a pool of threads.
+
+            Parameters:
+                    day (date): the day to create the jobs of
+                    batchSize (int): the number of jobs per insert
+                    workers (int): the number of _id ranges materialized at the same time
+                    partitions (list): only materializes the feeders of these scheduler partitions if given
+            Returns:
+                    inserted (int): the number of jobs created
+    """
+    now = clock.now()
+    day = day or now.date()
+    if workers <= 1:
+        return _materializeFeederRange(None, None, now, day, batchSize, partitions)
+
+    ranges = _feederIdRanges(workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(lambda bounds: _materializeFeederRange(bounds[0], bounds[1], now, day, batchSize, partitions),
+                            ranges))
+
+def _feederIdRanges(parts):
+    """
+        Splits the feeders into parts [lower, upper) _id ranges of about the same number of feeders, None meaning unbounded.
+        The bounds are read from the _id index, one skip query per bound.
+    """
+    count = feeders.estimated_document_count()
+    bounds = []
+    for part in range(1, parts):
+        feeder = feeders.find_one({}, projection={"_id": 1}, sort=[("_id", ASCENDING)], skip=count * part // parts)
+        if feeder != None and (len(bounds) == 0 or feeder["_id"] > bounds[-1]):
+            bounds.append(feeder["_id"])
+    return list(zip([None] + bounds, bounds + [None]))
+
+def _materializeFeederRange(lower, upper, now, day, batchSize, partitions=None):
+    query = {"feedSchedule.0": {"$exists": True} }
+    if partitions is not None:
+        query["partition"] = {"$in": list(partitions)}
+    if lower != None or upper != None:
+        query["_id"] = {}
+        if lower != None:
+            query["_id"]["$gte"] = lower
+        if upper != None:
+            query["_id"]["$lt"] = upper
+
+    inserted = 0
+    chunk = []
+    for feeder in feeders.find(query, projection=_FEEDER_SCHEDULE_PROJECTION, batch_size=_MATERIALIZE_CHUNK):
+        if feeder.get("address") is not None:
+            chunk.append(feeder)
+        if len(chunk) >= _MATERIALIZE_CHUNK:
+            inserted += _materializeFeeders(chunk, now, day, batchSize)
+            chunk = []
+    inserted += _materializeFeeders(chunk, now, day, batchSize)
+    return inserted
+
+def _materializeFeeders(chunk, now, day, batchSize):
+    # The next occurrences of the whole chunk are computed at once
+    times = iter(nextScheduleOccurrences([sched for feeder in chunk for sched in feeder["feedSchedule"]], now))
+    inserted = 0
+    events = []
+    singleUpdates = []
+    for feeder in chunk:
+        singles = []
+        remainingTimes = []
+        for sched in feeder["feedSchedule"]:
+            time = next(times)
+            if time is None or time.date() > day:
+                remainingTimes.append(time)
+                continue
+            events.append(_eventFromScheduleItem(feeder, sched, time))
+            if sched["type"] == "S":
+                singles.append(sched)
+            else:
+                remainingTimes.append(time)
+        if len(singles) > 0:
+            nextFeed = min((time for time in remainingTimes if time is not None), default=None)
+            singleUpdates.append(UpdateOne({"_id": feeder["_id"]}, {"$pull": {"feedSchedule": {"$in": singles} },
+                                                                    "$set": {"nextFeed": nextFeed} }))
+        if len(events) >= batchSize:
+            inserted += _insertMaterializedJobs(events, singleUpdates)
+            events = []
+            singleUpdates = []
+    inserted += _insertMaterializedJobs(events, singleUpdates)
+    return inserted
+
+def _insertMaterializedJobs(events, singleUpdates):
+    # The jobs are inserted before the single items are removed, so a failed run can lose no job and is simply run again
+    inserted = _insertJobs(events)
+    if len(singleUpdates) > 0:
+        feeders.bulk_write(singleUpdates, ordered=False)
+    return inserted
 
 def deleteScheduledEventById(eventId):
     deleteResult = jobs.delete_one({"_id": ObjectId(eventId)})
@@ -370,10 +909,29 @@ def _insertScheduleEvents(events):
         eventEntry = { prop: event[prop] for prop in _EVENT_PROPERTIES if event[prop] != None}
         if eventEntry["feederId"] != None:
             eventEntry["feederId"] = ObjectId(eventEntry["feederId"])
-        if len(eventEntry) == len(_EVENT_PROPERTIES): validEvents.append(eventEntry)
+        if len(eventEntry) == len(_EVENT_PROPERTIES):
+            if event.get("occurrenceKey") != None:
+                eventEntry["occurrenceKey"] = event["occurrenceKey"]
+            eventEntry["expireAt"] = expiresAt(eventEntry["time"], JOB_EXPIRY_HORIZON)
+            validEvents.append(eventEntry)
     #send it
-    result = jobs.insert_many(validEvents, ordered=False)
-    return len(result.inserted_ids)
+    return _insertJobs(validEvents)
+
+def _insertJobs(events):
+    """
+        Inserts jobs with one unordered insert_many. Jobs whose occurrence is already queued are left out, a duplicate
+        key is not an error as the job is queued either way.
+
+        Returns the number of jobs inserted.
+    """
+    if len(events) == 0:
+        return 0
+    try:
+        return len(jobs.insert_many(events, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+        return e.details["nInserted"]
 
 # Feeder Logs
 def logFeedingResult(feederId, eventType, time, amount, status):
@@ -393,6 +951,59 @@ def logFeedingResult(feederId, eventType, time, amount, status):
 
     return insertResult.inserted_id != None
 
+def dispatchReadyEventsForFeeder(feederId, status="OK"):
+    """
+        Dispatches every job of a feeder that is due now and logs the feeding results, in a constant
+        number of round trips however many jobs were pending.
+
+        The due jobs are first claimed atomically from the job queue (see job_queue) so that concurrent polls of
+        the same feeder can never dispatch a job twice. The claimed jobs are then logged with one insert_many,
+        acknowledged (removed) with one delete_many and the feeder's lastFeed/nextFeed are updated once. Jobs of a
+        consumer that dies before acknowledging them are dispatched again after JOB_VISIBILITY_TIMEOUT seconds.
+
+        Returns the list of dispatched jobs (empty if nothing was due).
+    """
+    return dispatchReadyEventsForFeeders([feederId], status=status).get(str(feederId), [])
+
+def dispatchReadyEventsForFeeders(feederIds, status="OK"):
+    """
+        Dispatches the due jobs of many feeders at once, in the same constant number of round trips as
+        dispatchReadyEventsForFeeder.
+
+        Returns a dictionary from feeder id to the list of its dispatched jobs, feeders without due jobs are left out.
+    """
+    objectIds = list({ObjectId(feederId) for feederId in feederIds})
+    if len(objectIds) == 0:
+        return {}
+
+    now = clock.now()
+    claimed = jobQueue.claimAll({"feederId": {"$in": objectIds} }, now)
+    if len(claimed) == 0:
+        return {}
+
+    feedLogs.insert_many([{ "feederId": job["feederId"],
+                            "type": job["type"],
+                            "time": now,
+                            "amount": job["count"],
+                            "status": status
+                        } for job in claimed], ordered=False)
+    jobQueue.ack(claimed)
+
+    dispatched = {}
+    for job in claimed:
+        job["_id"] = str(job["_id"])
+        job["feederId"] = str(job["feederId"])
+        dispatched.setdefault(job["feederId"], []).append(job)
+
+    #update feeders (next and last fed time)
+    fedFeeders = feeders.find({"_id": {"$in": [ObjectId(feederId) for feederId in dispatched]} }, projection={"feedSchedule": 1})
+    updates = [UpdateOne({"_id": feeder["_id"]}, {"$set": {"lastFeed": now, "nextFeed": getNextFeederFeed(feeder=feeder)} })
+                for feeder in fedFeeders]
+    if len(updates) > 0:
+        feeders.bulk_write(updates, ordered=False)
+
+    return dispatched
+
 def getFeedingLogs(feederId, limit=30):
     """
         Get all recorded food dispense logs for feeder with id=feederId
@@ -410,17 +1021,69 @@ def logOngoingConsumption(feederId, amount):
 
         "amount" should represent the amount of food eaten since this function was last called.
     """
-    now = dt.datetime.now().replace(minute=0, second=0, microsecond=0)
-    hourlySumary = hourlyLogs.find_one_and_update({"feederId": ObjectId(feederId), "hour": now}, {'$inc': {'foodEaten': amount}}, return_document=ReturnDocument.AFTER)
-    if hourlySumary == None:
-        hourlyLogs.insert_one({"feederId": ObjectId(feederId), "hour": now, "foodEaten": amount})
+    now = clock.now().replace(minute=0, second=0, microsecond=0)
+    if CONSUMPTION_LAYOUT == "daily":
+        _writeDailySlots({(feederId, now): amount}, "$inc")
+        return
+    query = {"feederId": ObjectId(feederId), "hour": now}
+    try:
+        hourlyLogs.update_one(query, {'$inc': {'foodEaten': amount}}, upsert=True)
+    except DuplicateKeyError:
+        # A concurrent upsert created the hour first (unique index), it is incremented now that it exists
+        hourlyLogs.update_one(query, {'$inc': {'foodEaten': amount}})
+
+def logOngoingConsumptionBatch(increments):
+    """
+        Applies many consumption increments in a single round trip.
 
-def getOngoingConsumptionLogs(feederId, start=dt.datetime.now() - dt.timedelta(30), end=dt.datetime.now()):
+        "increments" maps (feederId, hour) to the amount of food eaten, where hour is a datetime truncated to the hour.
+        Returns the number of hourly summaries that were updated or created. Raises a PartialWriteError holding the
+        increments that were not applied if only some were, the others must not be applied again.
+    """
+    if len(increments) == 0:
+        return 0
+    if CONSUMPTION_LAYOUT == "daily":
+        return _writeDailySlots(increments, "$inc")
+    keys = list(increments)
+    requests = [UpdateOne({"feederId": ObjectId(feederId), "hour": hour}, {'$inc': {'foodEaten': increments[(feederId, hour)]}},
+                          upsert=True) for feederId, hour in keys]
+    try:
+        result = hourlyLogs.bulk_write(requests, ordered=False)
+        return result.modified_count + result.upserted_count
+    except BulkWriteError as e:
+        # Unordered, every write but the failed ones was applied
+        errors = e.details.get("writeErrors", [])
+        written = e.details.get("nModified", 0) + e.details.get("nUpserted", 0)
+        failed = {keys[error["index"]]: increments[keys[error["index"]]] for error in errors if error.get("code") != 11000}
+        # A concurrent upsert created these hours first (unique index), they are incremented again now that they exist
+        retried = [keys[error["index"]] for error in errors if error.get("code") == 11000]
+        cause = e
+    if len(retried) > 0:
+        try:
+            written += hourlyLogs.bulk_write([UpdateOne({"feederId": ObjectId(feederId), "hour": hour},
+                                                       {'$inc': {'foodEaten': increments[(feederId, hour)]}})
+                                              for feederId, hour in retried], ordered=False).modified_count
+        except BulkWriteError as e:
+            written += e.details.get("nModified", 0)
+            failed.update({retried[error["index"]]: increments[retried[error["index"]]]
+                           for error in e.details.get("writeErrors", [])})
+            cause = e
+    if len(failed) > 0:
+        raise PartialWriteError("{} of {} consumption increments failed".format(len(failed), len(keys)), failed) from cause
+    return written
+
+def getOngoingConsumptionLogs(feederId, start=None, end=None):
     """
         Gets logged information about hourly pet food consumption.
 
         Can specify the start and end dates between which to get logs (defaults to last 30 days)
     """
+    if end is None:
+        end = clock.now()
+    if start is None:
+        start = end - dt.timedelta(30)
+    if CONSUMPTION_LAYOUT == "daily":
+        return getDailyConsumptionLogs(feederId, start, end)
     data = hourlyLogs.find({"feederId": ObjectId(feederId), "hour": {"$gte": start, "$lte": end} })
     data = list(data)
     for datum in data:
@@ -428,6 +1091,179 @@ def getOngoingConsumptionLogs(feederId, start=dt.datetime.now() - dt.timedelta(3
         datum.pop("_id", None)
     return data
 
+def getDailyConsumptionLogs(feederId, start, end):
+    """
+        Reads the day-bucketed consumption logs and returns them in the same shape as the hourly layout,
+        a list of {"feederId", "hour", "foodEaten"} for every hour between start and end with food eaten.
+    """
+    startDay = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    data = []
+    for bucket in dailyLogs.find({"feederId": ObjectId(feederId), "day": {"$gte": startDay, "$lte": end} }, projection={"_id": 0, "day": 1, "hours": 1}):
+        for slot, foodEaten in enumerate(bucket.get("hours", [])):
+            hour = bucket["day"] + dt.timedelta(hours=slot)
+            if foodEaten and start <= hour <= end:
+                data.append({"feederId": str(feederId), "hour": hour, "foodEaten": foodEaten})
+    return data
+
+def _writeDailySlots(values, operator):
+    """
+        Writes hourly values into the day-bucketed consumption layout with one ordered bulk write.
+
+        "values" maps (feederId, hour) to an amount and "operator" is "$inc" or "$set". Missing day buckets are
+        created first with 24 empty slots so that the positional updates always target an array. Raises a
+        PartialWriteError holding the values that were not applied if the bulk write failed part way.
+
+        Private Method. Only used by the consumption logging functions and migrate_consumption.py.
+    """
+    days = set()
+    slotUpdates = {}
+    for (feederId, hour), amount in values.items():
+        day = hour.replace(hour=0, minute=0, second=0, microsecond=0)
+        days.add((feederId, day))
+        slotUpdates.setdefault((feederId, day), {})["hours.%d" % hour.hour] = amount
+
+    slotKeys = list(slotUpdates)
+    requests = [UpdateOne({"feederId": ObjectId(feederId), "day": day}, {"$setOnInsert": {"hours": [0] * 24}}, upsert=True)
+                    for feederId, day in days]
+    requests += [UpdateOne({"feederId": ObjectId(feederId), "day": day}, {operator: slotUpdates[(feederId, day)]})
+                    for feederId, day in slotKeys]
+    applied = 0 # the number of requests applied by the previous attempts
+    while applied < len(requests):
+        try:
+            dailyLogs.bulk_write(requests[applied:], ordered=True)
+            break
+        except BulkWriteError as e:
+            # Only write concern errors if no write failed, every write was applied
+            errors = e.details.get("writeErrors", [])
+            failedAt = applied + errors[0]["index"] if len(errors) > 0 else len(requests)
+            if len(errors) == 0 or errors[0].get("code") != 11000 or failedAt >= len(days):
+                # Ordered, the writes before the failed one were applied and none after it
+                failedDays = set(slotKeys[max(0, failedAt - len(days)):])
+                failed = {(feederId, hour): amount for (feederId, hour), amount in values.items()
+                            if (feederId, hour.replace(hour=0, minute=0, second=0, microsecond=0)) in failedDays}
+                raise PartialWriteError("{} of {} consumption slots failed".format(len(failed), len(values)), failed) from e
+            # Another writer created one of the day buckets at the same time. The bucket exists now so only the
+            # writes after the failed upsert need to be retried.
+            applied = failedAt + 1
+    return len(slotUpdates)
+
+
+# Scheduler partitions
+def feederPartition(feederId):
+    """
+        Gets the scheduler partition of a feeder, a stable hash of its id.
+    """
+    return zlib.crc32(ObjectId(feederId).binary) % SCHEDULER_PARTITIONS
+
+def assignFeederPartitions(batchSize=10000):
+    """
+        Stores the scheduler partition in the feeders that do not have one yet (e.g. inserted before partitions existed).
+
+        Returns the number of feeders updated.
+    """
+    updated = 0
+    while True:
+        missing = list(feeders.find({"partition": {"$exists": False} }, projection={"_id": 1}, limit=batchSize))
+        if len(missing) == 0:
+            return updated
+        feeders.bulk_write([UpdateOne({"_id": feeder["_id"]}, {"$set": {"partition": feederPartition(feeder["_id"])} })
+                            for feeder in missing], ordered=False)
+        updated += len(missing)
+
+def heartbeatSchedulerWorker(owner, ttl):
+    """
+        Records that a scheduler worker is alive for the next ttl seconds.
+
+        Returns the sorted ids of every live scheduler worker, owner included.
+    """
+    now = clock.now()
+    schedulerWorkers.update_one({"_id": owner}, {"$set": {"expiresAt": now + dt.timedelta(seconds=ttl)} }, upsert=True)
+    return sorted(worker["_id"] for worker in schedulerWorkers.find({"expiresAt": {"$gte": now} }, projection={"_id": 1}))
+
+def removeSchedulerWorker(owner):
+    """
+        Removes a stopping scheduler worker, so the others take its share of the partitions at their next heartbeat.
+    """
+    schedulerWorkers.delete_one({"_id": owner})
+
+def claimSchedulerPartition(partition, owner, ttl):
+    """
+        Takes the lease of a scheduler partition for ttl seconds if it is free, expired or already held by owner.
+
+        Returns the lease document if it was taken, None if another worker holds it.
+    """
+    now = clock.now()
+    try:
+        return schedulerLeases.find_one_and_update(
+            {"_id": partition, "$or": [{"owner": owner}, {"owner": None}, {"expiresAt": {"$lt": now} }] },
+            {"$set": {"owner": owner, "expiresAt": now + dt.timedelta(seconds=ttl)} },
+            upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # The lease exists and is held by another worker, so the upsert tried to create it again
+        return None
+
+def renewSchedulerLeases(owner, ttl):
+    """
+        Extends every lease held by owner by ttl seconds (the heartbeat of a scheduler worker).
+
+        Returns the set of partitions the owner still holds.
+    """
+    now = clock.now()
+    schedulerLeases.update_many({"owner": owner, "expiresAt": {"$gte": now} },
+                                {"$set": {"expiresAt": now + dt.timedelta(seconds=ttl)} })
+    return {lease["_id"] for lease in schedulerLeases.find({"owner": owner, "expiresAt": {"$gte": now} }, projection={"_id": 1})}
+
+def releaseSchedulerPartitions(owner, partitions):
+    """
+        Gives up the leases of the partitions so that other workers can take them at once.
+    """
+    schedulerLeases.update_many({"_id": {"$in": list(partitions)}, "owner": owner},
+                                {"$set": {"owner": None, "expiresAt": clock.now()} })
+
+def getSchedulerLeases():
+    """
+        Gets the lease of every scheduler partition that has one, as (partition, owner, expiresAt, materializedDay).
+    """
+    return [(lease["_id"], lease.get("owner"), lease.get("expiresAt"), lease.get("materializedDay"))
+            for lease in schedulerLeases.find()]
+
+def markPartitionMaterialized(partition, owner, day):
+    """
+        Records that the jobs of day were created for a partition, if owner still holds its lease.
+    """
+    result = schedulerLeases.update_one({"_id": partition, "owner": owner},
+                                        {"$set": {"materializedDay": day.isoformat()} })
+    return result.matched_count == 1
+
+# Indexes
+def ensureIndexes(rebuild=False):
+    """
+        Creates the indexes the hot queries rely on (see indexes.py). Safe to call on every startup.
+
+        Indexes declared with other options are only reported as a conflict, unless rebuild is set. Dropping and
+        building an index again can take long on a large collection, so it is left to an explicit migration or to
+        "python -m feeder_api.indexes".
+
+        Returns the (collection, index name, action) of every declared index.
+    """
+    return indexes.ensureIndexes(_db, rebuild=rebuild)
+
+# Verified credential cache
+def configureCredentialCache(maxSize=None, ttl=None):
+    """
+        Changes the size and time to live (seconds) of the verified feeder credential cache. A size of 0 disables it.
+    """
+    if maxSize is not None:
+        _credentialCache.maxSize = maxSize
+    if ttl is not None:
+        _credentialCache.ttl = ttl
+    _credentialCache.clear()
+
+def getCredentialCacheStats():
+    """
+        Gets the hit, miss and eviction counters of the verified feeder credential cache.
+    """
+    return _credentialCache.stats()
 
 #-Helper-Functions----------------------------------------------------------------------------------------------------------------------------------------------------
 def isValidProductKey(productKey, password):
@@ -443,31 +1279,51 @@ def isValidProductKey(productKey, password):
     return True # this could be arbitrarily complex - we'll just keep it simple
 
 #-SCHEDUING-FUNCTIONS--------------------------------------------------------------------------------------------------------------------------------------------------
-def nextScheduleOccurrence(scheduleItem):
+def nextScheduleOccurrence(scheduleItem, now=None):
     """
-        Calculates the next feeding time from a schedule item.
+        Calculates the next feeding time from a schedule item, at or after now (the current time if None).
     """
+    if now is None:
+        now = clock.now()
     if scheduleItem["type"] == "R":
-        return _nextRepeatingScheduleOccurrence(scheduleItem)
+        return _nextRepeatingScheduleOccurrence(scheduleItem, now)
     elif scheduleItem["type"] == "W":
-        return _nextWeeklyScheduleOccurrence(scheduleItem)
+        return _nextWeeklyScheduleOccurrence(scheduleItem, now)
     else:
         return scheduleItem["time"]
 
-def _nextRepeatingScheduleOccurrence(scheduleItem):
-    now = dt.datetime.now()
+def nextScheduleOccurrences(scheduleItems, now=None):
+    """
+        Calculates the next feeding times of many schedule items against the same now (the current time if None).
+
+        Uses the vectorized schedule_vector when NumPy is installed and there are enough items, nextScheduleOccurrence
+        for each item otherwise.
+
+            Parameters:
+                    scheduleItems (list): the schedule items
+                    now (datetime): the reference time
+            Returns:
+                    times (list): the next feeding time of each item, None if an item has none
+    """
+    if now is None:
+        now = clock.now()
+    if schedule_vector.available() and len(scheduleItems) >= _VECTOR_MIN_ITEMS:
+        return schedule_vector.nextScheduleOccurrences(scheduleItems, now)
+    return [nextScheduleOccurrence(scheduleItem, now) for scheduleItem in scheduleItems]
+
+def _nextRepeatingScheduleOccurrence(scheduleItem, now):
     schedule = scheduleItem["time"]
     dispenseTimeToday = now.replace(hour=schedule.hour, minute=schedule.minute, second=0, microsecond=0)
     if scheduleItem["unit"] == "days":
         every = scheduleItem["every"]
         yday = now.timetuple().tm_yday
-        daysUntilFeed = yday % every
+        # Feeds on the days of the year that are a multiple of every
+        daysUntilFeed = -yday % every
         if daysUntilFeed == 0 and dispenseTimeToday < now:
-            daysUntilFeed += 1
+            daysUntilFeed += every
         return dispenseTimeToday + dt.timedelta(daysUntilFeed)
 
-def _nextWeeklyScheduleOccurrence(scheduleItem):
-    now = dt.datetime.now()
+def _nextWeeklyScheduleOccurrence(scheduleItem, now):
     schedule = scheduleItem["time"]
     dispenseTimeToday = now.replace(hour=schedule.hour, minute=schedule.minute, second=0, microsecond=0)
 
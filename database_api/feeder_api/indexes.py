@@ -0,0 +1,251 @@
+"""
+The indexes of every feeder collection, and the tools to create and check them.
+
+declaredIndexes lists every index the queries of db_helper rely on. ensureIndexes creates the missing ones and brings
+the existing ones in line with their declaration, so it can run on every startup (db_helper.ensureIndexes calls it).
+Indexes that would have to be dropped and built again are only rebuilt when asked to, not on startup.
+reportIndexes compares the indexes of the database with the declared ones and reads their use from $indexStats, and
+explainQueries explains the hot queries of db_helper to find any that scans a whole collection.
+
+Run from the database_api folder (or with the package installed) with "python -m feeder_api.indexes", which ensures
+the indexes, prints the report and exits with an error if a hot query does a COLLSCAN.
+"""
+
+import argparse
+import datetime as dt
+import sys
+from collections import namedtuple
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+from bson import ObjectId
+
+from . import clock
+from .job_queue import readyQuery, unclaimedQuery
+
+IndexSpec = namedtuple("IndexSpec", ["collection", "name", "keys", "options"])
+
+# The queries of db_helper that are checked with explain, as (collection, description, filter, sort). Queries reading
+# a whole collection on purpose (e.g. getPendingEventTimes of every job, the daily materialization of every feeder or
+# the 64 scheduler leases) are left out, a collection scan is their best plan.
+HotQuery = namedtuple("HotQuery", ["collection", "description", "filter", "sort"])
+
+def declaredIndexes():
+    """
+        Gets the full set of indexes of the feeder collections.
+
+            Returns:
+                    indexes (list): IndexSpec of every index, _id indexes excluded
+    """
+    return [
+        IndexSpec("feeders", "productKey", [("productKey", ASCENDING)], {"unique": True}),
+        IndexSpec("feeders", "partition", [("partition", ASCENDING)], {}),
+        IndexSpec("users", "username", [("username", ASCENDING)], {"unique": True}),
+        IndexSpec("jobs_scheduled", "feederId_time", [("feederId", ASCENDING), ("time", ASCENDING)], {}),
+        IndexSpec("jobs_scheduled", "time", [("time", ASCENDING)], {}),
+        IndexSpec("jobs_scheduled", "type_time", [("type", ASCENDING), ("time", ASCENDING)], {}),
+        # Undelivered jobs expire at their expireAt, in UTC (see job_queue.expiresAt)
+        IndexSpec("jobs_scheduled", "expireAt", [("expireAt", ASCENDING)], {"expireAfterSeconds": 0}),
+        IndexSpec("jobs_scheduled", "occurrenceKey", [("occurrenceKey", ASCENDING)], {"unique": True, "sparse": True}),
+        IndexSpec("jobs_scheduled", "lease", [("lease", ASCENDING)], {"sparse": True}),
+        IndexSpec("feeding_logs", "feederId_time", [("feederId", ASCENDING), ("time", ASCENDING)], {}),
+        IndexSpec("hourly_consumption", "feederId_hour", [("feederId", ASCENDING), ("hour", ASCENDING)], {"unique": True}),
+        IndexSpec("daily_consumption", "feederId_day", [("feederId", ASCENDING), ("day", ASCENDING)], {"unique": True}),
+        IndexSpec("scheduler_leases", "owner_expiresAt", [("owner", ASCENDING), ("expiresAt", ASCENDING)], {}),
+        IndexSpec("scheduler_workers", "expiresAt", [("expiresAt", ASCENDING)], {}),
+    ]
+
+def hotQueries(now=None):
+    """
+        Gets the hot queries of db_helper with sample values, at the current time of the clock if now is None.
+    """
+    now = now or clock.now()
+    feederId = ObjectId()
+    return [
+        HotQuery("feeders", "authenticateFeeder, getFeederByProductKey", {"productKey": "000000000000"}, None),
+        HotQuery("feeders", "getFeederSchedules(partitions)", {"partition": {"$in": [0, 1]} }, None),
+        HotQuery("feeders", "materializeDailyJobs(partitions)",
+                 {"feedSchedule.0": {"$exists": True}, "partition": {"$in": [0, 1]} }, None),
+        HotQuery("feeders", "assignFeederPartitions", {"partition": {"$exists": False} }, None),
+        HotQuery("users", "getUserByUsername, verifyUser", {"username": "user"}, None),
+        HotQuery("jobs_scheduled", "hasReadyEventsForFeeder, dispatchReadyEventsForFeeder",
+                 readyQuery(now, {"feederId": feederId}), None),
+        HotQuery("jobs_scheduled", "JobQueue.claim, getReadyEvents", readyQuery(now), [("time", ASCENDING)]),
+        HotQuery("jobs_scheduled", "getNextEventTimeForFeeder", unclaimedQuery(now, {"feederId": feederId}),
+                 [("time", ASCENDING)]),
+        HotQuery("jobs_scheduled", "JobQueue.claimAll", {"lease": ObjectId()}, None),
+        HotQuery("jobs_scheduled", "getPendingEventTimes(eventType)",
+                 unclaimedQuery(now, {"type": "S"}), None),
+        HotQuery("feeding_logs", "getFeedingLogs", {"feederId": feederId}, None),
+        HotQuery("hourly_consumption", "getOngoingConsumptionLogs, logOngoingConsumption",
+                 {"feederId": feederId, "hour": {"$gte": now - dt.timedelta(30), "$lte": now} }, None),
+        HotQuery("daily_consumption", "getDailyConsumptionLogs",
+                 {"feederId": feederId, "day": {"$gte": now - dt.timedelta(30), "$lte": now} }, None),
+        HotQuery("scheduler_leases", "renewSchedulerLeases", {"owner": "worker", "expiresAt": {"$gte": now} }, None),
+        HotQuery("scheduler_workers", "heartbeatSchedulerWorker", {"expiresAt": {"$gte": now} }, None),
+    ]
+
+def _options(info):
+    # The options of index_information that declaredIndexes sets
+    options = {}
+    for option in ("unique", "sparse"):
+        if info.get(option):
+            options[option] = info[option]
+    # A horizon of 0 is a TTL index too
+    if info.get("expireAfterSeconds") is not None:
+        options["expireAfterSeconds"] = info["expireAfterSeconds"]
+    return options
+
+def _keys(info):
+    return [(field, int(direction)) for field, direction in info["key"]]
+
+def _hasDuplicates(collection, keys):
+    group = {"_id": {field.replace(".", "_"): "$" + field for field, _ in keys}, "count": {"$sum": 1} }
+    return len(list(collection.aggregate([{"$group": group}, {"$match": {"count": {"$gt": 1} } }, {"$limit": 1}],
+                                         allowDiskUse=True))) > 0
+
+def ensureIndexes(db, rebuild=False):
+    """
+        Creates the declared indexes that are missing and changes the ones whose options differ. Safe to call on every
+        startup, declared indexes that already exist are left alone.
+
+        A TTL horizon that differs is changed in place with collMod. Other differences (e.g. an index that must become
+        unique) are fixed by dropping and creating the index again if rebuild is set, unless the collection holds
+        duplicate keys that a unique index would refuse.
+
+            Parameters:
+                    db (Database): the smartfeeder database
+                    rebuild (bool): whether indexes with other options are dropped and created again
+            Returns:
+                    actions (list): (collection, index name, action) where action is "created", "unchanged",
+                                    "modified", "rebuilt" or "conflict: <reason>"
+    """
+    actions = []
+    for spec in declaredIndexes():
+        collection = db[spec.collection]
+        existing = collection.index_information()
+        currentName = next((name for name, info in existing.items() if _keys(info) == spec.keys), None)
+        if currentName is None and spec.name in existing:
+            currentName = spec.name
+        if currentName is None:
+            actions.append((spec.collection, spec.name, _createIndex(collection, spec, "created")))
+            continue
+
+        current = existing[currentName]
+        options = _options(current)
+        if currentName == spec.name and _keys(current) == spec.keys and options == spec.options:
+            actions.append((spec.collection, spec.name, "unchanged"))
+        elif (currentName == spec.name and _keys(current) == spec.keys and "expireAfterSeconds" in spec.options
+                and {k: v for k, v in options.items() if k != "expireAfterSeconds"} ==
+                    {k: v for k, v in spec.options.items() if k != "expireAfterSeconds"}):
+            db.command("collMod", spec.collection,
+                       index={"name": spec.name, "expireAfterSeconds": spec.options["expireAfterSeconds"]})
+            actions.append((spec.collection, spec.name, "modified"))
+        elif not rebuild:
+            actions.append((spec.collection, spec.name, "conflict: {} has options {}".format(currentName, options)))
+        elif spec.options.get("unique") and not current.get("unique") and _hasDuplicates(collection, spec.keys):
+            actions.append((spec.collection, spec.name, "conflict: duplicate keys, cannot be unique"))
+        else:
+            collection.drop_index(currentName)
+            actions.append((spec.collection, spec.name, _createIndex(collection, spec, "rebuilt")))
+    return actions
+
+def _createIndex(collection, spec, action):
+    try:
+        collection.create_index(spec.keys, name=spec.name, **spec.options)
+        return action
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        # Left to be created once the duplicates are removed, the other indexes are still created
+        return "conflict: duplicate keys, cannot be unique"
+
+def indexUsage(db, collectionName):
+    """
+        Gets the number of operations that used each index of a collection since the server started or the index
+        was created, from $indexStats. Returns an empty dictionary if $indexStats is not available.
+    """
+    try:
+        return {stats["name"]: stats["accesses"]["ops"] for stats in db[collectionName].aggregate([{"$indexStats": {} }])}
+    except OperationFailure:
+        return {}
+
+def reportIndexes(db):
+    """
+        Compares the indexes of the database with the declared ones.
+
+            Returns:
+                    report (dict): "missing" declared (collection, name) that do not exist, "undeclared" existing
+                                   (collection, name) that are not declared and "unused" existing (collection, name, ops)
+                                   that $indexStats has seen no operation use
+    """
+    declared = declaredIndexes()
+    report = {"missing": [], "undeclared": [], "unused": []}
+    for collectionName in sorted({spec.collection for spec in declared}):
+        names = {spec.name for spec in declared if spec.collection == collectionName}
+        existing = db[collectionName].index_information()
+        usage = indexUsage(db, collectionName)
+        report["missing"] += [(collectionName, name) for name in sorted(names - set(existing))]
+        report["undeclared"] += [(collectionName, name) for name in sorted(set(existing) - names - {"_id_"})]
+        report["unused"] += [(collectionName, name, usage[name]) for name in sorted(existing)
+                             if name != "_id_" and usage.get(name) == 0]
+    return report
+
+def _planStages(plan):
+    stages = [plan.get("stage")]
+    for child in ("inputStage", "outerStage", "innerStage", "queryPlan"):
+        if child in plan:
+            stages += _planStages(plan[child])
+    for child in plan.get("inputStages", []):
+        stages += _planStages(child)
+    return [stage for stage in stages if stage is not None]
+
+def explainQueries(db, now=None):
+    """
+        Explains every hot query of db_helper.
+
+            Returns:
+                    plans (list): (HotQuery, stages) where stages lists the stages of the winning plan, a "COLLSCAN"
+                                  among them meaning the query reads the whole collection
+    """
+    plans = []
+    for query in hotQueries(now):
+        cursor = db[query.collection].find(query.filter)
+        if query.sort is not None:
+            cursor = cursor.sort(query.sort)
+        plans.append((query, _planStages(cursor.explain()["queryPlanner"]["winningPlan"])))
+    return plans
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Creates the indexes of the feeder collections and checks their use")
+    parser.add_argument('--no_rebuild', action='store_true',
+                        help='Reports indexes with other options instead of dropping and creating them again')
+    parser.add_argument('--check_only', action='store_true', help='Only reports, creates no index')
+    return parser.parse_args()
+
+def main(args):
+    from . import db_helper
+
+    if not args.check_only:
+        for collectionName, name, action in db_helper.ensureIndexes(rebuild=not args.no_rebuild):
+            print("{:<20} {:<18} {}".format(collectionName, name, action))
+
+    report = reportIndexes(db_helper._db)
+    for collectionName, name in report["missing"]:
+        print("missing index {}.{}".format(collectionName, name))
+    for collectionName, name in report["undeclared"]:
+        print("undeclared index {}.{}".format(collectionName, name))
+    for collectionName, name, ops in report["unused"]:
+        print("unused index {}.{} ({} operations since the server started)".format(collectionName, name, ops))
+
+    scans = 0
+    for query, stages in explainQueries(db_helper._db):
+        scanned = "COLLSCAN" in stages
+        scans += scanned
+        print("{:<8} {:<20} {:<52} {}".format("COLLSCAN" if scanned else "ok", query.collection, query.description,
+                                             " <- ".join(stages)))
+    if scans > 0 or len(report["missing"]) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(parse_args())
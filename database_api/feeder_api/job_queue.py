@@ -0,0 +1,171 @@
+"""
+A job queue with visibility timeouts on top of the jobs_scheduled collection.
+
+A consumer claims due jobs by atomically setting their owner, a lease id and the time the lease expires
+(leaseExpires), so no two consumers can hold the same job. Once a job was handled it is acknowledged (ack), which
+deletes it, or given back (nack) to be claimed again. A consumer that dies or takes longer than the visibility timeout
+never acknowledges its jobs, their leases expire and the jobs can be claimed by any consumer again, so every job is
+dispatched at least once.
+
+Every claim gets a new lease id and ack, nack and extend only act on jobs whose lease id is unchanged, so a consumer
+whose lease expired and whose job was claimed by another consumer cannot delete or give back that job.
+
+Jobs that are never dispatched are removed by MongoDB once their expireAt has passed (a TTL index, see indexes.py).
+"""
+
+import datetime as dt
+import os
+import socket
+
+from pymongo import ASCENDING
+from pymongo.collection import ReturnDocument
+from bson import ObjectId
+
+from . import clock
+
+# The number of seconds a claimed job stays invisible to the other consumers
+DEFAULT_VISIBILITY_TIMEOUT = 60.0
+
+def expiresAt(time, horizon):
+    """
+        Gets the expireAt of a job due at time, horizon seconds after it. The job times are naive local datetimes, which
+        pymongo stores as they are, while the TTL monitor of MongoDB reads dates as UTC, so expireAt is converted to UTC.
+    """
+    return time.astimezone(dt.timezone.utc).replace(tzinfo=None) + dt.timedelta(seconds=horizon)
+
+def readyQuery(now, query=None):
+    """
+        Gets the query of the jobs that are due at now and not held by a consumer (never claimed, given back or with
+        an expired lease), restricted to query if given.
+    """
+    ready = {"time": {"$lte": now}, "$or": [{"owner": None}, {"leaseExpires": {"$lt": now} }] }
+    if query:
+        ready = {"$and": [query, ready]}
+    return ready
+
+def unclaimedQuery(now, query=None):
+    """
+        Gets the query of the jobs not held by a consumer at now, whether they are due or not, restricted to query.
+    """
+    unclaimed = {"$or": [{"owner": None}, {"leaseExpires": {"$lt": now} }] }
+    if query:
+        unclaimed = {"$and": [query, unclaimed]}
+    return unclaimed
+
+class JobQueue:
+    """
+        One consumer of the job queue.
+
+        Intance Variables:
+            collection:
+                The jobs collection (jobs_scheduled)
+            owner:
+                The id of the consumer stored in the jobs it holds
+            visibilityTimeout:
+                The number of seconds a claimed job stays invisible to the other consumers
+            expiryHorizon:
+                The number of seconds after their new time that given back jobs expire, None if jobs never expire
+    """
+
+    def __init__(self, collection, owner=None, visibilityTimeout=DEFAULT_VISIBILITY_TIMEOUT, expiryHorizon=None):
+        """
+            collection (Collection): the jobs collection
+            owner (str): the id of the consumer, "<host>:<pid>" if None
+            visibilityTimeout (float): the number of seconds a claimed job stays invisible to the other consumers
+            expiryHorizon (int): the number of seconds after their new time that given back jobs expire
+        """
+        self.collection = collection
+        self.owner = owner or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.visibilityTimeout = visibilityTimeout
+        self.expiryHorizon = expiryHorizon
+
+    def _lease(self, now):
+        return {"owner": self.owner, "lease": ObjectId(), "claimedAt": now,
+                "leaseExpires": now + dt.timedelta(seconds=self.visibilityTimeout)}
+
+    def claim(self, query=None, now=None):
+        """
+            Claims the earliest due job that no consumer holds.
+
+            Parameters:
+                    query (dict): only claims a job matching this query, e.g. {"feederId": feederId}
+                    now (datetime): the current time of the clock if None
+            Returns:
+                    job (dict): the claimed job, None if no job is ready
+        """
+        now = now or clock.now()
+        return self.collection.find_one_and_update(readyQuery(now, query),
+                                                   {"$set": self._lease(now), "$inc": {"attempts": 1} },
+                                                   sort=[("time", ASCENDING)], return_document=ReturnDocument.AFTER)
+
+    def claimMany(self, query=None, limit=None, now=None):
+        """
+            Claims every due job matching query (at most limit of them, one find_one_and_update each).
+
+            Returns the list of claimed jobs, earliest first.
+        """
+        now = now or clock.now()
+        claimed = []
+        while limit is None or len(claimed) < limit:
+            job = self.claim(query, now)
+            if job is None:
+                break
+            claimed.append(job)
+        return claimed
+
+    def claimAll(self, query=None, now=None):
+        """
+            Claims every due job matching query in two round trips, whatever their number: all of them are leased
+            under one lease id with update_many, which is atomic for each job, then fetched by that lease id.
+
+            Returns the list of claimed jobs.
+        """
+        now = now or clock.now()
+        lease = self._lease(now)
+        result = self.collection.update_many(readyQuery(now, query), {"$set": lease, "$inc": {"attempts": 1} })
+        if result.modified_count == 0:
+            return []
+        return list(self.collection.find({"lease": lease["lease"]}))
+
+    def ack(self, jobs):
+        """
+            Acknowledges handled jobs, removing them from the queue. Jobs whose lease expired and that were claimed
+            again by another consumer are left to that consumer.
+
+            Returns the number of jobs removed.
+        """
+        leases = list({job["lease"] for job in jobs})
+        if len(leases) == 0:
+            return 0
+        return self.collection.delete_many({"_id": {"$in": [job["_id"] for job in jobs]},
+                                            "lease": {"$in": leases} }).deleted_count
+
+    def nack(self, jobs, delay=0.0):
+        """
+            Gives back jobs that could not be handled, to be claimed again by any consumer after delay seconds.
+
+            Returns the number of jobs given back.
+        """
+        leases = list({job["lease"] for job in jobs})
+        if len(leases) == 0:
+            return 0
+        update = {"$set": {"owner": None}, "$unset": {"lease": "", "claimedAt": "", "leaseExpires": ""} }
+        if delay > 0:
+            update["$set"]["time"] = clock.now() + dt.timedelta(seconds=delay)
+            if self.expiryHorizon is not None:
+                update["$set"]["expireAt"] = expiresAt(update["$set"]["time"], self.expiryHorizon)
+        return self.collection.update_many({"_id": {"$in": [job["_id"] for job in jobs]}, "lease": {"$in": leases} },
+                                           update).modified_count
+
+    def extend(self, jobs, seconds=None):
+        """
+            Extends the leases of jobs still being handled by seconds (the visibility timeout if None) from now.
+
+            Returns the number of jobs whose lease was extended, jobs already claimed by another consumer are not.
+        """
+        leases = list({job["lease"] for job in jobs})
+        if len(leases) == 0:
+            return 0
+        expires = clock.now() + dt.timedelta(seconds=self.visibilityTimeout if seconds is None else seconds)
+        return self.collection.update_many({"_id": {"$in": [job["_id"] for job in jobs]}, "lease": {"$in": leases} },
+                                           {"$set": {"leaseExpires": expires} }).modified_count
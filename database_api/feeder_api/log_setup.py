@@ -0,0 +1,159 @@
+"""
+Shared logging setup of the CoAP server, the scheduler and the website.
+
+Log calls only put the record on an in-memory queue (QueueHandler), a background thread (QueueListener) does the
+formatting for and writing to the console and the log file, so the CoAP event loop never waits on disk or terminal
+I/O. The log file is rotated by size or by time and records can be written as one JSON object per line.
+
+The defaults of configureLogging can be set with environment variables:
+    FEEDER_LOG_LEVEL        the level of the root logger (INFO)
+    FEEDER_LOG_FILE         the log file, no log file if empty
+    FEEDER_LOG_JSON         "1" to write JSON lines instead of text
+    FEEDER_LOG_MAX_BYTES    the size in bytes that rotates the log file (10 MiB)
+    FEEDER_LOG_BACKUPS      the number of rotated log files kept (5)
+    FEEDER_LOG_ROTATE_WHEN  rotates the log file by time instead, e.g. "midnight" or "H"
+"""
+
+import atexit
+import copy
+import datetime as dt
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+_TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(process)d]: %(message)s"
+
+# Attributes every LogRecord has, anything else was passed with extra= and is added to the JSON output
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+_listener = None
+_listenerPid = None
+
+class JsonFormatter(logging.Formatter):
+    """
+        Formats log records as one JSON object per line, with the fields passed to the log call with extra= included.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+        Puts log records on the queue with their message and traceback rendered as text, but not yet formatted, so
+        the formatter of the listener can still write the traceback as a separate JSON field.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_EXCEPTION_FORMATTER = logging.Formatter()
+
+def _env(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, "") else value
+
+def configureLogging(level=None, logFile=None, jsonFormat=None, maxBytes=None, backupCount=None, rotateWhen=None,
+                     console=True):
+    """
+        Routes all log records of the process through a queue to a background thread that writes them.
+
+        Replaces the handlers of the root logger, so it can be called again (e.g. in a forked worker process, whose
+        copy of the parent's listener thread does not exist). Arguments left as None use the FEEDER_LOG_* environment
+        variables, see the module documentation.
+
+            Parameters:
+                    level (str): the level of the root logger
+                    logFile (str): the file to log to, no log file if empty
+                    jsonFormat (bool): writes JSON lines instead of text
+                    maxBytes (int): the size that rotates the log file, 0 never rotates by size
+                    backupCount (int): the number of rotated log files kept
+                    rotateWhen (str): rotates the log file at this interval instead of by size (see
+                                      logging.handlers.TimedRotatingFileHandler), e.g. "midnight"
+                    console (bool): also logs to stderr
+            Returns:
+                    listener (QueueListener): the started listener, stopped by stopLogging at exit
+    """
+    global _listener, _listenerPid
+    level = level or _env("FEEDER_LOG_LEVEL", "INFO")
+    logFile = _env("FEEDER_LOG_FILE", "") if logFile is None else logFile
+    jsonFormat = _env("FEEDER_LOG_JSON", "0") == "1" if jsonFormat is None else jsonFormat
+    maxBytes = int(_env("FEEDER_LOG_MAX_BYTES", 10 * 1024 * 1024)) if maxBytes is None else maxBytes
+    backupCount = int(_env("FEEDER_LOG_BACKUPS", 5)) if backupCount is None else backupCount
+    rotateWhen = _env("FEEDER_LOG_ROTATE_WHEN", "") if rotateWhen is None else rotateWhen
+
+    formatter = JsonFormatter() if jsonFormat else logging.Formatter(_TEXT_FORMAT)
+    handlers = []
+    if console:
+        handlers.append(logging.StreamHandler())
+    if logFile:
+        directory = os.path.dirname(logFile)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if rotateWhen:
+            handlers.append(logging.handlers.TimedRotatingFileHandler(logFile, when=rotateWhen, backupCount=backupCount))
+        else:
+            handlers.append(logging.handlers.RotatingFileHandler(logFile, maxBytes=maxBytes, backupCount=backupCount))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    stopLogging()
+    records = queue.Queue(-1)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        if _listenerPid == os.getpid():
+            handler.close()
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    _listenerPid = os.getpid()
+    return _listener
+
+def stopLogging():
+    """
+        Writes the queued log records and stops the background thread, records logged afterwards are written directly
+        by the handlers. Call before os._exit, which skips atexit.
+    """
+    global _listener, _listenerPid
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    if _listenerPid != os.getpid():
+        # Started by the parent of this forked process, its thread and queue lock do not exist here
+        return
+    listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler) and handler.queue is listener.queue:
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
+
+atexit.register(stopLogging)
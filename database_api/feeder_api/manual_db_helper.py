@@ -7,13 +7,16 @@ from pprint import pprint
 from random import randint, randrange
 import datetime as dt
 
+try:
+    from . import clock
+except ImportError: # run as a script from the feeder_api folder
+    import clock
+
 EVENT_PROPERTIES = ["feederId", "address", "type", "time", "count"]
 
 
 _client = MongoClient("mongodb+srv://<MongoDB username>:<MongoDB password>@<MongoDB address>/<dbname>?retryWrites=true&w=majority")
-db = client.test
-
-db = client["smartfeeder"]
+db = _client["smartfeeder"]
 feeders = db["feeders"]
 users = db["users"]
 jobs = db["jobs_scheduled"]
@@ -112,7 +115,7 @@ def addScheduleItem(feederId, item=None, scheduleType="R", time=dt.datetime(2000
     updateFeederNextFeed(feederId)
 
     # add to job queue if it is due later today
-    if nextScheduleOccurrence(scheduleItem).date() <= dt.datetime.now().date():
+    if nextScheduleOccurrence(scheduleItem).date() <= clock.now().date():
         event = createEventFromScheduleItem(feederId, scheduleItem)
         insertScheduleEvents([event])
 
@@ -262,7 +265,7 @@ def clearSchedule():
 
 def getReadyEvents():
     """MOVE TO DB_HELPER"""
-    events = list( jobs.find({"time": {"$lte": dt.datetime.now()} }) )
+    events = list( jobs.find({"time": {"$lte": clock.now()} }) )
     for event in events:
         event["_id"] = str(event["_id"])
         event["feederId"] = str(event["feederId"])
@@ -289,12 +292,16 @@ def getFeedingLogs(feederId, limit=30):
 
 # Feeder ongoing food consumption
 def logOngoingConsumption(feederId, amount):
-    now = dt.datetime.now().replace(minute=0, second=0, microsecond=0)
+    now = clock.now().replace(minute=0, second=0, microsecond=0)
     hourlySumary = hourlyLogs.find_one_and_update({"feederId": ObjectId(feederId), "hour": now}, {'$inc': {'foodEaten': amount}}, return_document=ReturnDocument.AFTER)
     if hourlySumary == None:
         hourlyLogs.insert_one({"feederId": ObjectId(feederId), "hour": now, "foodEaten": amount})
 
-def getOngoingConsumptionLogs(feederId, start=dt.datetime.now() - dt.timedelta(30), end=dt.datetime.now()):
+def getOngoingConsumptionLogs(feederId, start=None, end=None):
+    if end is None:
+        end = clock.now()
+    if start is None:
+        start = end - dt.timedelta(30)
     data = hourlyLogs.find({"feederId": ObjectId(feederId), "hour": {"$gte": start, "$lte": end} })
     data = list(data)
     for datum in data:
@@ -321,19 +328,20 @@ def nextScheduleOccurrence(scheduleItem):
         return scheduleItem["time"]
 
 def _nextRepeatingScheduleOccurrence(scheduleItem):
-    now = dt.datetime.now()
+    now = clock.now()
     schedule = scheduleItem["time"]
     dispenseTimeToday = now.replace(hour=schedule.hour, minute=schedule.minute, second=0, microsecond=0)
     if scheduleItem["unit"] == "days":
         every = scheduleItem["every"]
         yday = now.timetuple().tm_yday
-        daysUntilFeed = yday % every
+        # Feeds on the days of the year that are a multiple of every
+        daysUntilFeed = -yday % every
         if daysUntilFeed == 0 and dispenseTimeToday < now:
-            daysUntilFeed += 1
+            daysUntilFeed += every
         return dispenseTimeToday + dt.timedelta(daysUntilFeed)
 
 def _nextWeeklyScheduleOccurrence(scheduleItem):
-    now = dt.datetime.now()
+    now = clock.now()
     schedule = scheduleItem["time"]
     dispenseTimeToday = now.replace(hour=schedule.hour, minute=schedule.minute, second=0, microsecond=0)
 
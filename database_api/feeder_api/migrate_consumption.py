@@ -0,0 +1,65 @@
+"""
+Migrates the ongoing consumption logs from the hourly layout (one document per feeder per hour in
+"hourly_consumption") to the day-bucketed layout (one document per feeder per day in "daily_consumption").
+
+Usage:
+    python -m feeder_api.migrate_consumption [--until "2020-10-20 13:00"] [--batch_size 1000]
+
+The migration only sets the hourly slots that have a source document, so it is safe to re-run. Run it once
+while still on the hourly layout, switch FEEDER_CONSUMPTION_LAYOUT to "daily" and restart the servers, then
+run it again with --until set to the hour of the switch to copy the hours logged in between.
+"""
+import argparse
+import datetime as dt
+
+from . import db_helper
+
+def migrateHourlyToDaily(until=None, batchSize=1000):
+    """
+        Copies every hourly consumption document older than "until" (defaults to the start of the current hour)
+        into the day-bucketed layout. Returns the number of hourly documents migrated.
+    """
+    if until is None:
+        until = dt.datetime.now().replace(minute=0, second=0, microsecond=0)
+
+    migrated = 0
+    batch = {}
+    cursor = db_helper.hourlyLogs.find({"hour": {"$lt": until} },
+                                        projection={"_id": 0, "feederId": 1, "hour": 1, "foodEaten": 1},
+                                        batch_size=batchSize)
+    for datum in cursor:
+        key = (str(datum["feederId"]), datum["hour"])
+        batch[key] = batch.get(key, 0) + datum.get("foodEaten", 0)
+        migrated += 1
+        if len(batch) >= batchSize:
+            db_helper._writeDailySlots(batch, "$set")
+            batch = {}
+    if len(batch) > 0:
+        db_helper._writeDailySlots(batch, "$set")
+    return migrated
+
+def countDocuments():
+    """
+        Counts the documents in both layouts to compare their size.
+    """
+    return {"hourly": db_helper.hourlyLogs.estimated_document_count(),
+            "daily": db_helper.dailyLogs.estimated_document_count()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrates hourly consumption logs to the day-bucketed layout")
+    parser.add_argument("--until", type=lambda s: dt.datetime.strptime(s, "%Y-%m-%d %H:%M"), default=None,
+                        help="Only migrate hours before this time, formatted as \"YYYY-MM-DD HH:MM\" [default=current hour]")
+    parser.add_argument("--batch_size", type=int, default=1000,
+                        help="The number of hourly documents written per bulk write [default=1000]")
+    args = parser.parse_args()
+
+    # Brings the consumption indexes in line before copying, e.g. the unique index of the hourly logs
+    for collectionName, name, action in db_helper.ensureIndexes(rebuild=True):
+        if action.startswith("conflict"):
+            print("Index %s.%s: %s" % (collectionName, name, action))
+    migrated = migrateHourlyToDaily(until=args.until, batchSize=args.batch_size)
+    print("Migrated %d hourly documents" % migrated)
+    print("Documents per layout: %s" % countDocuments())
+
+if __name__ == "__main__":
+    main()
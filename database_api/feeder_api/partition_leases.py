@@ -0,0 +1,93 @@
+"""
+Splits the scheduler partitions of the feeders between the running scheduler workers.
+
+Each worker holds the partitions it schedules through lease documents (scheduler_leases, one per partition) that
+expire ttl seconds after its last heartbeat, and records that it is alive in scheduler_workers. On every heartbeat a
+worker renews its leases, counts the live workers and aims for an equal share of the partitions: it gives back the
+partitions over its share and takes free or expired ones up to it. A worker that dies stops renewing, so its
+partitions expire and are taken over by the others within ttl seconds and a heartbeat.
+"""
+
+import datetime as dt
+import logging
+import math
+import os
+import random
+import socket
+
+from . import clock, db_helper
+
+class PartitionLeases:
+    """
+        The partitions held by one scheduler worker.
+
+        Intance Variables:
+            owner:
+                The id of the worker in the lease documents
+            ttl:
+                The number of seconds a lease lasts without a heartbeat
+            owned:
+                The partitions the worker holds
+    """
+
+    def __init__(self, owner=None, ttl=30.0, partitions=None):
+        """
+            owner (str): the id of the worker, "<host>:<pid>" if None
+            ttl (float): the number of seconds a lease lasts without a heartbeat
+            partitions (int): the number of partitions, db_helper.SCHEDULER_PARTITIONS if None
+        """
+        self.owner = owner or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.partitions = partitions or db_helper.SCHEDULER_PARTITIONS
+        self.owned = set()
+        self.logger = logging.getLogger(__name__)
+
+    def share(self, workers):
+        """
+            Gets the number of partitions each of that many workers should hold.
+        """
+        return math.ceil(self.partitions / max(1, workers))
+
+    def heartbeat(self):
+        """
+            Renews the leases of the worker and rebalances the partitions.
+
+            Returns:
+                    (gained, lost): the sets of partitions the worker took and the ones it gave back or lost
+        """
+        before = set(self.owned)
+        workers = db_helper.heartbeatSchedulerWorker(self.owner, self.ttl)
+        owned = db_helper.renewSchedulerLeases(self.owner, self.ttl)
+        share = self.share(len(workers))
+
+        if len(owned) > share:
+            extra = sorted(owned)[share:]
+            db_helper.releaseSchedulerPartitions(self.owner, extra)
+            owned -= set(extra)
+        elif len(owned) < share:
+            leases = {partition: (owner, expiresAt) for partition, owner, expiresAt, _ in db_helper.getSchedulerLeases()}
+            now = clock.now()
+            free = [partition for partition in range(self.partitions) if partition not in owned and (
+                    partition not in leases or leases[partition][0] is None or leases[partition][1] < now)]
+            # Workers starting together try the free partitions in different orders
+            random.shuffle(free)
+            for partition in free:
+                if len(owned) >= share:
+                    break
+                if db_helper.claimSchedulerPartition(partition, self.owner, self.ttl) is not None:
+                    owned.add(partition)
+
+        self.owned = owned
+        gained, lost = owned - before, before - owned
+        if gained or lost:
+            self.logger.info("Worker %s holds %d partitions (%d workers), took %d and gave up %d",
+                             self.owner, len(owned), len(workers), len(gained), len(lost))
+        return gained, lost
+
+    def releaseAll(self):
+        """
+            Gives back every partition and leaves the workers, so the others take over at their next heartbeat.
+        """
+        db_helper.releaseSchedulerPartitions(self.owner, self.owned)
+        db_helper.removeSchedulerWorker(self.owner)
+        self.owned = set()
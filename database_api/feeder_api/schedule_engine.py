@@ -0,0 +1,294 @@
+"""
+Timer heap that runs callbacks at the next occurrence of schedules, used by the scheduler instead of polling the
+database every minute.
+
+Each entry has a key, a function giving its next occurrence and a callback. The engine keeps a min-heap of the next
+occurrence of every entry and sleeps until the earliest one, so a callback runs at its due time and nothing runs while
+nothing is due. Changing or removing an entry wakes the engine, so a schedule that becomes due sooner is never missed.
+Replaced entries are left in the heap and skipped when they reach the top.
+
+ScheduleEngine runs the callbacks in a thread of its own (run blocks), AsyncScheduleEngine runs them on an asyncio
+event loop.
+"""
+
+import asyncio
+import datetime as dt
+import heapq
+import itertools
+import logging
+import threading
+
+from . import clock
+
+# Occurrences are searched for strictly after the time an entry ran, so an entry never runs twice for one occurrence
+_TICK = dt.timedelta(microseconds=1)
+
+class _TimerHeap:
+    """
+        The heap and entries shared by the engines. Not thread safe, ScheduleEngine locks around it.
+    """
+
+    def __init__(self, now=clock.now):
+        """
+            now (function): gives the current time as a naive datetime, the schedules are in local time
+        """
+        self.now = now
+        self.runs = 0
+        self._heap = [] # (when, sequence, key)
+        self._entries = {} # key -> (when, sequence, nextOccurrence, callback)
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def nextRun(self, key):
+        """
+            Gets the time an entry runs next, or None if there is no such entry.
+        """
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def _put(self, key, nextOccurrence, callback, after):
+        when = nextOccurrence(after)
+        if when is None:
+            self._entries.pop(key, None)
+            return None
+        sequence = next(self._sequence)
+        self._entries[key] = (when, sequence, nextOccurrence, callback)
+        heapq.heappush(self._heap, (when, sequence, key))
+        return when
+
+    def _remove(self, key):
+        return self._entries.pop(key, None) is not None
+
+    def _head(self):
+        # Drops the replaced and removed entries from the top of the heap
+        heap = self._heap
+        while heap:
+            when, sequence, key = heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == sequence:
+                return when
+            heapq.heappop(heap)
+        return None
+
+    def _popDue(self, now):
+        """
+            Takes the entries due at now off the heap and schedules their next occurrence.
+
+            Returns:
+                    due (list): (key, when, callback) of the entries to run
+        """
+        due = []
+        while True:
+            when = self._head()
+            if when is None or when > now:
+                return due
+            _, sequence, key = heapq.heappop(self._heap)
+            _, _, nextOccurrence, callback = self._entries[key]
+            due.append((key, when, callback))
+            # A one off entry gives the same (or no) occurrence again and ends here
+            following = nextOccurrence(when + _TICK)
+            if following is None or following <= when:
+                del self._entries[key]
+            else:
+                sequence = next(self._sequence)
+                self._entries[key] = (following, sequence, nextOccurrence, callback)
+                heapq.heappush(self._heap, (following, sequence, key))
+
+    def compact(self):
+        """
+            Rebuilds the heap without the replaced and removed entries, e.g. after reloading every schedule.
+        """
+        self._heap = [(entry[0], entry[1], key) for key, entry in self._entries.items()]
+        heapq.heapify(self._heap)
+
+class ScheduleEngine(_TimerHeap):
+    """
+        Runs the callbacks of the entries at their next occurrences from the thread that calls run.
+
+        The entries can be changed from any thread, a change that makes an entry due earlier wakes the engine. The
+        sleep is cut into maxSleep second parts so a change of the system clock delays a run by at most maxSleep.
+    """
+
+    def __init__(self, now=clock.now, maxSleep=3600.0):
+        """
+            now (function): gives the current time as a naive datetime
+            maxSleep (float): the longest the engine sleeps before checking the clock again
+        """
+        super().__init__(now=now)
+        self.maxSleep = maxSleep
+        self.stopping = False
+        self._condition = threading.Condition()
+        self.logger = logging.getLogger(__name__)
+
+    def schedule(self, key, nextOccurrence, callback):
+        """
+            Adds an entry, or replaces the entry with the same key.
+
+                Parameters:
+                        key: identifies the entry, e.g. (feederId, scheduleItemIndex)
+                        nextOccurrence (function): gives the first occurrence at or after the datetime it is called
+                                                   with, or None if there is none
+                        callback (function): called with the key and the occurrence when it is due
+                Returns:
+                        when (datetime): the next occurrence, or None if the entry never runs
+        """
+        with self._condition:
+            head = self._head()
+            when = self._put(key, nextOccurrence, callback, self.now())
+            if when is not None and (head is None or when < head):
+                self._condition.notify()
+            return when
+
+    def remove(self, key):
+        """
+            Removes an entry. Returns whether there was such an entry.
+        """
+        with self._condition:
+            return self._remove(key)
+
+    def compact(self):
+        with self._condition:
+            super().compact()
+
+    def nextDue(self):
+        """
+            Gets the earliest next occurrence of the entries, or None if there are no entries.
+        """
+        with self._condition:
+            return self._head()
+
+    def runPending(self):
+        """
+            Runs the callbacks due at the current time from the calling thread, without waiting for the next ones.
+            Used instead of run to step the engine along a virtual clock.
+
+            Returns the number of callbacks run.
+        """
+        with self._condition:
+            due = self._popDue(self.now())
+        self._runCallbacks(due)
+        return len(due)
+
+    def _runCallbacks(self, due):
+        for key, when, callback in due:
+            self.runs += 1
+            try:
+                callback(key, when)
+            except Exception:
+                self.logger.exception("Scheduled callback of {} failed".format(key))
+
+    def run(self):
+        """
+            Runs the due callbacks until stop is called. A callback that raises is logged and its entry keeps its
+            following occurrences.
+        """
+        with self._condition:
+            while not self.stopping:
+                now = self.now()
+                due = self._popDue(now)
+                if len(due) == 0:
+                    head = self._head()
+                    delay = self.maxSleep if head is None else (head - now).total_seconds()
+                    self._condition.wait(min(delay, self.maxSleep))
+                    continue
+
+                self._condition.release()
+                try:
+                    self._runCallbacks(due)
+                finally:
+                    self._condition.acquire()
+
+    def stop(self):
+        """
+            Makes run return after the callbacks that are running, run cannot be called again afterwards.
+        """
+        with self._condition:
+            self.stopping = True
+            self._condition.notify()
+
+class AsyncScheduleEngine(_TimerHeap):
+    """
+        Runs the callbacks of the entries at their next occurrences on an asyncio event loop, with one timer handle
+        for the earliest entry. Callbacks that return a coroutine are run as tasks.
+
+        Must only be used from the thread of the event loop.
+    """
+
+    def __init__(self, now=clock.now, maxSleep=3600.0, loop=None):
+        """
+            now (function): gives the current time as a naive datetime
+            maxSleep (float): the longest the engine sleeps before checking the clock again
+            loop: the event loop to run on, the current event loop if None
+        """
+        super().__init__(now=now)
+        self.maxSleep = maxSleep
+        self._loop = loop or asyncio.get_event_loop()
+        self._handle = None
+        self._handleWhen = None
+        self._started = False
+        self.logger = logging.getLogger(__name__)
+
+    def schedule(self, key, nextOccurrence, callback):
+        """
+            Adds an entry, or replaces the entry with the same key. See ScheduleEngine.schedule.
+        """
+        when = self._put(key, nextOccurrence, callback, self.now())
+        if self._started and when is not None and (self._handleWhen is None or when < self._handleWhen):
+            self._rearm()
+        return when
+
+    def remove(self, key):
+        """
+            Removes an entry. Returns whether there was such an entry.
+        """
+        return self._remove(key)
+
+    def start(self):
+        """
+            Starts running the due callbacks.
+        """
+        self._started = True
+        self._rearm()
+
+    def stop(self):
+        """
+            Stops running callbacks, the entries are kept.
+        """
+        self._started = False
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._handleWhen = None
+
+    def _rearm(self):
+        if self._handle is not None:
+            self._handle.cancel()
+        head = self._head()
+        now = self.now()
+        delay = self.maxSleep if head is None else (head - now).total_seconds()
+        self._handleWhen = head
+        self._handle = self._loop.call_later(max(0.0, min(delay, self.maxSleep)), self._fire)
+
+    def _fire(self):
+        self._handle = None
+        for key, when, callback in self._popDue(self.now()):
+            self.runs += 1
+            try:
+                result = callback(key, when)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(self._guard(key, result), loop=self._loop)
+            except Exception:
+                self.logger.exception("Scheduled callback of {} failed".format(key))
+        if self._started:
+            self._rearm()
+
+    async def _guard(self, key, coroutine):
+        try:
+            await coroutine
+        except Exception:
+            self.logger.exception("Scheduled callback of {} failed".format(key))
@@ -0,0 +1,142 @@
+"""
+Next occurrences of many schedule items at once with NumPy, giving the same times as db_helper.nextScheduleOccurrence.
+
+The schedule items are first encoded into columns (encodeScheduleItems), one entry per item:
+    kind            0 repeating ('R'), 1 weekly ('W'), 2 single ('S'), -1 no next occurrence (e.g. a unit other than days)
+    minuteOfDay     the minute of the day of 'R' and 'W' items
+    every           the number of days between feeds of 'R' items
+    weekdayMask     bit d is set if a 'W' item feeds on weekday d (0 is Monday)
+    singleTime      the time of 'S' items (datetime64[us])
+and nextOccurrences then computes every next occurrence with datetime64 arithmetic against one reference time.
+
+A weekly item listing the same day twice is treated as listing it once.
+"""
+
+import datetime as dt
+
+try:
+    import numpy as np
+except ImportError: # NumPy is optional, install the "vector" extra of the package
+    np = None
+
+from . import clock
+
+KIND_REPEATING = 0
+KIND_WEEKLY = 1
+KIND_SINGLE = 2
+KIND_NONE = -1
+
+_KINDS = {"R": KIND_REPEATING, "W": KIND_WEEKLY, "S": KIND_SINGLE}
+
+def available():
+    """
+        Checks if NumPy is installed.
+    """
+    return np is not None
+
+def _requireNumpy():
+    if np is None:
+        raise RuntimeError("NumPy is required for vectorized schedules, install pet-feeder-api[vector]")
+
+# Index of the lowest set bit of every 7 bit weekday mask, 7 for an empty mask
+_LOWEST_DAY = None
+
+def _lowestDay():
+    global _LOWEST_DAY
+    if _LOWEST_DAY is None:
+        table = np.full(128, 7, dtype=np.int64)
+        for mask in range(1, 128):
+            table[mask] = (mask & -mask).bit_length() - 1
+        _LOWEST_DAY = table
+    return _LOWEST_DAY
+
+def encodeScheduleItems(items):
+    """
+        Encodes schedule items into the columns nextOccurrences works on.
+
+            Parameters:
+                    items (list): schedule items as stored in the feedSchedule of feeders
+            Returns:
+                    columns (dict): the kind, minuteOfDay, every, weekdayMask and singleTime arrays
+    """
+    _requireNumpy()
+    count = len(items)
+    kind = np.empty(count, dtype=np.int8)
+    minuteOfDay = np.zeros(count, dtype=np.int64)
+    every = np.ones(count, dtype=np.int64)
+    weekdayMask = np.zeros(count, dtype=np.int64)
+    singleTime = np.full(count, np.datetime64("NaT"), dtype="datetime64[us]")
+
+    for index, item in enumerate(items):
+        itemKind = _KINDS.get(item["type"], KIND_SINGLE)
+        if itemKind == KIND_SINGLE:
+            singleTime[index] = item["time"]
+        else:
+            time = item["time"]
+            minuteOfDay[index] = time.hour * 60 + time.minute
+            if itemKind == KIND_REPEATING:
+                if item.get("unit") == "days":
+                    every[index] = item["every"]
+                else:
+                    itemKind = KIND_NONE
+            else:
+                mask = 0
+                for day in item["days"]:
+                    mask |= 1 << day
+                weekdayMask[index] = mask
+        kind[index] = itemKind
+
+    return {"kind": kind, "minuteOfDay": minuteOfDay, "every": every, "weekdayMask": weekdayMask,
+            "singleTime": singleTime}
+
+def nextOccurrences(columns, now=None):
+    """
+        Computes the next occurrence of every encoded schedule item at or after now.
+
+            Parameters:
+                    columns (dict): the columns of encodeScheduleItems
+                    now (datetime): the reference time, the current time if None
+            Returns:
+                    occurrences (ndarray): datetime64[us] next occurrences, NaT where an item has none
+    """
+    _requireNumpy()
+    if now is None:
+        now = clock.now()
+    kind = columns["kind"]
+    reference = np.datetime64(now, "us")
+    midnight = np.datetime64(now.date(), "us")
+    timeToday = midnight + columns["minuteOfDay"].astype("timedelta64[m]")
+    passedToday = timeToday < reference
+
+    # Repeating: the days until the next day of the year that is a multiple of every, every days later if that is
+    # today and the time has passed
+    yday = now.timetuple().tm_yday
+    every = columns["every"]
+    repeatingDays = -yday % every
+    repeatingDays = repeatingDays + every * ((repeatingDays == 0) & passedToday)
+
+    # Weekly: the mask rotated so that bit k is k days from today, today's bit dropped if its time has passed
+    weekday = now.weekday()
+    mask = columns["weekdayMask"]
+    rotated = ((mask >> weekday) | (mask << (7 - weekday))) & 0x7F
+    rotated = np.where(passedToday & (rotated > 1), rotated & ~1, rotated)
+    weeklyDays = _lowestDay()[rotated]
+    # An item feeding only today, after its time, feeds again in a week
+    weeklyDays = np.where(passedToday & (rotated == 1), 7, weeklyDays)
+
+    days = np.where(kind == KIND_REPEATING, repeatingDays, weeklyDays)
+    occurrences = timeToday + days.astype("timedelta64[D]")
+    occurrences = np.where(kind == KIND_SINGLE, columns["singleTime"], occurrences)
+    occurrences = np.where((kind == KIND_NONE) | ((kind == KIND_WEEKLY) & (mask == 0)),
+                           np.datetime64("NaT"), occurrences)
+    return occurrences.astype("datetime64[us]")
+
+def nextScheduleOccurrences(items, now=None):
+    """
+        Calculates the next feeding time of every schedule item, like db_helper.nextScheduleOccurrence for each.
+
+        Returns a list of datetimes, None where an item has no next occurrence.
+    """
+    occurrences = nextOccurrences(encodeScheduleItems(items), now)
+    # NaT converts to None, the other times to naive datetimes
+    return occurrences.tolist()
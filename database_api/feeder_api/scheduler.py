@@ -1,50 +1,388 @@
-import schedule
+"""
+Dispatches the scheduled feeds when they are due and creates the jobs of each day at midnight.
+
+The schedule items of every feeder are kept in a ScheduleEngine, which sleeps until the next item is due instead of
+polling the job queue every minute. Changes to the schedules and the single (one off) jobs booked during the day are
+followed with MongoDB change streams, and both are reloaded every --resync_interval seconds in case the change streams
+are unavailable.
+
+Several schedulers can run at once, each holding a share of the feeder partitions through leases (see
+partition_leases), and the partitions of a scheduler that stops or dies are taken over by the others.
+
+Run from the database_api folder (or with the package installed) with "python -m feeder_api.scheduler".
+"""
+
+import argparse
+import datetime as dt
+import functools
+import logging
+import signal
+import threading
 import time
 from random import randint
-from datetime import datetime
 
-import manual_db_helper
-from bson import ObjectId
+from . import clock, db_helper, log_setup
+from .schedule_engine import ScheduleEngine
+from .partition_leases import PartitionLeases
+
+logger = logging.getLogger(__name__)
+
+# Repeats every day at midnight, when the jobs of the day are created
+_MIDNIGHT = {"type": "R", "time": dt.datetime(2000, 1, 1, 0, 0), "every": 1, "unit": "days"}
 
-def processScheduledJobs():
+def dispatchFeederJobs(feederIds):
     """
-    Connects to the database and checks queue for any jobs that were set to be dispatched at or before (current time + some small delta).
-    If any jobs are found, CoAP server is signaled to dispense the job.
+        Dispatches the jobs of the feeders that are due, logging the feeding results and removing them from the job
+        queue, in the same few round trips however many feeders are given.
+    """
+    dispatched = db_helper.dispatchReadyEventsForFeeders(feederIds)
+    for jobs in dispatched.values():
+        for job in jobs:
+            logger.info("[JOB] %s %s %s %s | Currently %s", job["feederId"], job["address"], job["time"], job["count"], clock.now())
 
+def dispatchReadyJobs(partitions=None):
+    """
+        Dispatches every job in the job queue that is due, or the due jobs of the feeders in the given partitions, e.g.
+        the jobs that came due while no scheduler held their partitions.
     """
-    jobs = manual_db_helper.getReadyEvents()
-    for job in jobs:
-        print("[JOB] ", job["feederId"], job["address"], job["time"], job["count"], " | Currently ", datetime.now())
-        manual_db_helper.logFeedingResult(job["feederId"], job["type"], datetime.now(), job["count"], "OK")
-        manual_db_helper.deleteScheduledEventById(job["_id"])
+    dispatchFeederJobs({job["feederId"] for job in db_helper.getReadyEvents()
+                        if partitions is None or db_helper.feederPartition(job["feederId"]) in partitions})
 
-def scheduleJobs():
+def scheduleJobs(workers=1, partitions=None):
     """
-    Runs once a day and loops over all feeders. Creates a scheduled job in collection for any dispenses that should happen today.
+        Runs once a day and loops over all feeders (or the feeders in the given partitions). Creates a scheduled job in
+        collection for any dispenses that should happen today.
 
-    *Note that jobs should also be spawned when users update a feeder's schedule or schedule a one time job.*
+        *Note that jobs should also be spawned when users update a feeder's schedule or schedule a one time job.*
     """
-    feeders = manual_db_helper.getAllFeeders()
-    for feeder in feeders:
-        jobsToRun = []
-        for sched in feeder["feedSchedule"]:
-            nextOccurrence = manual_db_helper.nextScheduleOccurrence(sched)
-            if nextOccurrence.date() <= datetime.now().date():
-                jobsToRun.append( manual_db_helper.createEventFromScheduleItem(feeder["_id"], sched) )
-        if len(jobsToRun) > 0:
-            manual_db_helper.insertScheduleEvents(jobsToRun)
+    start = time.perf_counter()
+    inserted = db_helper.materializeDailyJobs(workers=workers, partitions=partitions)
+    logger.info("Created %d jobs for today in %.2fs", inserted, time.perf_counter() - start)
 
-def sendDeltaFood():
+def sendDeltaFood(feederId):
     delta = randint(0, 5)
-    print("[DELTA FOOD] ", delta)
-    manual_db_helper.logOngoingConsumption("5f719654cb197055601f11ca", delta)
+    logger.info("[DELTA FOOD] %d", delta)
+    db_helper.logOngoingConsumption(feederId, delta)
+
+class Scheduler:
+    """
+        Keeps the schedule items of the feeders in the partitions this worker holds in a ScheduleEngine and dispatches
+        the jobs of a feeder when one of its items is due. The feeders whose items are due at the same time are
+        dispatched together.
+
+        The leases are renewed from a thread of their own, so a burst of due items or the takeover of many partitions
+        never delays a renewal past the lease ttl. The partitions lost are unloaded by that thread at once, and the
+        partitions gained are taken over (their jobs created, their overdue jobs dispatched and their schedules loaded)
+        by the engine.
+
+        Any number of schedulers can run at once, on one or several machines. The feeders are split into hash
+        partitions that the schedulers hold through leases (see partition_leases), so each feeder is scheduled by one
+        of them and the partitions of a scheduler that stops are taken over by the others.
+
+        Intance Variables:
+            engine:
+                The timer heap of the schedule items and the daily tasks
+            leases:
+                The partitions this worker holds
+            resyncInterval:
+                The number of seconds between reloads of every schedule from the database
+            retryInterval:
+                The number of seconds to wait before reopening a failed change stream
+            materializeWorkers:
+                The number of threads creating the jobs of each day, each from its own range of feeders
+    """
+
+    def __init__(self, resyncInterval=3600.0, retryInterval=30.0, testFeederId=None, engine=None, materializeWorkers=1,
+                 leases=None):
+        """
+            resyncInterval (float): the number of seconds between reloads of every schedule
+            retryInterval (float): the number of seconds to wait before reopening a failed change stream
+            testFeederId (str): logs random amounts of food eaten every minute for this feeder, for testing the website
+            engine (ScheduleEngine): the engine to schedule on, a new ScheduleEngine if None
+            materializeWorkers (int): the number of threads creating the jobs of each day
+            leases (PartitionLeases): the partition leases of this worker, a new PartitionLeases if None
+        """
+        self.engine = engine if engine is not None else ScheduleEngine()
+        self.leases = leases or PartitionLeases()
+        self.resyncInterval = resyncInterval
+        self.retryInterval = retryInterval
+        self.testFeederId = testFeederId
+        self.materializeWorkers = materializeWorkers
+        self._itemCounts = {} # feederId -> number of schedule items in the engine
+        self._singleJobs = {} # feederId -> times of the single jobs in the engine
+        self._dueFeeders = set() # feeders with an item due, dispatched together by _dispatchDue
+        self._gained = set() # partitions gained and not taken over yet
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @property
+    def partitions(self):
+        return self.leases.owned
+
+    def setFeederSchedule(self, feederId, feedSchedule):
+        """
+            Replaces the schedule items of a feeder in the engine. Items that already ran today are not run again as
+            only occurrences from now on are scheduled.
+        """
+        with self._lock:
+            previous = self._itemCounts.get(feederId, 0)
+            for index, item in enumerate(feedSchedule):
+                self.engine.schedule((feederId, index), functools.partial(db_helper.nextScheduleOccurrence, item),
+                                     self._itemDue)
+            for index in range(len(feedSchedule), previous):
+                self.engine.remove((feederId, index))
+            if len(feedSchedule) > 0:
+                self._itemCounts[feederId] = len(feedSchedule)
+            else:
+                self._itemCounts.pop(feederId, None)
+
+    def removeFeeder(self, feederId):
+        """
+            Removes the schedule items of a deleted feeder.
+        """
+        self.setFeederSchedule(feederId, [])
+
+    def loadSchedules(self, partitions=None):
+        """
+            Loads the schedule of every feeder in the partitions (all the partitions held if None), removing the
+            feeders that no longer exist.
+        """
+        partitions = set(self.partitions if partitions is None else partitions)
+        seen = set()
+        for feederId, feedSchedule in db_helper.getFeederSchedules(partitions):
+            seen.add(feederId)
+            self.setFeederSchedule(feederId, feedSchedule)
+        for feederId in list(self._itemCounts):
+            if feederId not in seen and db_helper.feederPartition(feederId) in partitions:
+                self.removeFeeder(feederId)
+        self.engine.compact()
+        logger.info("Loaded the schedules of %d feeders (%d items)", len(self._itemCounts), len(self.engine))
+
+    def unloadPartitions(self, partitions):
+        """
+            Removes the feeders of partitions this worker no longer holds.
+        """
+        for feederId in list(self._itemCounts):
+            if db_helper.feederPartition(feederId) in partitions:
+                self.removeFeeder(feederId)
+        with self._lock:
+            for feederId in list(self._singleJobs):
+                if db_helper.feederPartition(feederId) in partitions:
+                    for time in self._singleJobs.pop(feederId):
+                        self.engine.remove((feederId, "S", time))
+        self.engine.compact()
+
+    def scheduleSingleJob(self, feederId, time):
+        """
+            Dispatches the jobs of a feeder at the time of one of its single (one off) jobs. The single items are
+            removed from the feeders when their jobs are created, so their schedule items are never in the engine.
+        """
+        with self._lock:
+            self._singleJobs.setdefault(feederId, set()).add(time)
+            self.engine.schedule((feederId, "S", time), lambda after, time=time: time, self._singleJobDue)
+
+    def scheduleSingleJobs(self, partitions):
+        """
+            Dispatches the pending single jobs of the partitions at their times.
+        """
+        for feederId, time in db_helper.getPendingEventTimes(eventType="S"):
+            if db_helper.feederPartition(feederId) in partitions:
+                self.scheduleSingleJob(feederId, time)
+
+    def materializePartitions(self, partitions):
+        """
+            Creates today's jobs of the partitions whose jobs have not been created today yet, by any worker.
+        """
+        today = clock.now().date()
+        done = {partition for partition, _, _, day in db_helper.getSchedulerLeases() if day == today.isoformat()}
+        pending = sorted(set(partitions) - done)
+        if len(pending) > 0:
+            scheduleJobs(self.materializeWorkers, pending)
+            for partition in pending:
+                db_helper.markPartitionMaterialized(partition, self.leases.owner, today)
+        self.scheduleSingleJobs(partitions)
+
+    def heartbeat(self):
+        """
+            Renews the leases of this worker and rebalances the partitions. Only unloads the partitions it lost, the
+            ones it gained are taken over by the engine as soon as it is free (see _takeOver).
+        """
+        gained, lost = self.leases.heartbeat()
+        if lost:
+            self.unloadPartitions(lost)
+        if gained:
+            with self._lock:
+                self._gained |= gained
+            now = clock.now()
+            self.engine.schedule("takeover", lambda after: now, self._takeOver)
+
+    def start(self):
+        """
+            Ensures the indexes of the job queue, takes a share of the partitions and schedules their takeover (see
+            _takeOver) and the daily and resync tasks. Neither the engine nor the lease renewal is run, see run.
+        """
+        # The unique occurrenceKey index keeps the jobs created by several workers from being queued twice
+        for collectionName, name, action in db_helper.ensureIndexes():
+            if action.startswith("conflict"):
+                logger.warning("Index %s.%s not rebuilt on startup (%s), run python -m feeder_api.indexes",
+                               collectionName, name, action)
+        db_helper.assignFeederPartitions()
+        self.heartbeat()
+
+        self.engine.schedule("scheduleJobs", functools.partial(db_helper.nextScheduleOccurrence, _MIDNIGHT), self._midnight)
+        self.engine.schedule("resync", self._nextResync, lambda key, when: self._resync())
+        if self.testFeederId is not None:
+            self.engine.schedule("sendDeltaFood", _nextMinute, lambda key, when: sendDeltaFood(self.testFeederId))
+
+    def run(self):
+        """
+            Starts the scheduler, then renews the leases and dispatches the jobs as they come due until stop is called.
+        """
+        self.start()
+        renewer = threading.Thread(target=self._renewLeases, name="lease-renewer", daemon=True)
+        renewer.start()
+        threading.Thread(target=self._watchSchedules, name="schedule-watcher", daemon=True).start()
+        threading.Thread(target=self._watchSingleJobs, name="single-job-watcher", daemon=True).start()
+        try:
+            self.engine.run()
+        finally:
+            # A heartbeat running after the release would take partitions again
+            self._stopped.set()
+            renewer.join()
+            self.leases.releaseAll()
+
+    def stop(self):
+        self._stopped.set()
+        self.engine.stop()
+
+    def _itemDue(self, key, when):
+        # The items due together are popped off the engine together, and the dispatch entry runs once they all ran
+        with self._lock:
+            self._dueFeeders.add(key[0])
+        self.engine.schedule("dispatch", lambda after: when, self._dispatchDue)
+
+    def _singleJobDue(self, key, when):
+        with self._lock:
+            times = self._singleJobs.get(key[0])
+            if times is not None:
+                times.discard(key[2])
+                if len(times) == 0:
+                    del self._singleJobs[key[0]]
+        self._itemDue(key, when)
+
+    def _dispatchDue(self, key, when):
+        with self._lock:
+            feederIds, self._dueFeeders = self._dueFeeders, set()
+        # The partitions lost since the items came due are left to their new holders
+        partitions = self.partitions
+        dispatchFeederJobs([feederId for feederId in feederIds if db_helper.feederPartition(feederId) in partitions])
+
+    def _takeOver(self, key, when):
+        with self._lock:
+            gained, self._gained = self._gained, set()
+        gained &= self.partitions
+        if gained:
+            self.materializePartitions(gained)
+            dispatchReadyJobs(gained)
+            self.loadSchedules(gained)
+            # A partition lost while it was loaded was unloaded by the heartbeat before it was loaded, so again here
+            lost = gained - self.partitions
+            if lost:
+                self.unloadPartitions(lost)
+
+    def _renewLeases(self):
+        while not self._stopped.wait(self.leases.ttl / 3):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.warning("Lease heartbeat failed (%s)", e)
+
+    def _midnight(self, key, when):
+        self.materializePartitions(self.partitions)
+        # The items due at midnight may have run before their jobs were created
+        dispatchReadyJobs(self.partitions)
+
+    def _resync(self):
+        # Feeders inserted without a partition (e.g. by an older version) are assigned one here
+        db_helper.assignFeederPartitions()
+        self.loadSchedules()
+        self.scheduleSingleJobs(self.partitions)
+
+    def _nextResync(self, after):
+        return after + dt.timedelta(seconds=self.resyncInterval)
+
+    def _watchSchedules(self):
+        while not self._stopped.is_set():
+            try:
+                for feederId, feedSchedule in db_helper.watchFeederSchedules():
+                    if db_helper.feederPartition(feederId) not in self.partitions:
+                        continue
+                    if feedSchedule is None:
+                        self.removeFeeder(feederId)
+                    else:
+                        self.setFeederSchedule(feederId, feedSchedule)
+            except Exception as e:
+                logger.warning("Feeder schedule change stream failed (%s), retrying in %ss", e, self.retryInterval)
+            self._stopped.wait(self.retryInterval)
+
+    def _watchSingleJobs(self):
+        # The single jobs booked while the change stream was closed are loaded once it is open
+        while not self._stopped.is_set():
+            try:
+                for feederId, time in db_helper.watchScheduledEvents(onOpen=lambda: self.scheduleSingleJobs(self.partitions),
+                                                                     eventType="S"):
+                    if db_helper.feederPartition(feederId) in self.partitions:
+                        self.scheduleSingleJob(feederId, time)
+            except Exception as e:
+                logger.warning("Single job change stream failed (%s), retrying in %ss", e, self.retryInterval)
+            self._stopped.wait(self.retryInterval)
+
+def _nextMinute(after):
+    # Second 59 of every minute
+    following = after.replace(second=59, microsecond=0)
+    return following if following >= after else following + dt.timedelta(minutes=1)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Dispatches the scheduled pet feeder jobs")
+
+    parser.add_argument(
+        '--resync_interval',
+        help = 'The number of seconds between reloads of every feeder schedule [default=3600]',
+        type = float,
+        default = 3600.0
+    )
+
+    parser.add_argument(
+        '--lease_ttl',
+        help = 'The number of seconds a partition lease lasts without a heartbeat, the partitions of a stopped worker are taken over after it [default=30]',
+        type = float,
+        default = 30.0
+    )
+
+    parser.add_argument(
+        '--materialize_workers',
+        help = 'The number of threads creating the jobs of each day, each from its own range of feeders [default=1]',
+        type = int,
+        default = 1
+    )
 
-scheduleJobs()
+    parser.add_argument(
+        '--test_feeder',
+        help = 'Logs random amounts of food eaten every minute for this feeder id, for testing the website [default=None]',
+        type = str,
+        default = None
+    )
+    return parser.parse_args()
 
-schedule.every().minute.at(":00").do(processScheduledJobs)
-schedule.every().minute.at(":59").do(sendDeltaFood)
-schedule.every().day.at("00:00").do(scheduleJobs)
+def main(args):
+    log_setup.configureLogging()
+    scheduler = Scheduler(resyncInterval=args.resync_interval, testFeederId=args.test_feeder,
+                          materializeWorkers=args.materialize_workers, leases=PartitionLeases(ttl=args.lease_ttl))
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+if __name__ == "__main__":
+    main(parse_args())
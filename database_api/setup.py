@@ -17,5 +17,9 @@ setuptools.setup(
         "bson",
         "bcrypt",
         "dnspython"
-    ]
+    ],
+    extras_require = {
+        # Vectorized next occurrences of schedule items (feeder_api.schedule_vector)
+        "vector": ["numpy"]
+    }
 )
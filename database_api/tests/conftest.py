@@ -0,0 +1,49 @@
+"""
+Fixtures of the Database API tests, which run against mongomock instead of a MongoDB deployment.
+
+Run from the database_api folder with "python -m pytest tests" (needs pytest and mongomock).
+"""
+
+import datetime as dt
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+class MockClient(mongomock.MongoClient):
+    """
+        A mongomock client that ignores the MongoDB URI db_helper connects with.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+# db_helper connects when it is imported
+pymongo.MongoClient = MockClient
+from feeder_api import clock, db_helper
+
+@pytest.fixture
+def db():
+    """
+        db_helper on an empty mongomock database with its indexes.
+    """
+    db_helper._client.drop_database("smartfeeder")
+    db_helper.reconnect()
+    db_helper.ensureIndexes()
+    yield db_helper
+    db_helper._client.drop_database("smartfeeder")
+
+@pytest.fixture
+def virtualClock():
+    """
+        A VirtualClock at 08:00 today used by the whole process, the system clock is restored afterwards.
+    """
+    virtual = clock.VirtualClock(dt.datetime.combine(dt.date.today(), dt.time(8)))
+    previous = clock.setClock(virtual)
+    yield virtual
+    clock.setClock(previous)
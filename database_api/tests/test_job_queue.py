@@ -0,0 +1,86 @@
+import datetime as dt
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+from feeder_api.job_queue import JobQueue
+
+NOW = dt.datetime(2020, 10, 20, 12)
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient()["smartfeeder"]["jobs_scheduled"]
+
+def insertJob(collection, time, feederId=None):
+    return collection.insert_one({"feederId": feederId or ObjectId(), "type": "R", "time": time, "count": 1}).inserted_id
+
+def test_claim_leases_the_earliest_due_job(collection):
+    later = insertJob(collection, NOW - dt.timedelta(minutes=1))
+    earliest = insertJob(collection, NOW - dt.timedelta(minutes=5))
+    insertJob(collection, NOW + dt.timedelta(minutes=5))
+    queue = JobQueue(collection, owner="a", visibilityTimeout=60)
+
+    job = queue.claim(now=NOW)
+    assert job["_id"] == earliest
+    assert job["owner"] == "a"
+    assert job["leaseExpires"] == NOW + dt.timedelta(seconds=60)
+    assert job["attempts"] == 1
+    assert queue.claim(now=NOW)["_id"] == later
+    # The third job is not due yet
+    assert queue.claim(now=NOW) is None
+
+def test_claimed_job_is_invisible_until_its_lease_expires(collection):
+    insertJob(collection, NOW)
+    first = JobQueue(collection, owner="a", visibilityTimeout=60)
+    second = JobQueue(collection, owner="b", visibilityTimeout=60)
+
+    job = first.claim(now=NOW)
+    assert second.claim(now=NOW + dt.timedelta(seconds=59)) is None
+    assert second.claimAll(now=NOW + dt.timedelta(seconds=59)) == []
+
+    again = second.claim(now=NOW + dt.timedelta(seconds=61))
+    assert again["_id"] == job["_id"]
+    assert again["owner"] == "b"
+    assert again["attempts"] == 2
+
+def test_ack_of_an_expired_lease_leaves_the_job_to_its_new_owner(collection):
+    insertJob(collection, NOW)
+    first = JobQueue(collection, owner="a", visibilityTimeout=60)
+    second = JobQueue(collection, owner="b", visibilityTimeout=60)
+
+    stale = first.claim(now=NOW)
+    current = second.claim(now=NOW + dt.timedelta(seconds=61))
+    assert first.ack([stale]) == 0
+    assert first.nack([stale]) == 0
+    assert first.extend([stale]) == 0
+    assert collection.count_documents({}) == 1
+    assert second.ack([current]) == 1
+    assert collection.count_documents({}) == 0
+
+def test_claim_all_claims_every_due_job_of_the_query(collection):
+    feederId = ObjectId()
+    for minutes in (1, 2, 3):
+        insertJob(collection, NOW - dt.timedelta(minutes=minutes), feederId)
+    insertJob(collection, NOW - dt.timedelta(minutes=1))
+    queue = JobQueue(collection, owner="a")
+
+    claimed = queue.claimAll({"feederId": feederId}, now=NOW)
+    assert len(claimed) == 3
+    assert len({job["lease"] for job in claimed}) == 1
+    assert queue.claimAll({"feederId": feederId}, now=NOW) == []
+    assert queue.ack(claimed) == 3
+
+def test_nack_gives_the_job_back(collection, virtualClock):
+    insertJob(collection, virtualClock.now())
+    queue = JobQueue(collection, owner="a", expiryHorizon=3600)
+
+    job = queue.claim()
+    assert queue.nack([job], delay=30) == 1
+    assert queue.claim() is None
+    given = collection.find_one()
+    assert given["owner"] is None and "lease" not in given
+    assert given["time"] == virtualClock.now() + dt.timedelta(seconds=30)
+
+    virtualClock.advance(30)
+    assert queue.claim()["_id"] == job["_id"]
@@ -0,0 +1,37 @@
+import datetime as dt
+
+from bson import ObjectId
+
+def test_occurrence_is_queued_once(db, virtualClock):
+    feeder = db.insertFeeder("address", "testingkey1234", "13511NG%%")
+    db.addScheduleItem(feeder["_id"], scheduleType="R", time=dt.datetime(2000, 1, 1, 12), every=1, unit="days")
+    assert db.jobs.count_documents({}) == 1
+
+    # The daily run and a restarted scheduler create the same occurrence again
+    assert db.materializeDailyJobs() == 0
+    assert db.materializeDailyJobs() == 0
+    jobs = list(db.jobs.find())
+    assert len(jobs) == 1
+    assert jobs[0]["time"] == dt.datetime.combine(virtualClock.now().date(), dt.time(12))
+
+def test_occurrence_keys_differ_by_feeder_item_and_time():
+    from feeder_api import db_helper
+    item = {"type": "R", "time": dt.datetime(2000, 1, 1, 12), "count": 1, "every": 1, "unit": "days"}
+    time = dt.datetime(2020, 10, 20, 12)
+    key = db_helper.occurrenceKey("5f68b87e65ff4dd70d6add43", item, time)
+
+    assert key == db_helper.occurrenceKey("5f68b87e65ff4dd70d6add43", dict(item), time)
+    assert key != db_helper.occurrenceKey("5f68b87e65ff4dd70d6add44", item, time)
+    assert key != db_helper.occurrenceKey("5f68b87e65ff4dd70d6add43", dict(item, count=2), time)
+    assert key != db_helper.occurrenceKey("5f68b87e65ff4dd70d6add43", item, time + dt.timedelta(days=1))
+
+def test_due_job_is_dispatched_once(db, virtualClock):
+    feeder = db.insertFeeder("address", "testingkey1234", "13511NG%%")
+    db.addScheduleItem(feeder["_id"], scheduleType="S", time=virtualClock.now() + dt.timedelta(minutes=5))
+
+    assert not db.hasReadyEventsForFeeder(feeder["_id"])
+    virtualClock.advance(dt.timedelta(minutes=5))
+    assert db.hasReadyEventsForFeeder(feeder["_id"])
+    assert len(db.dispatchReadyEventsForFeeder(feeder["_id"])) == 1
+    assert db.dispatchReadyEventsForFeeder(feeder["_id"]) == []
+    assert db.feedLogs.count_documents({"feederId": ObjectId(feeder["_id"])}) == 1
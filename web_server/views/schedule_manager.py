@@ -1,8 +1,11 @@
 from flask import Blueprint, request, render_template, redirect, url_for, send_from_directory, session, flash
 import feeder_api.db_helper as db
 import datetime as dt
+import logging
 from . import utils
 
+logger = logging.getLogger(__name__)
+
 schedule_blueprint = Blueprint("schedule_blueprint", __name__)
 
 INDEX_TO_DAY = [
@@ -68,8 +71,8 @@ def create_weekly_schedule(feeder_id, time_str, day):
     """
     try:
         schedule_time = dt.datetime.strptime(time_str, "%H:%M")
-    except Exception as e:
-        print(e)
+    except Exception:
+        logger.warning("Invalid schedule time %r for feeder %s", time_str, feeder_id, exc_info=True)
         return None
     db.addScheduleItem(feeder_id,
                         scheduleType="W",
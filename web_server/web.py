@@ -4,13 +4,20 @@ from views.home import home_blueprint
 from views.add_feeder import add_feeder_blueprint
 from views.admin import admin_blueprint
 from views.schedule_manager import schedule_blueprint
+import feeder_api.log_setup as log_setup
 import os
 
 """
 Registers the blueprints for the website endpoint resources and routes for
 the index page and assets.
+
+Logging is set up with the FEEDER_LOG_* environment variables (see
+feeder_api.log_setup) before the app is created, so the Flask logger writes
+through the same background thread.
 """
 
+log_setup.configureLogging()
+
 app =  Flask(__name__, static_url_path='')
 
 app.register_blueprint(auth_blueprint)